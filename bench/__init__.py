@@ -0,0 +1,10 @@
+"""Benchmarks for the eopl interpreters, run them from the repository root:
+
+    python -m bench.startup     # interpreter startup and Language construction
+    python -m bench.evaluate    # evaluation backends on recursive workloads
+    python -m bench.batch       # one program over many rows, with numpy
+    python -m bench.parse       # parsing long generated programs
+    python -m bench.memory      # bytes per node of a parsed program
+    python -m bench.need        # call by need against call by reference
+    python -m bench.suite       # all of the above that's in-process, saved as JSON
+"""
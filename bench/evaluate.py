@@ -0,0 +1,110 @@
+"""Evaluation speed of the different backends on recursive workloads.
+
+    python -m bench.evaluate [--repeat N] [workload ...]
+
+Parsing (and compiling) happens once, outside the timed region; each backend
+then runs the same program `--repeat` times and the best time is reported.
+"""
+
+import argparse
+import sys
+import time
+from functools import partial
+
+from eopl.state import LETREC, PROC, IMPLICIT_REFS
+from eopl.util import LRUCache
+
+
+WORKLOADS = {
+    'fib': (LETREC, """
+        letrec fib(i) =
+            if i == 0 then 0 else
+            if i == 1 then 1 else
+            fib(i-1) + fib(i-2)
+        in fib(20)
+    """),
+    'even_odd': (LETREC, """
+        letrec even(i) = if i == 0 then true else odd(i-1);
+               odd(i) = if i == 0 then false else even(i-1)
+        in even(500)
+    """),
+    'chain': (PROC, """
+        let chain = proc(f1) proc(f2) proc(x) f2(f1(x));
+            add_one = proc(x) x+1;
+            mult_two = proc(x) x*2 in
+        let twice = proc(f) chain(f)(f) in
+        twice(twice(twice(twice(add_one))))(twice(twice(mult_two))(5))
+    """),
+    'counter': (IMPLICIT_REFS, """
+        let count = 0 in
+        letrec loop(i) = if i == 0 then count else begin set count = count + i; loop(i-1) end
+        in loop(500)
+    """),
+    'constants': (LETREC, """
+        let size = 10; step = 2 * 3 - 5; debug = false in
+        letrec loop(i) =
+            if i == 0 then 0 else
+            if debug then 1 / 0 else
+            (size * size + 4 * step) mod 7 + loop(i - step)
+        in loop(2000)
+    """),
+}
+
+
+def memoized(lang, src):
+    prog = lang.parse(src)
+    # A fresh cache every run, otherwise all but the first run are free
+    return lambda: prog.evaluate(memo=LRUCache())
+
+
+# Each backend turns (language, source) into a function that runs the program
+BACKENDS = {
+    'evaluate': lambda lang, src: lang.parse(src).evaluate,
+    'compile': lambda lang, src: lang.compile(src),
+    'stack_safe': lambda lang, src: partial(lang.parse(src).evaluate, stack_safe=True),
+    'optimized': lambda lang, src: lang.compile(src, optimize=True),
+    'specialize': lambda lang, src: lang.parse(src).specialize(),
+    'vm': lambda lang, src: lang.parse(src).assemble().run,
+    'memo': memoized,
+}
+
+
+def best_of(fn, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--backend', action='append', choices=list(BACKENDS))
+    parser.add_argument('workloads', nargs='*', metavar='workload', help=', '.join(WORKLOADS))
+    args = parser.parse_args(argv)
+    for name in args.workloads:
+        if name not in WORKLOADS:
+            parser.error(f"unknown workload {name!r}")
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 20000))
+
+    backends = args.backend or list(BACKENDS)
+    print(f"{'workload':<10}" + ''.join(f"{b:>14}" for b in backends))
+    for name in args.workloads or WORKLOADS:
+        lang, src = WORKLOADS[name]
+        times = []
+        expected = None
+        for b in backends:
+            t, result = best_of(BACKENDS[b](lang, src), args.repeat)
+            if expected is None:
+                expected = result
+            elif result != expected:
+                raise AssertionError(f"{b} gave {result!r} on {name}, expected {expected!r}")
+            times.append(t)
+        base = times[0]
+        print(f"{name:<10}" + ''.join(f"{t * 1000:>8.1f}ms {base / t:>3.1f}x" for t in times))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""Memory: how many bytes does a parsed program keep alive, per node?
+
+A large LETREC program is generated and parsed in a fresh interpreter; the
+bytes it retains afterwards (measured with tracemalloc) are divided by the
+number of nodes in its tree. To compare against another revision, check it out
+next to this one and point --tree at it:
+
+    git worktree add /tmp/eopl-before HEAD~1
+    python -m bench.memory --tree /tmp/eopl-before
+    python -m bench.memory
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+
+# Runs in the checkout that's measured, so it only uses what every revision has
+CHILD = r'''
+import dataclasses, gc, json, sys, tracemalloc
+from eopl.state import LETREC
+
+def generate(size):
+    parts = []
+    for i in range(size):
+        prev = f"a{i - 1}" if i else "0"
+        parts.append([
+            f"a{i} = f({prev}) * 2 - {i % 7}",
+            f"a{i} = if {prev} < 10 then true else false",
+            f"a{i} = let y = {i} in proc(z) z + y",
+        ][i % 3])
+    return ("letrec f(x) = if x == 0 then 1 else x + f(x - 1) in let "
+            + "; ".join(parts) + " in 0")
+
+def count(obj, seen):
+    # Nodes are dataclasses, lists of nodes are lists
+    if isinstance(obj, list):
+        return sum(count(x, seen) for x in obj)
+    if not dataclasses.is_dataclass(obj):
+        return 0
+    seen.add(id(obj))
+    return 1 + sum(count(getattr(obj, f.name), seen) for f in dataclasses.fields(obj))
+
+sys.setrecursionlimit(100000)
+size = int(sys.argv[1])
+src = generate(size)
+LETREC.parse(generate(3))  # build the parser (and anything shared) first
+gc.collect()
+tracemalloc.start()
+before = tracemalloc.get_traced_memory()[0]
+prog = LETREC.parse(src)
+gc.collect()
+retained = tracemalloc.get_traced_memory()[0] - before
+tracemalloc.stop()
+seen = set()
+nodes = count(prog, seen)
+print(json.dumps({'nodes': nodes, 'objects': len(seen), 'bytes': retained}))
+'''
+
+
+def measure(tree, size):
+    env = dict(os.environ, PYTHONPATH=str(tree))
+    out = subprocess.run([sys.executable, '-c', CHILD, str(size)], cwd=tree, env=env,
+                         check=True, capture_output=True, text=True).stdout
+    return json.loads(out)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tree', type=Path, default=Path(__file__).resolve().parent.parent,
+                        help="checkout to measure (default: this one)")
+    parser.add_argument('--size', type=int, default=3000, help="number of let bindings")
+    args = parser.parse_args(argv)
+
+    result = measure(args.tree, args.size)
+    print(f"{'nodes':>10} {'objects':>10} {'retained':>12} {'bytes/node':>11}")
+    print(f"{result['nodes']:>10} {result['objects']:>10} {result['bytes'] / 1e6:>10.2f}MB"
+          f" {result['bytes'] / result['nodes']:>11.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""Call by need against call by reference, on programs that don't use everything.
+
+    python -m bench.need [--repeat N] [workload ...]
+
+Every workload is run in IMPLICIT_REFS, which evaluates every binding and
+argument up front, and in CALL_BY_NEED, which only evaluates them once they're
+read. Both languages run each program with evaluate() and with compile();
+parsing and compiling happen outside the timed region.
+"""
+
+import argparse
+import sys
+import time
+
+from eopl.state import IMPLICIT_REFS, CALL_BY_NEED
+
+
+FIB = "letrec fib(i) = if i < 2 then i else fib(i - 1) + fib(i - 2) in "
+
+WORKLOADS = {
+    # An expensive binding that's never used
+    'unused': FIB + "let unused = fib(18); used = 1 in used",
+    # An expensive argument that's only used on one branch
+    'branch': FIB + """
+        letrec loop(n) = if n == 0 then 0 else pick(n mod 10 == 0)(fib(12)) + loop(n - 1);
+               pick(c) = proc (x) if c then x else 1
+        in loop(200)
+    """,
+    # Used many times: by need evaluates it once, like by reference
+    'shared': FIB + """
+        let x = fib(16) in
+        letrec sum(n) = if n == 0 then 0 else x + sum(n - 1)
+        in sum(200)
+    """,
+}
+
+BACKENDS = {
+    'evaluate': lambda lang, src: lang.parse(src).evaluate,
+    'compile': lambda lang, src: lang.compile(src),
+}
+
+
+def best_of(fn, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('workloads', nargs='*', metavar='workload', help=', '.join(WORKLOADS))
+    args = parser.parse_args(argv)
+    for name in args.workloads:
+        if name not in WORKLOADS:
+            parser.error(f"unknown workload {name!r}")
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 20000))
+
+    print(f"{'workload':<10}" + ''.join(f"{b + ' ref':>14}{b + ' need':>20}" for b in BACKENDS))
+    for name in args.workloads or WORKLOADS:
+        src = WORKLOADS[name]
+        line = f"{name:<10}"
+        for backend in BACKENDS.values():
+            eager, expected = best_of(backend(IMPLICIT_REFS, src), args.repeat)
+            lazy, result = best_of(backend(CALL_BY_NEED, src), args.repeat)
+            if result != expected:
+                raise AssertionError(f"call by need gave {result!r} on {name}, expected {expected!r}")
+            line += f"{eager * 1000:>12.1f}ms{lazy * 1000:>12.1f}ms {eager / lazy:>5.1f}x"
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""Parsing speed on long generated programs.
+
+    python -m bench.parse [--size N] [--repeat N] [program ...]
+
+Every program has `--size` items in one list: statements in a begin block,
+bindings in a let, or procedures in a letrec group. Every program is parsed
+with both parser backends (parglare's LR parser and the Pratt parser of
+eopl.pratt), and loaded from the binary format of Language.dumps. The lexing
+column is the Pratt parser's tokenizer alone, in MB of source per second.
+"""
+
+import argparse
+import sys
+import time
+
+from eopl.state import EXPLICIT_REFS
+
+
+def begin_block(n):
+    return "let r = newref(0) in begin\n" + ";\n".join(
+        f"setref(r, deref(r) + {i})" for i in range(n)) + "\nend"
+
+
+def long_let(n):
+    return "let " + ";\n".join(f"x{i} = {i}" for i in range(n)) + f"\nin x{n - 1}"
+
+
+def letrec_group(n):
+    return "letrec " + ";\n".join(
+        f"f{i}(x) = if x == 0 then {i} else f{(i + 1) % n}(x - 1)" for i in range(n)) + "\nin f0(10)"
+
+
+PROGRAMS = {
+    'begin': begin_block,
+    'let': long_let,
+    'letrec': letrec_group,
+}
+
+
+def best_of(fn, arg, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(arg)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=int, default=50000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('programs', nargs='*', metavar='program', help=', '.join(PROGRAMS))
+    args = parser.parse_args(argv)
+    for name in args.programs:
+        if name not in PROGRAMS:
+            parser.error(f"unknown program {name!r}")
+    # Analysis passes still recurse over the (deep) tree
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 20000))
+
+    pratt = EXPLICIT_REFS.add_types(backend='pratt')
+    # Build (or load) the parsers outside the timed region
+    EXPLICIT_REFS.parser
+    pratt.pratt_parser
+    for name in args.programs or PROGRAMS:
+        text = PROGRAMS[name](args.size)
+        slow, prog = best_of(EXPLICIT_REFS.parse, text, args.repeat)
+        fast, pratt_prog = best_of(pratt.parse, text, args.repeat)
+        data = EXPLICIT_REFS.dumps(prog)
+        assert pratt.pratt_parser.fallbacks == 0 and pratt.dumps(pratt_prog) == data
+        lex, _ = best_of(pratt.pratt_parser.tokenize, text, args.repeat)
+        load, loaded = best_of(EXPLICIT_REFS.loads, data, args.repeat)
+        assert loaded == prog
+        print(f"{name:<8} {args.size:>7} items {len(text) / 1e6:>6.2f}MB  parglare {slow:>8.3f}s"
+              f"  pratt {fast:>7.3f}s {slow / fast:>5.1f}x  lex {len(text) / 1e6 / lex:>6.1f}MB/s"
+              f"  load {load:>7.3f}s ({len(data) / 1e6:.2f}MB) {slow / load:>6.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+"""Startup time: how long does `python -c "import eopl.state"` take?
+
+Every scenario runs in a fresh interpreter, `--repeat` times, and the best and
+median wall-clock times are reported. To compare against another revision,
+check it out next to this one and point --tree at it:
+
+    git worktree add /tmp/eopl-before HEAD~1
+    python -m bench.startup --tree /tmp/eopl-before
+    python -m bench.startup
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+
+SCENARIOS = {
+    'import': "import eopl.state",
+    'import+parse': "import eopl.state; eopl.state.IMPLICIT_REFS.parse('let x = 1 in x')",
+}
+
+
+def run_once(code, tree, cache_dir):
+    env = dict(os.environ, EOPL_CACHE_DIR=cache_dir, PYTHONPATH=str(tree))
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-c', code], cwd=tree, env=env, check=True)
+    return time.perf_counter() - start
+
+
+def measure(code, tree, cache_dir, repeat):
+    return [run_once(code, tree, cache_dir) for _ in range(repeat)]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tree', type=Path, default=Path(__file__).resolve().parent.parent,
+                        help="checkout to measure (default: this one)")
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    print(f"{'scenario':<24} {'best':>8} {'median':>8}")
+    with TemporaryDirectory() as warm_dir:
+        # Fill the table cache first, so 'warm' really is warm
+        run_once(SCENARIOS['import+parse'], args.tree, warm_dir)
+        for cache, cache_dir in [('no cache', ''), ('warm', warm_dir)]:
+            for name, code in SCENARIOS.items():
+                times = measure(code, args.tree, cache_dir, args.repeat)
+                print(f"{name + ' (' + cache + ')':<24} {min(times):>7.3f}s {statistics.median(times):>7.3f}s")
+
+
+if __name__ == '__main__':
+    main()
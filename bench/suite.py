@@ -0,0 +1,304 @@
+"""The whole benchmark suite, with results in JSON to compare revisions.
+
+    python -m bench.suite list [pattern ...]
+    python -m bench.suite run [--repeat N] [--out results.json] [pattern ...]
+    python -m bench.suite compare baseline.json results.json [--threshold 0.1]
+
+Benchmarks are named like parse/pratt/letrec/10000, and the patterns (shell
+style, like 'eval/fib/*') pick which of them run. There are:
+
+    parse/BACKEND/PROGRAM/SIZE   parsing the generated programs of bench.parse
+    language/LANGUAGE/CACHE      building a Language's parser, with a cold or
+                                 warm table cache (see eopl.cache)
+    eval/WORKLOAD/BACKEND        deep recursion (fib, even_odd), closures
+                                 (chain), dynamic scoping (dynamic) and store
+                                 traffic (counter_explicit, counter_implicit)
+                                 with every backend that supports them
+
+Every benchmark is set up outside the timed region. Fast ones are looped
+until a run takes at least --min-time seconds. Of the --repeat runs, the best
+and the median time per call are saved. compare matches two result files by
+benchmark name, and flags a regression if the best time grew by more than
+--threshold. It exits with 1 if there are any, so it can gate CI:
+
+    python -m bench.suite run --out baseline.json
+    (make changes)
+    python -m bench.suite run --out new.json
+    python -m bench.suite compare baseline.json new.json
+"""
+
+import argparse
+import fnmatch
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from functools import partial
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from eopl.state import LANGUAGES, PROC, DYNPROC, LETREC, EXPLICIT_REFS, IMPLICIT_REFS
+from bench.evaluate import BACKENDS as EVAL_BACKENDS
+from bench.parse import PROGRAMS
+
+
+# Benchmarks
+# ===============================================
+
+# name -> function that sets the benchmark up and returns (run, check, work):
+# `run` is timed, check(result) raises if the result is wrong, and `work` is
+# the amount of input for the throughput column (in MB), or None
+BENCHMARKS = {}
+
+
+def parse_benchmark(backend, program, size):
+    lang = EXPLICIT_REFS.add_types(backend=backend)
+    # Build (or load) the parser now, not in the first run
+    lang.parser if backend == 'parglare' else lang.pratt_parser
+    text = PROGRAMS[program](size)
+    expected = EXPLICIT_REFS.parse(text)
+    def check(prog):
+        if prog != expected:
+            raise AssertionError("parsed a different program")
+    return partial(lang.parse, text), check, len(text) / 1e6
+
+
+# parglare is an order of magnitude slower, so it doesn't get the largest size
+PARSE_SIZES = {
+    'parglare': (500, 2000),
+    'pratt': (500, 2000, 10000),
+}
+
+for backend, sizes in PARSE_SIZES.items():
+    for program in PROGRAMS:
+        for size in sizes:
+            BENCHMARKS[f'parse/{backend}/{program}/{size}'] = partial(parse_benchmark, backend, program, size)
+
+
+# Holds the tables of the warm language benchmarks, removed at exit
+_warm_dir = None
+
+
+def language_benchmark(name, warm):
+    global _warm_dir
+    if warm and _warm_dir is None:
+        _warm_dir = TemporaryDirectory()
+    cache_dir = _warm_dir.name if warm else ''
+    def run():
+        old = os.environ.get('EOPL_CACHE_DIR')
+        os.environ['EOPL_CACHE_DIR'] = cache_dir
+        try:
+            # A new Language, so nothing's built yet
+            return LANGUAGES[name].add_types().parser
+        finally:
+            if old is None:
+                del os.environ['EOPL_CACHE_DIR']
+            else:
+                os.environ['EOPL_CACHE_DIR'] = old
+    if warm:
+        # Fill the cache
+        run()
+    return run, lambda parser: None, None
+
+
+for name in LANGUAGES:
+    for state in ('cold', 'warm'):
+        BENCHMARKS[f'language/{name}/{state}'] = partial(language_benchmark, name, state == 'warm')
+
+
+FIB = "letrec fib(i) = if i < 2 then i else fib(i - 1) + fib(i - 2) in fib(20)"
+
+WORKLOADS = {
+    # (language, source, expected value)
+    'fib': (LETREC, FIB, 6765),
+    'even_odd': (LETREC, """
+        letrec even(i) = if i == 0 then true else odd(i - 1);
+               odd(i) = if i == 0 then false else even(i - 1)
+        in even(2000)
+    """, True),
+    'chain': (PROC, """
+        let chain = proc(f1) proc(f2) proc(x) f2(f1(x));
+            add_one = proc(x) x+1;
+            mult_two = proc(x) x*2 in
+        let twice = proc(f) chain(f)(f) in
+        twice(twice(twice(twice(add_one))))(twice(twice(mult_two))(5))
+    """, 96),
+    # sum sees itself and `step` in the environment of its caller
+    'dynamic': (DYNPROC, """
+        let step = 1 in
+        let sum = proc (n) if n == 0 then 0 else n + sum(n - step) in
+        let twice = proc (n) let step = 2 in sum(n) in
+        sum(1000) + twice(1000)
+    """, 751000),
+    'counter_explicit': (EXPLICIT_REFS, """
+        let count = newref(0) in
+        letrec loop(i) = if i == 0 then deref(count)
+                         else begin setref(count, deref(count) + i); loop(i - 1) end
+        in loop(1000)
+    """, 500500),
+    'counter_implicit': (IMPLICIT_REFS, """
+        let count = 0 in
+        letrec loop(i) = if i == 0 then count else begin set count = count + i; loop(i - 1) end
+        in loop(1000)
+    """, 500500),
+}
+
+
+def eval_benchmark(workload, backend):
+    lang, src, expected = WORKLOADS[workload]
+    def check(result):
+        if result != expected:
+            raise AssertionError(f"got {result!r}, expected {expected!r}")
+    return EVAL_BACKENDS[backend](lang, src), check, None
+
+
+# The bytecode compiler doesn't do dynamic scoping
+UNSUPPORTED = {('dynamic', 'vm')}
+
+for workload in WORKLOADS:
+    for backend in EVAL_BACKENDS:
+        if (workload, backend) in UNSUPPORTED:
+            continue
+        BENCHMARKS[f'eval/{workload}/{backend}'] = partial(eval_benchmark, workload, backend)
+
+
+def select(patterns):
+    if not patterns:
+        return list(BENCHMARKS)
+    return [name for name in BENCHMARKS if any(fnmatch.fnmatchcase(name, p) for p in patterns)]
+
+
+# Measuring
+# ===============================================
+
+def measure(setup, repeat, min_time):
+    """Times per call (in seconds) of `repeat` runs of the benchmark."""
+    run, check, work = setup()
+    start = time.perf_counter()
+    check(run())
+    first = time.perf_counter() - start
+    loops = max(1, int(min_time / first)) if first > 0 else 1000
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(loops):
+            run()
+        times.append((time.perf_counter() - start) / loops)
+    return {
+        'best': min(times),
+        'median': statistics.median(times),
+        'loops': loops,
+        'repeat': repeat,
+        'work': work,
+    }
+
+
+def _commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=Path(__file__).resolve().parent, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(names, repeat, min_time, out=None):
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 20000))
+    results = {}
+    print(f"{'benchmark':<40} {'best':>10} {'median':>10}")
+    for name in names:
+        r = results[name] = measure(BENCHMARKS[name], repeat, min_time)
+        line = f"{name:<40} {r['best'] * 1000:>8.3f}ms {r['median'] * 1000:>8.3f}ms"
+        if r['work']:
+            line += f" {r['work'] / r['best']:>7.2f}MB/s"
+        print(line, flush=True)
+    data = {
+        'meta': {
+            'commit': _commit(),
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'machine': platform.machine(),
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        },
+        'results': results,
+    }
+    if out:
+        with open(out, 'w') as f:
+            json.dump(data, f, indent=2)
+    return data
+
+
+def compare(baseline, new, threshold):
+    """Lines describing the changes from `baseline` to `new` (the results of
+    run()) and the names of the benchmarks that got slower than `threshold`."""
+    lines = [f"{'benchmark':<40} {'baseline':>10} {'new':>10} {'change':>8}"]
+    regressions = []
+    for name, r in new['results'].items():
+        old = baseline['results'].get(name)
+        if old is None:
+            lines.append(f"{name:<40} {'':>10} {r['best'] * 1000:>8.3f}ms {'new':>8}")
+            continue
+        ratio = r['best'] / old['best']
+        if ratio > 1 + threshold:
+            verdict = 'REGRESSION'
+            regressions.append(name)
+        elif ratio < 1 / (1 + threshold):
+            verdict = 'faster'
+        else:
+            verdict = ''
+        lines.append(f"{name:<40} {old['best'] * 1000:>8.3f}ms {r['best'] * 1000:>8.3f}ms"
+                     f" {(ratio - 1) * 100:>+7.1f}% {verdict}")
+    for name in baseline['results']:
+        if name not in new['results']:
+            lines.append(f"{name:<40} {baseline['results'][name]['best'] * 1000:>8.3f}ms {'':>10} {'missing':>8}")
+    return lines, regressions
+
+
+# Command line
+# ===============================================
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m bench.suite', description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+    list_cmd = commands.add_parser('list', help="list the benchmarks")
+    list_cmd.add_argument('patterns', nargs='*', metavar='pattern')
+    run_cmd = commands.add_parser('run', help="run benchmarks")
+    run_cmd.add_argument('patterns', nargs='*', metavar='pattern')
+    run_cmd.add_argument('--repeat', type=int, default=5)
+    run_cmd.add_argument('--min-time', type=float, default=0.05,
+                         help="loop fast benchmarks until a run takes this many seconds")
+    run_cmd.add_argument('--out', help="write the results to this JSON file")
+    compare_cmd = commands.add_parser('compare', help="compare two result files")
+    compare_cmd.add_argument('baseline')
+    compare_cmd.add_argument('new')
+    compare_cmd.add_argument('--threshold', type=float, default=0.1,
+                             help="relative slowdown that counts as a regression (default: 0.1)")
+    args = parser.parse_args(argv)
+
+    if args.command == 'compare':
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.new) as f:
+            new = json.load(f)
+        lines, regressions = compare(baseline, new, args.threshold)
+        print('\n'.join(lines))
+        if regressions:
+            print(f"\n{len(regressions)} regression(s) over {args.threshold:.0%}", file=sys.stderr)
+            return 1
+        return 0
+
+    names = select(args.patterns)
+    if not names:
+        parser.error(f"no benchmarks match {' '.join(args.patterns)}")
+    if args.command == 'list':
+        print('\n'.join(names))
+    else:
+        run(names, args.repeat, args.min_time, args.out)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,9 @@
+"""Interpreters for the languages of Essentials of Programming Languages.
+
+The node classes and contexts are slotted dataclasses, which need Python 3.10.
+"""
+
+import sys
+
+if sys.version_info < (3, 10):
+    raise ImportError(f"eopl needs Python 3.10 or newer, this is {sys.version.split()[0]}")
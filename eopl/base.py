@@ -1,27 +1,293 @@
+from dataclasses import dataclass, fields
 
-from dataclasses import dataclass, replace, field
-from collections import ChainMap
 
+def _last_index(names, name):
+    index = names.index(name)
+    if names.count(name) > 1:
+        # Later bindings shadow earlier ones, like with a dict
+        index = len(names) - 1 - names[::-1].index(name)
+    return index
 
-class Environment(ChainMap):
-    layer = ChainMap.new_child
+
+class Frame:
+    """Runtime environment: one layer of values, linked to its parent.
+    
+    Variables are found by the lexical address (depth, index) that Scope.resolve
+    computed beforehand, the names are only kept for dynamic scoping, programs
+    that weren't resolved and error messages.
+    """
+    
+    __slots__ = ('names', 'values', 'parent')
+    
+    def __init__(self, names, values, parent):
+        self.names = names
+        self.values = values
+        self.parent = parent
+    
+    def get(self, depth, index):
+        env = self
+        for _ in range(depth):
+            env = env.parent
+        return env.values[index]
+    
+    def lookup(self, name):
+        env = self
+        while env is not None:
+            if name in env.names:
+                return env.values[_last_index(env.names, name)]
+            env = env.parent
+        raise KeyError(name)
+    
+    def __repr__(self):
+        layers = []
+        env = self
+        while env is not None:
+            layers.append(dict(zip(env.names, env.values)))
+            env = env.parent
+        return f"Frame({', '.join(map(repr, layers))})"
+
+
+class Scope:
+    """Compile-time mirror of the Frames, used to resolve lexical addresses.
+    
+    A dynamic scope is the body of a dynamically scoped procedure: names that
+    aren't found up to that point can only be looked up at runtime.
+    """
+    
+    __slots__ = ('names', 'parent', 'dynamic')
+    
+    def __init__(self, names=(), parent=None, dynamic=False):
+        self.names = tuple(names)
+        self.parent = parent
+        self.dynamic = dynamic
+    
+    def extend(self, names):
+        return Scope(names, self)
+    
+    def resolve(self, name):
+        """Returns (depth, index), or None if `name` is dynamically scoped."""
+        depth = 0
+        scope = self
+        while scope is not None:
+            if name in scope.names:
+                return depth, _last_index(scope.names, name)
+            if scope.dynamic:
+                return None
+            scope = scope.parent
+            depth += 1
+        raise Exception(f"Unbound variable {name}")
+    
+    def fetcher(self, name):
+        """A function that gets `name` out of the Frame matching this scope."""
+        address = self.resolve(name)
+        if address is None:
+            return lambda env: env.lookup(name)
+        depth, index = address
+        return lambda env: env.get(depth, index)
 
 
 class BaseExpr:
+    __slots__ = ()
+    # Set on the nodes by analyze(), they get a slot for it
+    _instance_attrs = ('fvs',)
+    # Free variables, a frozenset filled in by analyze()
+    fvs = None
+    
+    def subexpressions(self):
+        for name in self._fields:
+            v = getattr(self, name)
+            if isinstance(v, BaseExpr):
+                yield v
+            elif isinstance(v, list):
+                yield from v
+    
+    def analyze(self):
+        """Compute (and store) the free variables of this node and all nodes below it.
+        
+        Runs once after parsing, so creating a closure doesn't need to walk its
+        body. Nodes that bind variables override this.
+        """
+        self.fvs = frozenset().union(*(e.analyze() for e in self.subexpressions()))
+        return self.fvs
+    
+    def resolve(self, scope):
+        """Resolve the variables of this node and all nodes below it to lexical
+        addresses in `scope`, for evaluate() (see Program.evaluate).
+        
+        Like analyze(), nodes that bind variables override this.
+        """
+        for e in self.subexpressions():
+            e.resolve(scope)
+    
     def free_vars(self):
-        for v in vars(self).values():
-            yield from v.free_vars()
+        if self.fvs is None:
+            self.analyze()
+        return self.fvs
+    
+    def walk(self):
+        yield self
+        for e in self.subexpressions():
+            yield from e.walk()
+    
+    # Optimization (see Program.optimize)
+    # -----------------------------------
+    
+    # Set on nodes that make variables refer to the caller's environment
+    dynamic = False
+    
+    def map_subexpressions(self, fn):
+        """Replace every direct subexpression `e` by `fn(e)`, in place."""
+        for name in self._fields:
+            v = getattr(self, name)
+            if isinstance(v, BaseExpr):
+                setattr(self, name, fn(v))
+            elif isinstance(v, list):
+                v[:] = [fn(e) for e in v]
+    
+    def optimize(self, inline=True):
+        """Returns an equivalent, optimized node, reusing (and changing) this one.
+        
+        Let bindings are only inlined or removed if `inline` is set.
+        """
+        self.map_subexpressions(lambda e: e.optimize(inline))
+        return self
+    
+    def has_effects(self):
+        # Whether evaluating this can do anything besides returning a value:
+        # change the store, call a procedure, raise an error, ... Only nodes
+        # that are sure they can't override this.
+        return True
+    
+    def count_uses(self, name):
+        """How many times the free variable `name` gets read. Returns infinity if
+        it is assigned to, so it can't be replaced by its value."""
+        return sum(e.count_uses(name) for e in self.subexpressions())
+    
+    def substitute(self, name, node):
+        """Replace the free variable `name` by `node`, in place."""
+        self.map_subexpressions(lambda e: e.substitute(name, node))
+        return self
+    
+    def can_vectorize(self):
+        """Whether vectorize(env, mask, np) can evaluate this for a whole batch
+        of environments at once, see eopl.batch."""
+        return False
+    
+    def check_purity(self, procs):
+        """Whether evaluating this does no store operations, no dynamic scoping and
+        only calls procedures named in `procs` (which are known to be pure).
+        
+        Also marks the pure procedures of every letrec below this node.
+        """
+        # Not all(...): every subexpression has to be visited
+        return all([e.check_purity(procs) for e in self.subexpressions()])
+    
+    def step(self, ctx, stack):
+        # Nodes without subexpressions can just evaluate, the others
+        # override this (see trampoline)
+        return None, self.evaluate(ctx)
+
+
+SAFE_POINT_INTERVAL = 256
+
 
+class OutOfFuel(Exception):
+    pass
+
+
+def trampoline(expr, ctx, fuel=None):
+    """Evaluate `expr` without using the Python stack for nested expressions.
+    
+    expr.step(ctx, stack) either returns (None, value), or (subexpr, sub_ctx) to
+    continue with a subexpression in tail position. Whatever has to happen with
+    the value of that subexpression is pushed on `stack` as a continuation,
+    a function (value, stack) that returns a pair in the same way.
+    
+    Tail calls thus run in constant space, and non-tail recursion only grows
+    `stack`, which lives on the heap.
+    
+    Before a step, (ctx, stack) is everything the rest of the evaluation needs,
+    so every so many steps the context gets the chance to collect garbage.
+    
+    With `fuel`, OutOfFuel is raised once more than that many steps were taken.
+    It's checked at the safe points, so up to SAFE_POINT_INTERVAL steps more
+    may run.
+    """
+    stack = []
+    pop = stack.pop
+    safe_point = ctx.safe_point
+    countdown = SAFE_POINT_INTERVAL
+    while True:
+        countdown -= 1
+        if not countdown:
+            safe_point(ctx, stack)
+            countdown = SAFE_POINT_INTERVAL
+            if fuel is not None:
+                fuel -= SAFE_POINT_INTERVAL
+                if fuel < 0:
+                    raise OutOfFuel("Ran out of fuel")
+        expr, x = expr.step(ctx, stack)
+        while expr is None:
+            if not stack:
+                return x
+            expr, x = pop()(x, stack)
+        ctx = x
 
-@dataclass
+
+_empty_frame = Frame((), (), None)
+
+
+def _make_with_env(cls):
+    # Assigning the fields one by one is several times faster than
+    # dataclasses.replace, which goes through __init__ with keyword arguments
+    others = [f.name for f in fields(cls) if f.name != 'env']
+    source = (f"def with_env(self, env):\n"
+              f"    ctx = new(cls)\n"
+              f"    ctx.env = env\n"
+              + ''.join(f"    ctx.{name} = self.{name}\n" for name in others)
+              + f"    return ctx\n")
+    namespace = {'new': object.__new__, 'cls': cls}
+    exec(source, namespace)
+    return namespace['with_env']
+
+
+def _first_with_env(self, env):
+    """This context with another environment."""
+    # Replaces itself with the code for the fields of the class
+    cls = type(self)
+    cls.with_env = _make_with_env(cls)
+    return cls.with_env(self, env)
+
+
+@dataclass(slots=True)
 class Context:
-    env: Environment = field(default_factory=Environment)
+    # The variables of evaluate(), a linked list of Frames. Extending it only
+    # makes a new Frame and a new Context, everything else is shared.
+    env: Frame = _empty_frame
+    # An LRUCache to memoize calls of pure procedures in, see Program.evaluate
+    memo: object = None
+    # Check invariants while running (slower), see Program.evaluate
+    debug: bool = False
     
-    def with_layer(self, layer: dict):
-        return replace(self, env=self.env.layer(layer))
+    with_env = _first_with_env
+    
+    def __init_subclass__(cls, **kwargs):
+        # (super() without arguments doesn't work in slotted dataclasses)
+        super(Context, cls).__init_subclass__(**kwargs)
+        # A subclass may add fields, so it makes its own with_env
+        cls.with_env = _first_with_env
     
-    def clean_env(self):
-        return replace(self, env=Environment())
+    def bind(self, names, values, env=None):
+        """This context with `names` bound to `values` (sequences of the same
+        length), on top of `env` (by default, this context's environment)."""
+        return self.with_env(Frame(names, values, self.env if env is None else env))
+    
+    def with_layer(self, layer: dict):
+        return self.bind(tuple(layer), tuple(layer.values()))
 
     def wrap(self, value):
         return value
+    
+    def safe_point(self, *roots):
+        # Called when `roots` hold everything that is still needed
+        pass
@@ -0,0 +1,141 @@
+"""Evaluate one program for many environments at once.
+
+    results = evaluate_batch(prog, {'x': xs, 'y': ys})
+
+runs `prog` once for every row i, with the free variable x bound to xs[i] and
+y to ys[i], and returns the results as a numpy array.
+
+If the program only uses constants, variables, let, if and the operators of
+LET (see BaseExpr.can_vectorize) and the columns hold numbers or booleans,
+every node is evaluated once for the whole batch, on numpy arrays:
+
+  - `if` evaluates both branches and picks per row (a masked select). Errors
+    in a branch only count for the rows that take it.
+  - `/` and `mod` are floor division and modulo, like Python's // and %
+    (rounding towards negative infinity). Dividing by zero in a row that
+    matters raises ZeroDivisionError, like evaluate() would.
+  - booleans in arithmetic count as 0 and 1, like in Python.
+
+The results are then equal (==) to what evaluate() gives for each row, except
+that integer columns are numpy's int64: where Python's integers would grow
+beyond 64 bits, numpy wraps around. Columns that don't fit in an int64 to begin
+with are left to the row by row evaluation, as is everything else (procedures,
+references, strings, ...).
+
+numpy is only needed for this module.
+"""
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+__all__ = ('evaluate_batch', 'can_vectorize')
+
+
+def _columns(columns):
+    if np is None:
+        raise Exception("Batches need numpy")
+    columns = {name: np.asarray(values) for name, values in columns.items()}
+    lengths = {len(values) for values in columns.values()}
+    if len(lengths) > 1:
+        raise Exception(f"Columns have different lengths: {sorted(lengths)}")
+    return columns, (lengths.pop() if lengths else 0)
+
+
+def can_vectorize(prog, columns=None):
+    """Whether evaluate_batch will evaluate `prog` on whole columns at once."""
+    if not prog.expr.can_vectorize():
+        return False
+    if columns is not None:
+        columns, _ = _columns(columns)
+        return all(values.dtype.kind in 'biuf' for values in columns.values())
+    return True
+
+
+def evaluate_batch(prog, columns, vectorize=True):
+    """Evaluate `prog` for every row of `columns` (a dict of equally long sequences).
+
+    Set `vectorize` to False to always go row by row.
+    """
+    columns, size = _columns(columns)
+    if vectorize and can_vectorize(prog, columns):
+        mask = np.ones(size, dtype=bool)
+        try:
+            result = prog.expr.vectorize(columns, mask, np)
+        except OverflowError:
+            pass  # a constant doesn't fit in an int64
+        else:
+            return np.broadcast_to(result, (size,)).copy()
+    return _evaluate_rows(prog, columns, size)
+
+
+def _evaluate_rows(prog, columns, size):
+    # Python values, so it's exactly what evaluate() would do
+    rows = {name: values.tolist() for name, values in columns.items()}
+    results = []
+    for i in range(size):
+        ctx = prog.context()
+        ctx = ctx.with_layer({name: ctx.wrap(values[i]) for name, values in rows.items()})
+        results.append(prog.expr.evaluate(ctx))
+    array = np.empty(size, dtype=object)
+    array[:] = results
+    return array
+
+
+# Tests
+# ===============================================
+
+import unittest
+
+
+@unittest.skipIf(np is None, "needs numpy")
+class TestBatch(unittest.TestCase):
+    def setUp(self):
+        from eopl.state import LET, LETREC, EXPLICIT_REFS
+        self.LET, self.LETREC, self.EXPLICIT_REFS = LET, LETREC, EXPLICIT_REFS
+        rng = np.random.default_rng(42)
+        self.columns = {
+            'x': rng.integers(-50, 50, 500),
+            'y': rng.integers(-5, 5, 500),
+            'b': rng.integers(0, 2, 500).astype(bool),
+        }
+
+    def check(self, lang, s, vectorized=True):
+        prog = lang.parse(s)
+        self.assertEqual(can_vectorize(prog, self.columns), vectorized)
+        batch = evaluate_batch(prog, self.columns)
+        rows = evaluate_batch(prog, self.columns, vectorize=False)
+        self.assertEqual(batch.tolist(), rows.tolist())
+        return batch
+
+    def test_arithmetic(self):
+        self.check(self.LET, "let z = x * 3 - y in -z + (x mod 7) * 2")
+        self.check(self.LET, "(x + b) * (b + b) - (not b)")
+
+    def test_floordiv(self):
+        self.check(self.LET, "if y == 0 then 0 else x / y + x mod y")
+        columns = {'x': [7, -7, 7, -7], 'y': [2, 2, -2, -2]}
+        self.assertEqual(evaluate_batch(self.LET.parse("x / y"), columns).tolist(), [3, -4, -4, 3])
+        self.assertEqual(evaluate_batch(self.LET.parse("x mod y"), columns).tolist(), [1, 1, -1, -1])
+        with self.assertRaises(ZeroDivisionError):
+            evaluate_batch(self.LET.parse("x / y"), self.columns)
+
+    def test_if(self):
+        self.check(self.LET, "if x > y and b then x else if x == y then true else y")
+        self.check(self.LET, "if 1 < 2 then x else 1 / 0")
+
+    def test_fallback(self):
+        self.check(self.LETREC, "letrec f(i) = if i < 0 then 0 - i else i in f(x) + y", False)
+        self.check(self.EXPLICIT_REFS, "let r = newref(x) in begin setref(r, deref(r) + y); deref(r) end", False)
+        self.check(self.LET, 'if x > 0 then "pos" else 0', False)
+
+    def test_big_ints(self):
+        columns = {'x': [2**70, 1]}
+        prog = self.LET.parse("x + 1")
+        self.assertFalse(can_vectorize(prog, columns))
+        self.assertEqual(evaluate_batch(prog, columns).tolist(), [2**70 + 1, 2])
+
+
+if __name__ == '__main__':
+    unittest.main()
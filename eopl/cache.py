@@ -0,0 +1,225 @@
+"""On-disk cache for the LR tables parglare builds for a Language.
+
+Building the LALR table is by far the most expensive part of constructing a
+Language, and the grammars only change when the language definitions do. The
+tables are therefore stored as JSON in a cache directory, keyed by a
+fingerprint of the generated grammar (productions, priorities, associativity,
+terminals and the start symbol) so any change to a language simply misses the
+cache and rebuilds.
+
+The cache lives in $EOPL_CACHE_DIR, or in $XDG_CACHE_HOME/eopl (defaulting to
+~/.cache/eopl). Setting EOPL_CACHE_DIR to an empty string disables it.
+
+    python -m eopl.cache warm    # build the tables for every shipped language
+    python -m eopl.cache info    # list the cached tables
+    python -m eopl.cache clear   # remove them
+"""
+
+import hashlib
+import json
+import os
+import sys
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+
+import parglare
+from parglare.closure import LR_1
+from parglare.tables import create_table
+from parglare.tables.persist import table_to_serializable, table_from_serializable
+
+__all__ = ('CACHE_VERSION', 'cache_dir', 'grammar_fingerprint', 'get_table', 'clear', 'warm')
+
+
+# Bump whenever the fingerprint or the file layout changes
+CACHE_VERSION = 1
+
+# Options we build the table with; these match the defaults of parglare.Parser
+_build_options = {
+    'itemset_type': LR_1,
+    'start_production': 1,
+    'prefer_shifts': True,
+    'prefer_shifts_over_empty': True,
+}
+
+
+def cache_dir():
+    """The cache directory, or None if caching is disabled."""
+    path = os.environ.get('EOPL_CACHE_DIR')
+    if path is None:
+        base = os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache'
+        return Path(base) / 'eopl'
+    return Path(path) if path else None
+
+
+def _describe_terminal(t):
+    rec = t.recognizer
+    pattern = getattr(rec, '_regex', None)
+    kind = 'regex' if pattern is not None else 'string'
+    if pattern is None:
+        pattern = getattr(rec, 'value', None)
+    return [t.name, kind, pattern, t.prior, t.finish, t.prefer, t.keyword]
+
+
+def grammar_fingerprint(grammar):
+    """A stable digest of everything the LR table depends on."""
+    description = {
+        'version': CACHE_VERSION,
+        'parglare': parglare.__version__,
+        'options': _build_options,
+        'start': grammar.productions[0].rhs[0].name,
+        'productions': [[p.symbol.name, [s.name for s in p.rhs], p.prior, p.assoc, p.dynamic,
+                         p.nops, p.nopse]
+                        for p in grammar.productions],
+        'terminals': sorted(_describe_terminal(t) for t in grammar.terminals.values()),
+    }
+    data = json.dumps(description, sort_keys=True, default=str).encode('utf-8')
+    return hashlib.sha256(data).hexdigest()
+
+
+def _table_path(directory, fingerprint):
+    return directory / f"{fingerprint[:32]}.json"
+
+
+def _load(path, grammar, fingerprint):
+    try:
+        with open(path, encoding='utf-8') as f:
+            payload = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if (not isinstance(payload, dict)
+            or payload.get('version') != CACHE_VERSION
+            or payload.get('fingerprint') != fingerprint):
+        return None
+    try:
+        return table_from_serializable(payload['table'], grammar)
+    except (LookupError, TypeError, ValueError, AttributeError):
+        # Corrupt or from a grammar that happens to collide; rebuild
+        return None
+
+
+def _save(path, table, fingerprint):
+    payload = {
+        'version': CACHE_VERSION,
+        'fingerprint': fingerprint,
+        'table': table_to_serializable(table),
+    }
+    tmp_name = None
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Write atomically, concurrent workers may be warming the same table
+        with NamedTemporaryFile('w', encoding='utf-8', dir=path.parent,
+                                prefix=f".{path.name}.", delete=False) as tmp:
+            tmp_name = tmp.name
+            json.dump(payload, tmp)
+        os.replace(tmp_name, path)
+    except OSError:
+        # An unwritable cache is not an error, we just rebuild next time
+        if tmp_name is not None:
+            try:
+                os.unlink(tmp_name)
+            except OSError:
+                pass
+
+
+def get_table(grammar):
+    """Load the LR table for `grammar` from the cache, building (and storing) it if needed."""
+    directory = cache_dir()
+    if directory is None:
+        return create_table(grammar, **_build_options)
+
+    fingerprint = grammar_fingerprint(grammar)
+    path = _table_path(directory, fingerprint)
+    table = _load(path, grammar, fingerprint)
+    if table is None:
+        table = create_table(grammar, **_build_options)
+        _save(path, table, fingerprint)
+    return table
+
+
+def clear():
+    """Remove every cached table, returns the number of files removed."""
+    directory = cache_dir()
+    if directory is None or not directory.is_dir():
+        return 0
+    removed = 0
+    for path in directory.glob('*.json'):
+        path.unlink()
+        removed += 1
+    return removed
+
+
+def warm():
+    """Make sure the tables of every shipped language are cached."""
+    from eopl.state import LANGUAGES
+    for lang in LANGUAGES.values():
+        lang.parser
+    return LANGUAGES
+
+
+def _main(args):
+    cmd = args[0] if args else 'warm'
+    if cmd == 'warm':
+        for name in warm():
+            print(f"{name}: ok")
+    elif cmd == 'clear':
+        print(f"Removed {clear()} cached table(s)")
+    elif cmd == 'info':
+        directory = cache_dir()
+        print(f"Cache directory: {directory}")
+        if directory is not None and directory.is_dir():
+            for path in sorted(directory.glob('*.json')):
+                print(f"  {path.name}  {path.stat().st_size:>9}")
+    else:
+        print("Usage: python -m eopl.cache [warm|info|clear]", file=sys.stderr)
+        return 2
+    return 0
+
+
+# Tests
+# ===============================================
+
+import unittest
+from tempfile import TemporaryDirectory
+from unittest import mock
+
+
+class TestTableCache(unittest.TestCase):
+    def setUp(self):
+        from eopl.expressions import LET, LETREC
+        self.LET, self.LETREC = LET, LETREC
+        tmp = TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dir = Path(tmp.name)
+        env = mock.patch.dict(os.environ, {'EOPL_CACHE_DIR': tmp.name})
+        env.start()
+        self.addCleanup(env.stop)
+
+    def test_fingerprint(self):
+        self.assertEqual(grammar_fingerprint(self.LET.grammar), grammar_fingerprint(self.LET.grammar))
+        self.assertNotEqual(grammar_fingerprint(self.LET.grammar), grammar_fingerprint(self.LETREC.grammar))
+
+    def test_fresh_grammars(self):
+        # Building a grammar doesn't change the ones built before
+        first = self.LET.add_types().grammar
+        second = self.LET.add_types().grammar
+        self.assertEqual(grammar_fingerprint(first), grammar_fingerprint(second))
+        self.assertEqual(len(first.get_symbol('LAYOUT').productions), 2)
+
+    def test_roundtrip(self):
+        get_table(self.LET.grammar)
+        self.assertEqual(len(list(self.dir.glob('*.json'))), 1)
+        with mock.patch(f'{__name__}.create_table', side_effect=AssertionError("not cached")):
+            table = get_table(self.LET.grammar)
+        self.assertEqual(len(table.states), len(self.LET.parser.table.states))
+
+    def test_invalid(self):
+        path = _table_path(self.dir, grammar_fingerprint(self.LET.grammar))
+        self.dir.mkdir(exist_ok=True)
+        path.write_text('{"version": 0}')
+        get_table(self.LET.grammar)
+        self.assertEqual(json.loads(path.read_text())['version'], CACHE_VERSION)
+        self.assertEqual(clear(), 1)
+
+
+if __name__ == '__main__':
+    sys.exit(_main(sys.argv[1:]))
@@ -1,23 +1,95 @@
 
 import operator
+import sys
 from dataclasses import dataclass
+from typing import Callable
 
 from eopl.util import *
 from eopl.base import *
+from eopl.base import _empty_frame
 from eopl.language import *
+from eopl import vm, specialize
 
 
 
 # LET: A Simple Language
 # ===============================================
 
+# Batches (see eopl.batch) are evaluated with the same functions, on numpy
+# arrays. These need help to act like they do on Python values.
+_arithmetic = {operator.add, operator.sub, operator.mul, operator.floordiv, operator.mod, operator.neg}
+_can_divide_by_zero = {operator.floordiv, operator.mod}
+
+def _as_number(x, np):
+    # numpy adds booleans as 'or', Python as integers
+    if isinstance(x, bool) or getattr(x, 'dtype', None) == np.bool_:
+        return x * 1
+    return x
+
+
+def _without(names, hidden):
+    # Usually nothing is hidden, then copying (a large set) isn't needed
+    return names if names.isdisjoint(hidden) else names - hidden
+
+
 def make_binary_operator(_name, _cls, _op, _func, _priority, _assoc='left'):
     def f(name=_name, cls=_cls, op=_op, func=_func, priority=_priority, assoc=_assoc):
         @generates(Field('a', cls), op, Field('b', cls), assoc=assoc, priority=priority)
         @replaces(cls)
         class Operator(BaseExpr):
+            __slots__ = ()
+            
             def evaluate(self, ctx):
-                return func(self.a.evaluate(ctx), self.b.evaluate(ctx))
+                # In a local, where a safe point sees it (see _safe_point)
+                a = self.a.evaluate(ctx)
+                return func(a, self.b.evaluate(ctx))
+            
+            def compile(self, scope):
+                a, b = self.a.compile(scope), self.b.compile(scope)
+                def binary(env, ctx):
+                    x = a(env, ctx)
+                    return func(x, b(env, ctx))
+                return binary
+            
+            def specialize(self, scope, counters):
+                return specialize.BinaryNode(func, self.a.specialize(scope, counters),
+                                             self.b.specialize(scope, counters), counters)
+            
+            def step(self, ctx, stack):
+                b = self.b
+                def got_a(a, stack):
+                    stack.append(lambda b, stack: (None, func(a, b)))
+                    return b, ctx
+                stack.append(got_a)
+                return self.a, ctx
+            
+            def emit(self, code, scope, tail=False):
+                self.a.emit(code, scope)
+                self.b.emit(code, scope)
+                code.emit(vm.BINARY, code.operator(func))
+            
+            def can_vectorize(self):
+                return self.a.can_vectorize() and self.b.can_vectorize()
+            
+            def vectorize(self, env, mask, np):
+                a, b = self.a.vectorize(env, mask, np), self.b.vectorize(env, mask, np)
+                if func in _arithmetic:
+                    a, b = _as_number(a, np), _as_number(b, np)
+                if func in _can_divide_by_zero:
+                    zero = b == 0
+                    if np.any(zero & mask):
+                        raise ZeroDivisionError("integer division or modulo by zero")
+                    b = np.where(zero, 1, b)  # rows that don't matter
+                return func(a, b)
+            
+            def optimize(self, inline=True):
+                super().optimize(inline)
+                if isinstance(self.a, Constant) and isinstance(self.b, Constant):
+                    try:
+                        return Constant(val=func(self.a.val, self.b.val))
+                    except Exception:
+                        pass  # Leave the error for when the program runs
+                return self
         Operator.__name__ = name
         Operator.__qualname__ = name
         return Operator
@@ -29,8 +101,43 @@ def make_unary_operator(_name, _cls, _op, _func, _priority):
         @generates(op, Field('a', cls), priority=priority)
         @replaces(cls)
         class Operator(BaseExpr):
+            __slots__ = ()
+            
             def evaluate(self, ctx):
                 return func(self.a.evaluate(ctx))
+            
+            def compile(self, scope):
+                a = self.a.compile(scope)
+                return lambda env, ctx: func(a(env, ctx))
+            
+            def specialize(self, scope, counters):
+                return specialize.UnaryNode(func, self.a.specialize(scope, counters), counters)
+            
+            def step(self, ctx, stack):
+                stack.append(lambda a, stack: (None, func(a)))
+                return self.a, ctx
+            
+            def emit(self, code, scope, tail=False):
+                self.a.emit(code, scope)
+                code.emit(vm.UNARY, code.operator(func))
+            
+            def can_vectorize(self):
+                return self.a.can_vectorize()
+            
+            def vectorize(self, env, mask, np):
+                a = self.a.vectorize(env, mask, np)
+                if func is operator.not_:
+                    return np.logical_not(a)
+                return func(_as_number(a, np))
+            
+            def optimize(self, inline=True):
+                super().optimize(inline)
+                if isinstance(self.a, Constant):
+                    try:
+                        return Constant(val=func(self.a.val))
+                    except Exception:
+                        pass
+                return self
         Operator.__name__ = name
         Operator.__qualname__ = name
         return Operator
@@ -42,68 +149,387 @@ class Expression(BaseExpr):
     pass
 
 
-@generates(Field('expr', Expression))
-class LetProgram(Start):
-    def evaluate(self):
-        ctx = Context()
+class Program(Start):
+    __slots__ = ()
+    _instance_attrs = ('purity_checked', 'resolved')
+    # The type of Context the program runs in
+    context = Context
+    # Whether check_purity ran on the tree, which only memoization needs
+    purity_checked = False
+    # Whether the variables have lexical addresses for evaluate() (see resolve)
+    resolved = False
+    
+    def __post_init__(self):
+        # Called by the parser once the whole tree is there
+        self.expr.analyze()
+    
+    def evaluate(self, stack_safe=False, memo=None, fuel=None, debug=False):
+        """Evaluate the program. Deep recursion in the program can exceed Python's
+        recursion limit, unless `stack_safe` is set (which is slower).
+        
+        If `memo` is an LRUCache, calls of pure letrec procedures (see
+        check_purity) are memoized in it, by procedure and argument.
+        
+        `fuel` limits the number of evaluation steps, after which OutOfFuel
+        is raised (see trampoline). It implies `stack_safe`.
+        
+        With `debug`, the context checks what gets bound (see
+        ImplicitStoreContext), which is too slow to do all the time.
+        
+        Variables are resolved to lexical addresses the first time, so unbound
+        variables are reported before anything runs.
+        """
+        if not self.resolved:
+            self.expr.resolve(Scope())
+            self.resolved = True
+        ctx = self.context(memo=memo, debug=debug)
+        if stack_safe or fuel is not None:
+            if memo is not None:
+                raise Exception("Memoization only works without stack_safe")
+            return trampoline(self.expr, ctx, fuel)
+        if memo is not None and not self.purity_checked:
+            self.expr.check_purity(frozenset())
+            self.purity_checked = True
         return self.expr.evaluate(ctx)
     
+    def compile(self):
+        """Compile to nested closures once, returns a function that runs the program.
+        
+        Variables are resolved to lexical addresses along the way, so unbound
+        variables are reported here instead of when running.
+        """
+        code = self.expr.compile(Scope())
+        context = self.context
+        def run():
+            return code(Frame((), (), None), context())
+        return run
+    
+    def specialize(self):
+        """Build a tree of nodes that specialize themselves while they run (see
+        eopl.specialize), returns a function that runs the program. Its
+        `counters` count how many nodes specialized (and deoptimized) over
+        all runs.
+        """
+        counters = specialize.Counters()
+        node = self.expr.specialize(Scope(), counters)
+        context = self.context
+        def run():
+            return node.execute(Frame((), (), None), context())
+        run.counters = counters
+        return run
+    
+    def assemble(self):
+        """Compile to bytecode for the virtual machine in eopl.vm, returns a Code
+        object (call its run() method to run the program)."""
+        code = vm.Code(self.context)
+        self.expr.emit(code, Scope())
+        code.emit(vm.HALT)
+        return code
+    
+    def optimize(self):
+        """Fold constant subexpressions, drop branches that can't be taken and
+        inline let bindings of constants that are used once, in place. Returns
+        the program.
+        
+        Under dynamic scoping a procedure sees every variable of its caller, so
+        let bindings are left alone in programs that make dynamic procedures.
+        """
+        inline = not any(e.dynamic for e in self.expr.walk())
+        self.expr = self.expr.optimize(inline)
+        self.expr.analyze()
+        self.purity_checked = self.resolved = False
+        return self
+
+
+@generates(Field('expr', Expression))
+class LetProgram(Program):
+    __slots__ = ()
+    
 
 @generates(Field('val', Number))
 @generates(Field('val', Boolean))
 @generates(Field('val', String))
 @replaces(Expression)
 class Constant(BaseExpr):
+    __slots__ = ()
+    # Nothing changes a Constant (not even analyze), so the parser shares the
+    # nodes for small numbers and booleans between all programs
+    _shared = {}
+    fvs = frozenset()
+    
+    @classmethod
+    def from_parse(cls, val):
+        if isinstance(val, str) or (type(val) is int and not 0 <= val < 1024):
+            return cls(val=val)
+        key = (type(val), val)
+        node = cls._shared.get(key)
+        if node is None:
+            node = cls._shared[key] = cls(val=val)
+        return node
+    
     def evaluate(self, ctx):
         return self.val
     
-    def free_vars(self):
-        return; yield
+    def compile(self, scope):
+        val = self.val
+        return lambda env, ctx: val
+    
+    def specialize(self, scope, counters):
+        return specialize.Constant(self.val)
+    
+    def emit(self, code, scope, tail=False):
+        code.emit(vm.CONST, code.constant(self.val))
+    
+    def can_vectorize(self):
+        return not isinstance(self.val, str)
+    
+    def vectorize(self, env, mask, np):
+        return self.val
+    
+    def analyze(self):
+        return self.fvs
+    
+    def has_effects(self):
+        return False
 
 
 @generates(Field('name', RawIdentifier))
 @replaces(Expression)
 class Identifier(BaseExpr):
+    __slots__ = ()
+    _instance_attrs = ('address',)
+    # Lexical address (depth, index), set by resolve() and compile(). The same
+    # for both, their Frames have the same layout.
+    address = None
+    
     def evaluate(self, ctx):
-        if self.name not in ctx.env:
-            raise Exception(f"Couldn't find {self.name} in:\n{pretty(ctx.env)}")
-        return ctx.env[self.name]
+        address = self.address
+        if address is None:
+            # Dynamically scoped, or not resolved (see Program.evaluate)
+            try:
+                return ctx.env.lookup(self.name)
+            except KeyError:
+                raise Exception(f"Couldn't find {self.name} in:\n{pretty(ctx.env)}") from None
+        depth, index = address
+        env = ctx.env
+        while depth:
+            env = env.parent
+            depth -= 1
+        return env.values[index]
+    
+    def resolve(self, scope):
+        self.address = scope.resolve(self.name)
+    
+    def compile(self, scope):
+        self.address = scope.resolve(self.name)
+        if self.address is None:
+            name = self.name
+            def lookup(env, ctx):
+                try:
+                    return env.lookup(name)
+                except KeyError:
+                    raise Exception(f"Couldn't find {name} in:\n{pretty(env)}") from None
+            return lookup
+        depth, index = self.address
+        if depth == 0:
+            return lambda env, ctx: env.values[index]
+        elif depth == 1:
+            return lambda env, ctx: env.parent.values[index]
+        return lambda env, ctx: env.get(depth, index)
+    
+    def specialize(self, scope, counters):
+        self.address = scope.resolve(self.name)
+        if self.address is None:
+            return specialize.Dynamic(self.name)
+        depth, index = self.address
+        if depth == 0:
+            return specialize.Local(index)
+        elif depth == 1:
+            return specialize.Outer(index)
+        return specialize.Address(depth, index)
+    
+    def can_vectorize(self):
+        return True
+    
+    def vectorize(self, env, mask, np):
+        if self.name not in env:
+            raise Exception(f"Couldn't find {self.name} in the batch")
+        return env[self.name]
+    
+    def emit(self, code, scope, tail=False):
+        # Not kept in self.address, the VM's Frames have another layout
+        address = scope.resolve(self.name)
+        if address is None:
+            raise Exception(f"The bytecode compiler doesn't support dynamic scoping ({self.name})")
+        depth, index = address
+        if depth == 0:
+            code.emit(vm.LOAD0, index)
+        elif depth == 1:
+            code.emit(vm.LOAD1, index)
+        else:
+            code.emit(vm.LOAD, depth, index)
 
-    def free_vars(self):
-        yield self.name
+    def analyze(self):
+        self.fvs = frozenset([self.name])
+        return self.fvs
+    
+    def count_uses(self, name):
+        return int(self.name == name)
+    
+    def substitute(self, name, node):
+        return node if self.name == name else self
 
 
 @generates(Field('var', RawIdentifier), '=', Field('value', Expression))
 class Assignment:
-    def free_vars(self):
-        yield from self.value.free_vars()
+    __slots__ = ()
 
 
 @make_list(Assignment, ';')
 class AssignmentList(list):
-    def free_vars(self):
-        for assignment in self:
-            yield from assignment.free_vars()
+    __slots__ = ()
 
 
 @generates('let', Field('assignments', AssignmentList), 'in', Field('expr', Expression))
 @replaces(Expression)
 class LetExpr(BaseExpr):
+    __slots__ = ()
+    
     def evaluate(self, ctx):
-        sub_ctx = ctx.with_layer({ass.var: ctx.wrap(ass.value.evaluate(ctx))
-                                  for ass in self.assignments})
-        return self.expr.evaluate(sub_ctx)
+        # Not a list comprehension: a safe point (see _safe_point) has to see
+        # the values so far
+        values = []
+        for ass in self.assignments:
+            values.append(ctx.wrap(ass.value.evaluate(ctx)))
+        return self.expr.evaluate(ctx.bind(self.var_names, values))
+    
+    def resolve(self, scope):
+        for ass in self.assignments:
+            ass.value.resolve(scope)
+        self.expr.resolve(scope.extend(self.var_names))
+    
+    def step(self, ctx, stack):
+        assignments = iter(self.assignments)
+        values = []
+        current = next(assignments)
+        def bind(value, stack):
+            nonlocal current
+            values.append(ctx.wrap(value))
+            current = next(assignments, None)
+            if current is None:
+                return self.expr, ctx.bind(self.var_names, values)
+            stack.append(bind)
+            return current.value, ctx
+        stack.append(bind)
+        return current.value, ctx
+    
+    def compile(self, scope):
+        names = tuple(ass.var for ass in self.assignments)
+        values = [ass.value.compile(scope) for ass in self.assignments]
+        body = self.expr.compile(scope.extend(names))
+        if len(values) == 1:
+            [value] = values
+            return lambda env, ctx: body(Frame(names, (ctx.wrap(value(env, ctx)),), env), ctx)
+        def let(env, ctx):
+            # Like evaluate(), no list comprehension
+            results = []
+            for value in values:
+                results.append(ctx.wrap(value(env, ctx)))
+            return body(Frame(names, tuple(results), env), ctx)
+        return let
+    
+    def specialize(self, scope, counters):
+        names = tuple(ass.var for ass in self.assignments)
+        values = tuple(ass.value.specialize(scope, counters) for ass in self.assignments)
+        body = self.expr.specialize(scope.extend(names), counters)
+        if len(values) == 1:
+            return specialize.LetOne(names, values, body)
+        return specialize.Let(names, values, body)
     
-    def free_vars(self):
-        yield from self.assignments.free_vars()
-        for v in self.expr.free_vars():
-            if v not in self.names:
-                yield v
+    def emit(self, code, scope, tail=False):
+        names = tuple(ass.var for ass in self.assignments)
+        for ass in self.assignments:
+            ass.value.emit(code, scope)
+            code.emit(vm.WRAP)
+        code.emit(vm.LET, code.constant(names), len(names))
+        self.expr.emit(code, scope.extend(names), tail)
+        code.emit(vm.END_LET)
+    
+    def analyze(self):
+        self.fvs = frozenset().union(*(ass.value.analyze() for ass in self.assignments),
+                                     self.expr.analyze() - self.names)
+        return self.fvs
     
     @lazyprop
     def names(self):
         return {a.var for a in self.assignments}
     
+    @lazyprop
+    def var_names(self):
+        # In order, for the Frame
+        return tuple(a.var for a in self.assignments)
+    
+    def subexpressions(self):
+        for ass in self.assignments:
+            yield ass.value
+        yield self.expr
+    
+    def map_subexpressions(self, fn):
+        for ass in self.assignments:
+            ass.value = fn(ass.value)
+        self.expr = fn(self.expr)
+    
+    def optimize(self, inline=True):
+        for ass in self.assignments:
+            ass.value = ass.value.optimize(inline)
+        if not inline or len(self.names) != len(self.assignments):
+            # Bindings shadowing each other, just leave those
+            self.expr = self.expr.optimize(inline)
+            return self
+        
+        expr = self.expr
+        kept = []
+        for ass in self.assignments:
+            uses = expr.count_uses(ass.var)
+            if uses == 1 and isinstance(ass.value, Constant):
+                expr = expr.substitute(ass.var, ass.value)
+            elif uses > 0 or ass.value.has_effects():
+                kept.append(ass)
+        expr = expr.optimize(inline)
+        if not kept:
+            return expr
+        if len(kept) == len(self.assignments):
+            self.expr = expr
+            return self
+        return type(self)(assignments=type(self.assignments)(kept), expr=expr)
+    
+    def has_effects(self):
+        return any(e.has_effects() for e in self.subexpressions())
+    
+    def count_uses(self, name):
+        uses = sum(ass.value.count_uses(name) for ass in self.assignments)
+        if name not in self.names:
+            uses += self.expr.count_uses(name)
+        return uses
+    
+    def substitute(self, name, node):
+        for ass in self.assignments:
+            ass.value = ass.value.substitute(name, node)
+        if name not in self.names:
+            self.expr = self.expr.substitute(name, node)
+        return self
+    
+    def check_purity(self, procs):
+        values = all([ass.value.check_purity(procs) for ass in self.assignments])
+        return self.expr.check_purity(_without(procs, self.names)) and values
+    
+    def can_vectorize(self):
+        return all(e.can_vectorize() for e in self.subexpressions())
+    
+    def vectorize(self, env, mask, np):
+        layer = {ass.var: ass.value.vectorize(env, mask, np) for ass in self.assignments}
+        return self.expr.vectorize({**env, **layer}, mask, np)
+    
 
 let_exprs = [Assignment, AssignmentList, LetExpr]
 
@@ -111,11 +537,65 @@ let_exprs = [Assignment, AssignmentList, LetExpr]
 @generates('if', Field('cond', Expression), 'then', Field('true', Expression), 'else', Field('false', Expression))
 @replaces(Expression)
 class IfExpr(BaseExpr):
+    __slots__ = ()
+    
     def evaluate(self, ctx):
         if self.cond.evaluate(ctx):
             return self.true.evaluate(ctx)
         else:
             return self.false.evaluate(ctx)
+    
+    def step(self, ctx, stack):
+        stack.append(lambda cond, stack: (self.true if cond else self.false, ctx))
+        return self.cond, ctx
+    
+    def compile(self, scope):
+        cond, true, false = self.cond.compile(scope), self.true.compile(scope), self.false.compile(scope)
+        def if_(env, ctx):
+            if cond(env, ctx):
+                return true(env, ctx)
+            else:
+                return false(env, ctx)
+        return if_
+    
+    def specialize(self, scope, counters):
+        return specialize.If(self.cond.specialize(scope, counters), self.true.specialize(scope, counters),
+                             self.false.specialize(scope, counters))
+    
+    def emit(self, code, scope, tail=False):
+        self.cond.emit(code, scope)
+        to_false = code.emit(vm.JUMP_IF_FALSE, -1)
+        self.true.emit(code, scope, tail)
+        to_end = code.emit(vm.JUMP, -1)
+        code.patch(to_false)
+        self.false.emit(code, scope, tail)
+        code.patch(to_end)
+    
+    def optimize(self, inline=True):
+        self.cond = self.cond.optimize(inline)
+        if isinstance(self.cond, Constant):
+            return (self.true if self.cond.val else self.false).optimize(inline)
+        self.true = self.true.optimize(inline)
+        self.false = self.false.optimize(inline)
+        return self
+    
+    def has_effects(self):
+        return any(e.has_effects() for e in self.subexpressions())
+    
+    def can_vectorize(self):
+        return all(e.can_vectorize() for e in self.subexpressions())
+    
+    def vectorize(self, env, mask, np):
+        cond = self.cond.vectorize(env, mask, np)
+        if np.ndim(cond) == 0:
+            # The same for every row
+            return (self.true if cond else self.false).vectorize(env, mask, np)
+        # Both branches are evaluated, but only the rows that take a branch
+        # count for its errors
+        cond = cond.astype(bool)
+        true = self.true.vectorize(env, mask & cond, np)
+        false = self.false.vectorize(env, mask & ~cond, np)
+        return np.where(cond, true, false)
 
 
 Neg = make_unary_operator('Neg', Expression, '-', operator.neg, 1300)
@@ -158,49 +638,251 @@ class DynamicProcedure:
     argname: str
     body: Expression
     
-    def call(self, arg, ctx):
+    def __post_init__(self):
+        # The names of the Frame of a call
+        self.names = (self.argname,)
+    
+    def enter(self, arg, ctx):
         # arg should already be wrapped!
-        call_ctx = ctx.with_layer({self.argname: arg})
-        return self.body.evaluate(call_ctx)
+        # Returns the body and the context to evaluate it in
+        return self.body, ctx.bind(self.names, (arg,))
+    
+    def call(self, arg, ctx):
+        global _calls_left
+        body, call_ctx = self.enter(arg, ctx)
+        _calls_left -= 1
+        if _calls_left <= 0:
+            _safe_point(call_ctx)
+        return body.evaluate(call_ctx)
 
 
 @dataclass
 class Procedure(DynamicProcedure):
-    bound: dict
+    # Like CompiledProcedure, the body runs in a single Frame: the argument
+    # followed by the values captured when the procedure was made
+    names: tuple
+    captured: list
+    
+    def __post_init__(self):
+        # names is a field here
+        pass
+    
+    def enter(self, arg, ctx):
+        return self.body, ctx.bind(self.names, (arg, *self.captured), _empty_frame)
+
+
+# Procedure calls of evaluate() and compiled code until their next safe point
+_calls_left = SAFE_POINT_INTERVAL
+
+
+def _safe_point(ctx):
+    """The safe point of evaluate() and compiled code, every SAFE_POINT_INTERVAL
+    procedure calls (like trampoline does every so many steps).
+    
+    Their state is on the Python stack, so the roots are the locals of the
+    caller's frame and of the frames it was called from. Values only on the
+    stack of a frame, like the first argument while evaluating the second,
+    aren't visible, so evaluate() and compile() put those in locals.
+    """
+    global _calls_left
+    _calls_left = SAFE_POINT_INTERVAL
+    ctx.safe_point(sys._getframe(1))
+
+
+# Compiled code can't use the Procedures above: their body is a closure
+# taking (env, ctx), and they get called with the caller's Frame.
+
+@dataclass
+class CompiledDynamicProcedure:
+    argname: str
+    code: Callable
+    
+    def run(self, arg, env, ctx):
+        global _calls_left
+        _calls_left -= 1
+        if _calls_left <= 0:
+            _safe_point(ctx)
+        return self.code(Frame((self.argname,), (arg,), env), ctx)
+
+
+@dataclass
+class CompiledProcedure:
+    # The body runs in a single Frame: the argument followed by the
+    # values captured when the procedure was made (a 'flat closure').
+    names: tuple
+    code: Callable
+    captured: list
+    
+    def run(self, arg, env, ctx):
+        global _calls_left
+        _calls_left -= 1
+        if _calls_left <= 0:
+            _safe_point(ctx)
+        return self.code(Frame(self.names, (arg, *self.captured), None), ctx)
+
+
+@dataclass(eq=False)
+class MemoizedProcedure(Procedure):
+    # A pure procedure always gives the same result for the same argument
+    memo: LRUCache
+    
+    __eq__ = object.__eq__
+    __hash__ = object.__hash__
     
     def call(self, arg, ctx):
-        # arg should already be wrapped!
-        call_ctx = ctx.clean_env().with_layer(self.bound).with_layer({self.argname: arg})
-        return self.body.evaluate(call_ctx)
+        # 1 == True, but they're different arguments
+        key = (self, type(arg), arg)
+        try:
+            result = self.memo.get(key, _missing)
+        except TypeError:  # unhashable argument
+            return super().call(arg, ctx)
+        if result is _missing:
+            result = super().call(arg, ctx)
+            self.memo.put(key, result)
+        return result
+
+_missing = object()
+
+
+def emit_procedure(code, scope, arg, body):
+    """Emit the body of a procedure made in `scope` out of line, returns its entry point."""
+    skip = code.emit(vm.JUMP, -1)
+    entry = code.position
+    body.emit(code, Scope((arg,), scope), tail=True)
+    code.emit(vm.RETURN)
+    code.patch(skip)
+    return entry
 
 
 @generates('proc', '(', Field('arg', RawIdentifier), ')', Field('body', Expression))
 @replaces(Expression)
 class DynProcExpr(BaseExpr):
+    __slots__ = ()
+    # Set by resolve() for lexically scoped procedures: the names of the Frame
+    # of a call, and the functions that get the captured values (see Scope)
+    _instance_attrs = ('frame_names', 'captures')
+    captures = None
+    dynamic = True
+    
     def evaluate(self, ctx):
         return DynamicProcedure(self.arg, self.body)
+    
+    def resolve(self, scope):
+        self.body.resolve(Scope((self.arg,), dynamic=True))
+    
+    def compile(self, scope):
+        arg, body = self.arg, self.body.compile(Scope((self.arg,), dynamic=True))
+        return lambda env, ctx: CompiledDynamicProcedure(arg, body)
+    
+    def specialize(self, scope, counters):
+        body = self.body.specialize(Scope((self.arg,), dynamic=True), counters)
+        return specialize.MakeDynamicProcedure(self.arg, body)
         
-    def free_vars(self):
-        for v in self.body.free_vars():
-            if v != self.arg:
-                yield v
+    def analyze(self):
+        self.fvs = self.body.analyze() - {self.arg}
+        return self.fvs
+    
+    def emit(self, code, scope, tail=False):
+        raise Exception("The bytecode compiler doesn't support dynamic scoping")
+    
+    def check_purity(self, procs):
+        return False
+    
+    def has_effects(self):
+        # Only makes the procedure, the body doesn't run yet
+        return False
+    
+    def count_uses(self, name):
+        return 0 if name == self.arg else self.body.count_uses(name)
+    
+    def substitute(self, name, node):
+        if name != self.arg:
+            self.body = self.body.substitute(name, node)
+        return self
 
 
 class ProcExpr(DynProcExpr):
+    __slots__ = ()
+    dynamic = False
+    
     def evaluate(self, ctx):
-        bound = {v: ctx.env[v] for v in self.free_vars()}
-        return Procedure(self.arg, self.body, bound)
+        if self.captures is None:
+            # Not resolved (see Program.evaluate), capture by name
+            self.resolve(Scope(dynamic=True))
+        env = ctx.env
+        return Procedure(self.arg, self.body, self.frame_names, [f(env) for f in self.captures])
+    
+    def resolve(self, scope):
+        free = sorted(self.free_vars())
+        captures = [scope.fetcher(v) for v in free]
+        self.frame_names = (self.arg, *free)
+        self.body.resolve(Scope(self.frame_names))
+        self.captures = captures
+    
+    def compile(self, scope):
+        free = sorted(self.free_vars())
+        fetchers = [scope.fetcher(v) for v in free]
+        names = (self.arg, *free)
+        body = self.body.compile(Scope(names))
+        return lambda env, ctx: CompiledProcedure(names, body, [f(env) for f in fetchers])
+    
+    def specialize(self, scope, counters):
+        free = sorted(self.free_vars())
+        names = (self.arg, *free)
+        body = self.body.specialize(Scope(names), counters)
+        return specialize.MakeProcedure(names, body, [scope.fetcher(v) for v in free])
+    
+    def emit(self, code, scope, tail=False):
+        entry = emit_procedure(code, scope, self.arg, self.body)
+        code.emit(vm.MAKE_PROC, entry, code.constant((self.arg,)))
+    
+    def check_purity(self, procs):
+        # Making the procedure is pure, but letrecs in its body need marking
+        self.body.check_purity(_without(procs, {self.arg}))
+        return True
 
 
 # This grammar fits the rest better than (f a)
 @generates(Field('proc', Expression), '(', Field('arg', Expression), ')', priority=2000)
 @replaces(Expression)
 class CallExpr(BaseExpr):
+    __slots__ = ()
+    
     def evaluate(self, ctx):
         proc = self.proc.evaluate(ctx)
         arg = self.arg.evaluate(ctx)
         return proc.call(ctx.wrap(arg), ctx)
     
+    def step(self, ctx, stack):
+        def got_proc(proc, stack):
+            stack.append(lambda arg, stack: proc.enter(ctx.wrap(arg), ctx))
+            return self.arg, ctx
+        stack.append(got_proc)
+        return self.proc, ctx
+    
+    def compile(self, scope):
+        proc, arg = self.proc.compile(scope), self.arg.compile(scope)
+        def call(env, ctx):
+            # In a local, where a safe point sees it (see _safe_point)
+            p = proc(env, ctx)
+            return p.run(ctx.wrap(arg(env, ctx)), env, ctx)
+        return call
+    
+    def specialize(self, scope, counters):
+        return specialize.CallNode(self.proc.specialize(scope, counters), self.arg.specialize(scope, counters),
+                                   True, counters)
+    
+    def emit(self, code, scope, tail=False):
+        self.proc.emit(code, scope)
+        self.arg.emit(code, scope)
+        code.emit(vm.WRAP)
+        code.emit(vm.TAIL_CALL if tail else vm.CALL)
+    
+    def check_purity(self, procs):
+        proc = self.proc.check_purity(procs)
+        arg = self.arg.check_purity(procs)
+        return proc and arg and isinstance(self.proc, Identifier) and self.proc.name in procs
+    
 
 PROC = LET.add_types(ProcExpr, CallExpr)
 DYNPROC = LET.add_types(DynProcExpr, CallExpr)
@@ -213,35 +895,171 @@ DYNPROC = LET.add_types(DynProcExpr, CallExpr)
 
 @generates(Field('pname', RawIdentifier), '(', Field('arg', RawIdentifier), ')', '=', Field('body', Expression))
 class LetRecDecl:
-    def get_proc(self, ctx, pnames):
-        not_free = set(pnames)
-        not_free.add(self.arg)
-        bound = {v: ctx.env[v] for v in self.body.free_vars() if v not in not_free}
-        return Procedure(self.arg, self.body, bound)
+    __slots__ = ()
+    _instance_attrs = ('captured', 'pure', 'frame_names', 'captures')
+    # What the procedure captures from outside the letrec, set by LetRecExpr.analyze
+    captured = None
+    # Set by LetRecExpr.check_purity
+    pure = False
+    # Like ProcExpr, set by resolve()
+    captures = None
+    
+    def get_proc(self, ctx):
+        """The procedure, without its captured values: those come from the Frame
+        of the letrec, which needs the procedure first (see LetRecExpr.extend)."""
+        if self.pure and ctx.memo is not None:
+            return MemoizedProcedure(self.arg, self.body, self.frame_names, None, ctx.memo)
+        return Procedure(self.arg, self.body, self.frame_names, None)
+    
+    def resolve(self, scope):
+        """Like compile(), `scope` is the one of the letrec."""
+        free = sorted(self.body.free_vars() - {self.arg})
+        captures = [scope.fetcher(v) for v in free]
+        self.frame_names = (self.arg, *free)
+        self.body.resolve(Scope(self.frame_names))
+        self.captures = captures
+    
+    def compile(self, scope):
+        """Returns what's needed to make the procedure: the names and code of its
+        Frame, and the functions that fill in its captured values once the
+        Frame of the letrec (`scope`) is complete."""
+        free = sorted(self.body.free_vars() - {self.arg})
+        names = (self.arg, *free)
+        return names, self.body.compile(Scope(names)), [scope.fetcher(v) for v in free]
+    
+    def specialize(self, scope, counters):
+        """Like compile(), with a node as the body."""
+        free = sorted(self.body.free_vars() - {self.arg})
+        names = (self.arg, *free)
+        return names, self.body.specialize(Scope(names), counters), [scope.fetcher(v) for v in free]
 
 
 @make_list(LetRecDecl, ';')
 class LetRecDeclList(list):
-    pass
+    __slots__ = ()
 
 
 @generates('letrec', Field('decls', LetRecDeclList), 'in', Field('expr', Expression))
 @replaces(Expression)
 class LetRecExpr(BaseExpr):
+    __slots__ = ()
+    
+    def extend(self, ctx):
+        # The context with the (mutually recursive) procedures bound, which
+        # capture their values out of its Frame, like compile() does
+        if self.decls[-1].captures is None:
+            # Not resolved (see Program.evaluate), capture by name
+            self.resolve(Scope(dynamic=True))
+        procs = [decl.get_proc(ctx) for decl in self.decls]
+        ctx = ctx.bind(self.pnames, [ctx.wrap(p) for p in procs])
+        env = ctx.env
+        for decl, p in zip(self.decls, procs):
+            p.captured = [f(env) for f in decl.captures]
+        return ctx
+    
     def evaluate(self, ctx):
-        names = [decl.pname for decl in self.decls]
-        procs = {decl.pname: decl.get_proc(ctx, names) for decl in self.decls}
-        wrapped_procs = {k: ctx.wrap(v) for k, v in procs.items()}
-        for p in procs.values():
-            p.bound.update(wrapped_procs)
-        
-        sub_ctx = ctx.with_layer(wrapped_procs)
-        return self.expr.evaluate(sub_ctx)
+        return self.expr.evaluate(self.extend(ctx))
+    
+    def resolve(self, scope):
+        inner = scope.extend(self.pnames)
+        for decl in self.decls:
+            decl.resolve(inner)
+        self.expr.resolve(inner)
+    
+    @lazyprop
+    def pnames(self):
+        # In order, for the Frame
+        return tuple(decl.pname for decl in self.decls)
+    
+    def step(self, ctx, stack):
+        return self.expr, self.extend(ctx)
+    
+    def compile(self, scope):
+        names = tuple(decl.pname for decl in self.decls)
+        inner = scope.extend(names)
+        decls = [decl.compile(inner) for decl in self.decls]
+        body = self.expr.compile(inner)
+        def letrec(env, ctx):
+            procs = [(CompiledProcedure(names, code, None), fetchers) for names, code, fetchers in decls]
+            frame = Frame(names, [ctx.wrap(p) for p, _ in procs], env)
+            for p, fetchers in procs:
+                p.captured = [f(frame) for f in fetchers]
+            return body(frame, ctx)
+        return letrec
+    
+    def specialize(self, scope, counters):
+        names = tuple(decl.pname for decl in self.decls)
+        inner = scope.extend(names)
+        decls = tuple(decl.specialize(inner, counters) for decl in self.decls)
+        return specialize.LetRec(names, decls, self.expr.specialize(inner, counters))
+    
+    def emit(self, code, scope, tail=False):
+        # The procedures are made in the Frame that binds them
+        names = tuple(decl.pname for decl in self.decls)
+        inner = scope.extend(names)
+        code.emit(vm.LETREC, code.constant(names), len(names))
+        for i, decl in enumerate(self.decls):
+            entry = emit_procedure(code, inner, decl.arg, decl.body)
+            code.emit(vm.MAKE_PROC, entry, code.constant((decl.arg,)))
+            code.emit(vm.WRAP)
+            code.emit(vm.STORE0, i)
+        self.expr.emit(code, inner, tail)
+        code.emit(vm.END_LET)
         
-    def free_vars(self):
-        for v in self.expr.free_vars():
-            if v != self.pname:
-                yield v
+    def analyze(self):
+        names = {decl.pname for decl in self.decls}
+        fvs = self.expr.analyze() - names
+        for decl in self.decls:
+            proc_fvs = decl.body.analyze() - {decl.arg}
+            decl.captured = proc_fvs - names
+            fvs |= decl.captured
+        self.fvs = frozenset(fvs)
+        return self.fvs
+    
+    def subexpressions(self):
+        for decl in self.decls:
+            yield decl.body
+        yield self.expr
+    
+    def map_subexpressions(self, fn):
+        for decl in self.decls:
+            decl.body = fn(decl.body)
+        self.expr = fn(self.expr)
+    
+    def has_effects(self):
+        return self.expr.has_effects()
+    
+    def count_uses(self, name):
+        if any(decl.pname == name for decl in self.decls):
+            return 0
+        return (sum(decl.body.count_uses(name) for decl in self.decls if decl.arg != name)
+                + self.expr.count_uses(name))
+    
+    def check_purity(self, procs):
+        names = {decl.pname for decl in self.decls}
+        outer = procs - names
+        # Assume all are pure (they may call each other), then drop the ones
+        # that turn out not to be until nothing changes
+        pure = names
+        while True:
+            inner = outer | pure
+            now = {decl.pname for decl in self.decls
+                   if decl.body.check_purity(_without(inner, {decl.arg}))}
+            if now == pure:
+                break
+            pure = now
+        for decl in self.decls:
+            decl.pure = decl.pname in pure
+        return self.expr.check_purity(outer | pure)
+    
+    def substitute(self, name, node):
+        if any(decl.pname == name for decl in self.decls):
+            return self
+        for decl in self.decls:
+            if decl.arg != name:
+                decl.body = decl.body.substitute(name, node)
+        self.expr = self.expr.substitute(name, node)
+        return self
 
 
 LETREC = PROC.add_types(LetRecExpr, LetRecDeclList, LetRecDecl)
@@ -251,15 +1069,32 @@ LETREC = PROC.add_types(LetRecExpr, LetRecDeclList, LetRecDecl)
 # Tests
 # ===============================================
 
+import sys
 import unittest
 
-class TestLet(unittest.TestCase):
+
+class LanguageTest(unittest.TestCase):
+    def run_program(self, lang, s):
+        return lang.parse(s).evaluate()
+
+
+class CompiledMixin:
+    def run_program(self, lang, s):
+        return lang.compile(s)()
+
+
+class StackSafeMixin:
+    def run_program(self, lang, s):
+        return lang.parse(s).evaluate(stack_safe=True)
+
+
+class TestLet(LanguageTest):
     def test_math(self):
-        res = LET.parse("50 + 3 * 2").evaluate()
+        res = self.run_program(LET, "50 + 3 * 2")
         self.assertEqual(res, 56)
     
     def test_let(self):
-        res = LET.parse("let x = 5 in x + 9").evaluate()
+        res = self.run_program(LET, "let x = 5 in x + 9")
         self.assertEqual(res, 14)
     
     def test_complex(self):
@@ -271,18 +1106,18 @@ class TestLet(unittest.TestCase):
         else
             "something is wrong"
         """
-        res = LET.parse(s).evaluate()
+        res = self.run_program(LET, s)
         self.assertEqual(res, "as it should be")
 
 
-class TestProc(unittest.TestCase):
+class TestProc(LanguageTest):
     def test_simple(self):
         s = """
         let a = 5 in
         let f = proc (b) a+b in
         f(3)
         """
-        res = PROC.parse(s).evaluate()
+        res = self.run_program(PROC, s)
         self.assertEqual(res, 8)
     
     def test_complex(self):
@@ -292,7 +1127,7 @@ class TestProc(unittest.TestCase):
            mult_two = proc(x) x*2 in
         chain(add_one)(mult_two)(5)
         """
-        res = PROC.parse(s).evaluate()
+        res = self.run_program(PROC, s)
         self.assertEqual(res, 12)
     
     def test_exam_static(self):
@@ -301,7 +1136,7 @@ class TestProc(unittest.TestCase):
             let f = proc(y) if y == 0 then 0 else f(y-1) in
                 f(2)
         """
-        res = PROC.parse(s).evaluate()
+        res = self.run_program(PROC, s)
         self.assertEqual(res, 1)
     
     def test_exam_dynamic(self):
@@ -310,11 +1145,11 @@ class TestProc(unittest.TestCase):
             let f = proc(y) if y == 0 then 0 else f(y-1) in
                 f(2)
         """
-        res = DYNPROC.parse(s).evaluate()
+        res = self.run_program(DYNPROC, s)
         self.assertEqual(res, 0)
 
 
-class TestLetRec(unittest.TestCase):
+class TestLetRec(LanguageTest):
     def test_fib(self):
         s = """
         letrec fib(i) = 
@@ -323,7 +1158,7 @@ class TestLetRec(unittest.TestCase):
             fib(i-1) + fib(i-2)
         in fib(10)
         """
-        res = LETREC.parse(s).evaluate()
+        res = self.run_program(LETREC, s)
         self.assertEqual(res, 55)
     
     def test_mutual(self):
@@ -332,8 +1167,439 @@ class TestLetRec(unittest.TestCase):
                odd(i) =  if i == 0 then false else if i == 0 then true else even(i-1)
         in even(7)
         """
-        res = LETREC.parse(s).evaluate()
+        res = self.run_program(LETREC, s)
         self.assertEqual(res, False)
+    
+    def test_nested(self):
+        s = "let f = proc(x) letrec g(y) = if y == 0 then x else g(y-1) in g(3) in f(7)"
+        res = self.run_program(LETREC, s)
+        self.assertEqual(res, 7)
+
+
+class VMMixin:
+    def run_program(self, lang, s):
+        if lang is DYNPROC:
+            self.skipTest("no dynamic scoping in the bytecode compiler")
+        return lang.parse(s).assemble().run()
+
+
+class OptimizedMixin:
+    def run_program(self, lang, s):
+        return lang.parse(s, optimize=True).evaluate()
+
+
+class PrattMixin:
+    def run_program(self, lang, s):
+        from eopl.pratt import Fallback
+        try:
+            prog = lang.pratt_parser.parse(s)
+        except Fallback:
+            self.fail(f"Pratt parser fell back on {s!r}")
+        # The same classes too, which == doesn't check for lists
+        self.assertEqual(lang.dumps(prog), lang.dumps(lang.parse(s)))
+        return prog.evaluate()
+
+
+class SerializedMixin:
+    def run_program(self, lang, s):
+        prog = lang.parse(s)
+        loaded = lang.loads(lang.dumps(prog))
+        self.assertEqual(loaded, prog)
+        return loaded.evaluate()
+
+
+class SpecializedMixin:
+    def run_program(self, lang, s):
+        run = lang.parse(s).specialize()
+        result = run()
+        # Again, with the nodes specialized by the first run
+        self.assertEqual(run(), result)
+        return result
+
+
+class TestLetCompiled(CompiledMixin, TestLet): pass
+class TestProcCompiled(CompiledMixin, TestProc): pass
+class TestLetRecCompiled(CompiledMixin, TestLetRec): pass
+class TestLetStackSafe(StackSafeMixin, TestLet): pass
+class TestProcStackSafe(StackSafeMixin, TestProc): pass
+class TestLetRecStackSafe(StackSafeMixin, TestLetRec): pass
+class TestLetVM(VMMixin, TestLet): pass
+class TestProcVM(VMMixin, TestProc): pass
+class TestLetRecVM(VMMixin, TestLetRec): pass
+class TestLetOptimized(OptimizedMixin, TestLet): pass
+class TestProcOptimized(OptimizedMixin, TestProc): pass
+class TestLetRecOptimized(OptimizedMixin, TestLetRec): pass
+class TestLetSerialized(SerializedMixin, TestLet): pass
+class TestProcSerialized(SerializedMixin, TestProc): pass
+class TestLetRecSerialized(SerializedMixin, TestLetRec): pass
+class TestLetPratt(PrattMixin, TestLet): pass
+class TestProcPratt(PrattMixin, TestProc): pass
+class TestLetRecPratt(PrattMixin, TestLetRec): pass
+class TestLetSpecialized(SpecializedMixin, TestLet): pass
+class TestProcSpecialized(SpecializedMixin, TestProc): pass
+class TestLetRecSpecialized(SpecializedMixin, TestLetRec): pass
+
+
+class TestStackSafe(unittest.TestCase):
+    def test_tail_calls(self):
+        s = "letrec loop(i) = if i == 0 then 0 else let j = i - 1 in loop(j) in loop(20000)"
+        self.assertEqual(LETREC.parse(s).evaluate(stack_safe=True), 0)
+    
+    def test_fuel(self):
+        s = "letrec loop(i) = if i == 0 then 0 else loop(i - 1) in loop(1000)"
+        self.assertEqual(LETREC.parse(s).evaluate(fuel=100000), 0)
+        with self.assertRaises(OutOfFuel):
+            LETREC.parse(s).evaluate(fuel=1000)
+        with self.assertRaises(OutOfFuel):
+            LETREC.parse("letrec loop(i) = loop(i) in loop(0)").evaluate(fuel=10000)
+    
+    def test_deep_recursion(self):
+        s = "letrec sum(i) = if i == 0 then 0 else i + sum(i - 1) in sum(10000)"
+        self.assertEqual(LETREC.parse(s).evaluate(stack_safe=True), 10000 * 10001 // 2)
+
+
+class TestFreeVars(unittest.TestCase):
+    def test_let(self):
+        prog = LET.parse("let x = y; z = 1 in x + z + w")
+        self.assertEqual(prog.expr.fvs, {'y', 'w'})
+    
+    def test_proc(self):
+        prog = PROC.parse("let a = 1 in proc (x) x + a")
+        self.assertEqual(prog.expr.expr.fvs, {'a'})
+    
+    def test_letrec(self):
+        prog = LETREC.parse("letrec f(x) = g(x + a); g(y) = f(y) in f(b)")
+        self.assertEqual(prog.expr.fvs, {'a', 'b'})
+        self.assertEqual([d.captured for d in prog.expr.decls], [{'a'}, set()])
+
+
+class TestOptimize(unittest.TestCase):
+    def test_fold(self):
+        prog = LET.parse("(1 + 2) * 3 == 9", optimize=True)
+        self.assertEqual(prog.expr, Constant(val=True))
+    
+    def test_dead_branch(self):
+        prog = LET.parse("if 1 < 2 then x else y", optimize=True)
+        self.assertEqual(prog.expr, Identifier(name='x'))
+    
+    def test_inline(self):
+        prog = LET.parse("let x = 2; y = 3; z = 4 in let w = x * y in w + z + z", optimize=True)
+        self.assertIsInstance(prog.expr, LetExpr)
+        self.assertEqual([ass.var for ass in prog.expr.assignments], ['z'])
+        self.assertEqual(prog.expr.expr.a.a, Constant(val=6))
+        self.assertEqual(prog.evaluate(), 14)
+    
+    def test_shadowing(self):
+        s = "let x = 1 in let f = proc (x) x + 1 in let x = 5 in f(x)"
+        prog = PROC.parse(s, optimize=True)
+        self.assertEqual([ass.var for ass in prog.expr.assignments], ['f'])
+        self.assertEqual(prog.expr.expr.arg, Constant(val=5))
+        self.assertEqual(prog.evaluate(), 6)
+        self.assertEqual(PROC.compile(s, optimize=True)(), 6)
+    
+    def test_errors_stay(self):
+        with self.assertRaises(ZeroDivisionError):
+            LET.parse("let x = 1 / 0 in 5", optimize=True).evaluate()
+    
+    def test_dynamic(self):
+        s = "let f = proc (y) x in let x = 1 in f(0)"
+        self.assertEqual(DYNPROC.parse(s, optimize=True).evaluate(), 1)
+
+
+class TestMemoize(unittest.TestCase):
+    fib = """
+    letrec fib(i) = if i < 2 then i else fib(i - 1) + fib(i - 2)
+    in fib(80)
+    """
+    
+    def test_fib(self):
+        memo = LRUCache(1000)
+        self.assertEqual(LETREC.parse(self.fib).evaluate(memo=memo), 23416728348467685)
+        self.assertEqual(memo.misses, 81)
+        self.assertEqual(memo.hits, 78)
+    
+    def test_bounded(self):
+        memo = LRUCache(10)
+        s = "letrec sum(i) = if i == 0 then 0 else i + sum(i - 1) in sum(100) + sum(100)"
+        self.assertEqual(LETREC.parse(s).evaluate(memo=memo), 2 * 5050)
+        self.assertEqual(len(memo), 10)
+        self.assertEqual(memo.evictions, 91)
+        self.assertEqual(memo.hits, 1)
+    
+    def test_equal_arguments(self):
+        # 1 == True, but id(true) isn't id(1)
+        prog = LETREC.parse("letrec id(x) = x in let a = id(1) in id(true)")
+        self.assertIs(prog.evaluate(memo=LRUCache()), True)
+    
+    def test_purity(self):
+        s = """
+        let apply = proc (f) f(1) in
+        letrec pure(i) = if i == 0 then 0 else other(i - 1);
+               other(i) = pure(i) + 1;
+               impure(i) = apply(proc (x) i)
+        in pure(1)
+        """
+        prog = LETREC.parse(s)
+        # Only checked once it's needed
+        self.assertEqual([d.pure for d in prog.expr.expr.decls], [False] * 3)
+        self.assertEqual(prog.evaluate(memo=LRUCache()), 1)
+        self.assertEqual([d.pure for d in prog.expr.expr.decls], [True, True, False])
+
+
+class TestParseCache(unittest.TestCase):
+    def setUp(self):
+        self.lang = LETREC.add_types()
+    
+    def test_hits(self):
+        cache = self.lang.enable_parse_cache(maxsize=2)
+        s = "letrec f(x) = if x == 0 then 0 else x + f(x - 1) in let y = 3 in f(y)"
+        prog = self.lang.parse(s)
+        self.assertIs(self.lang.parse(s), prog)
+        self.assertIsNot(self.lang.parse(s, optimize=True), prog)
+        # Shared trees stay the same when they're run
+        results = [prog.evaluate(), prog.compile()(), prog.assemble().run(), prog.evaluate()]
+        self.assertEqual(results, [6] * 4)
+        self.assertIs(self.lang.parse(s), prog)
+        self.lang.parse("1")
+        self.assertEqual((cache.hits, cache.misses, cache.evictions), (2, 3, 1))
+    
+    def test_normalize(self):
+        cache = self.lang.enable_parse_cache(normalize=True)
+        prog = self.lang.parse("let x = 1 in x")
+        self.assertIs(self.lang.parse("let  x = 1 % one\n in\tx "), prog)
+        self.assertIsNot(self.lang.parse('let x = " 1" in x'), self.lang.parse('let x = "1" in x'))
+        self.assertEqual(cache.hits, 1)
+    
+    def test_bytes(self):
+        cache = self.lang.enable_parse_cache(maxsize=None, maxbytes=50000)
+        for i in range(100):
+            self.lang.parse(f"let x = {i} in x + x * 2")
+        self.assertLessEqual(cache.bytes, 50000)
+        self.assertGreater(len(cache), 5)
+        self.assertEqual(cache.evictions, 100 - len(cache))
+
+
+class TestLists(unittest.TestCase):
+    def test_empty(self):
+        @make_list(Identifier, ',', empty=True)
+        class NameList(list):
+            __slots__ = ()
+        
+        @generates('[', Field('names', NameList), ']')
+        class Names(Start):
+            __slots__ = ()
+        
+        lang = Language(Names, NameList, Expression, Identifier)
+        self.assertEqual(lang.parse("[]").names, [])
+        self.assertIsInstance(lang.parse("[]").names, NameList)
+        self.assertEqual([i.name for i in lang.parse("[a, b, c]").names], ['a', 'b', 'c'])
+        # The empty list doesn't allow stray dividers
+        for s in ["[a,]", "[, a]", "[,]"]:
+            with self.assertRaisesRegex(Exception, "syntax error"):
+                lang.parse(s)
+
+
+class TestNodeLayout(unittest.TestCase):
+    def test_slots(self):
+        prog = LETREC.parse("letrec f(x) = if x == 0 then 1 else x * f(x - 1) in let y = 2 in f(y)")
+        for node in [prog, *prog.expr.walk(), *prog.expr.decls]:
+            self.assertFalse(hasattr(node, '__dict__'), type(node).__name__)
+        # lazyprop and the attributes set by analyze() and compile() have slots
+        let = prog.expr.expr
+        self.assertEqual(let.names, {'y'})
+        self.assertEqual(prog.expr.decls[0].captured, frozenset())
+        self.assertEqual(prog.compile()(), 2)
+        self.assertEqual(let.expr.arg.address, (0, 0))
+        # but they don't count for equality
+        self.assertEqual(prog, LETREC.parse("letrec f(x) = if x == 0 then 1 else x * f(x - 1) in let y = 2 in f(y)"))
+
+    def test_shared_constants(self):
+        a = LET.parse("let x = 1 in if true then x + 1 else 2000").expr
+        b = LET.parse("1 + 2000").expr
+        self.assertIs(a.assignments[0].value, a.expr.true.b)
+        self.assertIs(a.expr.true.b, b.a)
+        self.assertIsNot(a.expr.false, b.b)
+        self.assertIsNot(LET.parse("1").expr, LET.parse("true").expr)
+        self.assertEqual(LET.parse("1 + 1").evaluate(), 2)
+
+    def test_interned(self):
+        s = "let " + "ab" * 3 + " = 1 in 2"
+        [assignment] = LET.parse(s).expr.assignments
+        self.assertIs(assignment.var, sys.intern("ab" * 3))
+
+
+class TestPratt(unittest.TestCase):
+    def setUp(self):
+        self.lang = LETREC.add_types(backend='pratt')
+    
+    def check(self, s):
+        prog = self.lang.pratt_parser.parse(s)
+        self.assertEqual(self.lang.dumps(prog), self.lang.dumps(LETREC.parse(s)))
+        return prog
+    
+    def test_precedence(self):
+        self.check("1 - 2 - 3 * 4 / 5 mod 6 + -7")
+        self.check("not a and b or c == d < e")
+        self.check("- f(1)(2) * -(3)")
+        self.check("let x = 1 in x + if a then b else c + d")
+        self.check("letrec f(x) = x; g(y) = proc (z) z + y in f(g)(1) - 2")
+    
+    def test_layout(self):
+        self.check("1 % comment\n  +\t2\n% another\n")
+        self.check('let s = "two words" in s')
+    
+    def test_keywords_as_names(self):
+        # parglare only expects a name there, so these are names
+        self.check("let in = 1; true = 2 in in")
+        self.check("proc (let) 1")
+    
+    def test_strings(self):
+        # A string ends at the first quote, not the last one on the line
+        prog = self.check('let x = "a" in "b"')
+        self.assertEqual(prog.expr.expr, Constant("b"))
+        self.check('"a" + "b"')
+    
+    def test_tokenize(self):
+        parser = self.lang.pratt_parser
+        kinds, texts, ambiguous = parser.tokenize("let x = 10 in x mod 3 % the end\n")
+        self.assertEqual(texts, ['let', 'x', '=', '10', 'in', 'x', 'mod', '3', ''])
+        ids = parser.kind_ids
+        self.assertEqual(list(kinds), [ids['let'], ids[RawIdentifier], ids['='], ids[Number],
+                                       ids['in'], ids[RawIdentifier], ids['mod'], ids[Number], 0])
+        self.assertEqual(ambiguous, {})
+        # `letx` is `let x` to parglare, so its position is marked
+        kinds, texts, ambiguous = parser.tokenize("letx <= y")
+        self.assertEqual(texts, ['letx', '<=', 'y', ''])
+        self.assertEqual(ambiguous, {0: frozenset([ids['let']])})
+    
+    def test_fallback(self):
+        from eopl.pratt import Fallback
+        parser = self.lang.pratt_parser
+        # parglare scans `notx` as `not x` where an expression starts
+        for s in ["notx", "let x = 1 in trueish", "1 +", ""]:
+            with self.assertRaises(Fallback):
+                parser.parse(s)
+        self.assertEqual(parser.fallbacks, 4)
+        self.assertEqual(self.lang.parse("notx"), LETREC.parse("notx"))
+        with self.assertRaisesRegex(Exception, "unexpected end of file"):
+            self.lang.parse("1 +")
+    
+    def test_backend(self):
+        self.assertEqual(self.lang.add_types().backend, 'pratt')
+        self.assertEqual(LETREC.backend, 'parglare')
+        with self.assertRaisesRegex(Exception, "Unknown parser backend"):
+            LETREC.add_types(backend='yacc')
+    
+    def test_unsupported(self):
+        # Two prefix productions that start the same way need LR
+        @generates('let', Field('name', RawIdentifier), 'in', Field('expr', Expression))
+        @replaces(Expression)
+        class OtherLet(BaseExpr):
+            pass
+        lang = LET.add_types(OtherLet, backend='pratt')
+        self.assertIsNone(lang.pratt_parser)
+
+
+class TestSpecialize(unittest.TestCase):
+    def test_int_operators(self):
+        run = LETREC.parse("letrec f(x) = if x < 1 then 0 else x + f(x - 1) in -f(10)").specialize()
+        self.assertEqual(run(), -55)
+        # <, +, - and the call in f, the negation and the call of f
+        self.assertEqual(run.counters.specialized, 6)
+        self.assertEqual(run.counters.deoptimized, 0)
+    
+    def test_deoptimize(self):
+        run = PROC.parse('let f = proc (x) x + x in let a = f(1) in f("a")').specialize()
+        self.assertEqual(run(), "aa")
+        self.assertEqual(run.counters.deoptimized, 1)
+        # Stays generic after that
+        self.assertEqual(run(), "aa")
+        self.assertEqual(run.counters.deoptimized, 1)
+        # Booleans don't count as ints
+        run = LET.parse("(1 == 1) + 1").specialize()
+        self.assertEqual(run(), 2)
+        self.assertEqual(run.counters.specialized, 1)
+    
+    def test_inline_cache(self):
+        s = """let apply = proc (p) p(1); f = proc (x) x; g = proc (y) y * 2 in
+               let a = apply(f) in a + apply(f)"""
+        run = PROC.parse(s).specialize()
+        self.assertEqual(run(), 2)
+        self.assertEqual(run.counters.deoptimized, 0)
+        # p(1) calls two different bodies
+        run = PROC.parse(s.replace("apply(f)", "apply(g)", 1)).specialize()
+        self.assertEqual(run(), 3)
+        self.assertEqual(run.counters.deoptimized, 1)
+        # Closures made by the same ProcExpr share the body
+        run = PROC.parse("""let add = proc (a) proc (b) a + b in
+                            let call = proc (f) f(1) in call(add(1)) + call(add(2))""").specialize()
+        self.assertEqual(run(), 5)
+        self.assertEqual(run.counters.deoptimized, 0)
+    
+    def test_program_unchanged(self):
+        prog = LETREC.parse("let x = 1 in x + 2")
+        before = LETREC.dumps(prog)
+        run = prog.specialize()
+        self.assertEqual(run(), 3)
+        self.assertEqual(LETREC.dumps(prog), before)
+        self.assertEqual(prog.compile()(), 3)
+
+
+class TestLexicalAddressing(unittest.TestCase):
+    def test_addresses(self):
+        prog = LET.parse("let x = 1; y = 2 in let z = 3 in x + z")
+        prog.compile()
+        add = prog.expr.expr.expr
+        self.assertEqual(add.a.address, (1, 0))
+        self.assertEqual(add.b.address, (0, 0))
+    
+    def test_unbound(self):
+        with self.assertRaisesRegex(Exception, "Unbound variable y"):
+            LET.compile("let x = 1 in if true then x else y")
+        with self.assertRaisesRegex(Exception, "Unbound variable g"):
+            PROC.compile("let f = proc (x) g(x) in 5")
+    
+    def test_shadowing(self):
+        s = "let x = 1; x = 2 in let y = x in let x = 3 in y * x"
+        self.assertEqual(LET.compile(s)(), LET.parse(s).evaluate())
+    
+    def test_dynamic(self):
+        s = "let f = proc (y) y + z in let z = 5 in f(1)"
+        self.assertEqual(DYNPROC.compile(s)(), 6)
+    
+    def test_evaluate(self):
+        prog = PROC.parse("let x = 1; y = 2 in let f = proc (a) a + y in f(x)")
+        self.assertEqual(prog.evaluate(), 3)
+        let = prog.expr.expr
+        self.assertEqual(let.expr.arg.address, (1, 0))
+        # Procedures are flat closures, like in compiled code
+        proc = let.assignments[0].value
+        self.assertEqual(proc.frame_names, ('a', 'y'))
+        self.assertEqual(proc.body.b.address, (0, 1))
+        # The VM's Frames are laid out differently, that doesn't change them
+        prog.assemble()
+        self.assertEqual(proc.body.b.address, (0, 1))
+        self.assertEqual(prog.evaluate(), 3)
+    
+    def test_unbound_evaluate(self):
+        # Even in a branch that isn't taken
+        for stack_safe in [False, True]:
+            with self.assertRaisesRegex(Exception, "Unbound variable y"):
+                LET.parse("let x = 1 in if true then x else y").evaluate(stack_safe=stack_safe)
+            with self.assertRaisesRegex(Exception, "Unbound variable g"):
+                PROC.parse("let f = proc (x) g(x) in 5").evaluate(stack_safe=stack_safe)
+    
+    def test_dynamic_evaluate(self):
+        s = "let f = proc (y) y + z in let z = 5 in f(1)"
+        self.assertEqual(DYNPROC.parse(s).evaluate(), 6)
+    
+    def test_unresolved(self):
+        # Variables from outside the program, like eopl.batch does it
+        prog = LETREC.parse("letrec f(n) = if n == 0 then k else f(n - 1) in let g = proc (a) a * k in g(f(3))")
+        ctx = prog.context()
+        self.assertEqual(prog.expr.evaluate(ctx.with_layer({'k': 4})), 16)
+        with self.assertRaisesRegex(Exception, "Unbound variable k"):
+            prog.evaluate()
 
 
 if __name__ == '__main__':
@@ -1,4 +1,7 @@
 
+import re
+import sys
+import threading
 from collections import defaultdict
 from dataclasses import dataclass, field, make_dataclass, MISSING
 from typing import Callable, Any
@@ -9,7 +12,8 @@ from parglare.grammar import Production, ProductionRHS, Terminal, NonTerminal, G
     ASSOC_NONE, ASSOC_LEFT, ASSOC_RIGHT, \
     LAYOUT, LAYOUT_ITEM, WS, EMPTY
 
-from eopl.util import multimap
+from eopl.util import multimap, lazyprop, LRUCache, deep_sizeof
+from eopl import cache, serialize
 
 __all__ = ('Field', 'skip', 'THIS', 'generates', 'replaces', 'upgrades', 'make_list',
            'Number', 'Boolean', 'String', 'RawIdentifier', 'Language', 'Start')
@@ -23,7 +27,7 @@ Action = Callable[[Any, list], Any]
 
 
 class Start:
-    pass
+    __slots__ = ()
 
 
 @dataclass
@@ -81,6 +85,23 @@ def skip(*symbols, **kwargs):
     return f
 
 
+def _instance_attrs(cls):
+    """Attributes (besides the fields) that nodes of `cls` set on themselves: those
+    listed in `_instance_attrs` by the class or its bases, and lazyprops."""
+    names = {}
+    for c in reversed(cls.__mro__):
+        names.update(dict.fromkeys(vars(c).get('_instance_attrs', ())))
+        names.update(dict.fromkeys(v.attr_name for v in vars(c).values() if isinstance(v, lazyprop)))
+    return names
+
+
+def _instance_attr_field(cls, name):
+    # Not part of the node's identity, and the class attribute is the default
+    if hasattr(cls, name):
+        return (name, Any, field(default=getattr(cls, name), init=False, repr=False, compare=False))
+    return (name, Any, field(init=False, repr=False, compare=False))
+
+
 def generates(*symbols, **kwargs):
     def f(cls):
         add_tags(cls)
@@ -93,9 +114,13 @@ def generates(*symbols, **kwargs):
         if cls._fields is None:
             cls._fields = fields
             orig_cls = cls
+            # Nodes only get the slots they need (if the classes they're based
+            # on define __slots__ too, there's no __dict__ at all)
             cls = make_dataclass(cls.__name__, 
-                                 [f.make_dc_field() for f in fields.values()],
-                                 bases=(cls,))
+                                 [f.make_dc_field() for f in fields.values()]
+                                 + [_instance_attr_field(cls, name) for name in _instance_attrs(cls)
+                                    if name not in fields],
+                                 bases=(cls,), slots=True)
             #cls._orig_type = orig_cls
             
         elif fields.keys() != cls._fields.keys():
@@ -103,8 +128,10 @@ def generates(*symbols, **kwargs):
             raise Exception("Fields on class differ!")
         
         def action(cls, field_index=field_index):
-            def _action(_, nodes, cls=cls, field_index=field_index):
-                return cls(**{name: nodes[i] for name, i in field_index.items()})
+            # Classes can take over making their nodes, to share them for example
+            make = getattr(cls, 'from_parse', cls)
+            def _action(_, nodes, make=make, field_index=field_index):
+                return make(**{name: nodes[i] for name, i in field_index.items()})
             return _action
         
         raw_symbols = [(s.type if isinstance(s, Field) else s) for s in symbols]
@@ -113,10 +140,14 @@ def generates(*symbols, **kwargs):
     return f
 
 
+def _forward(_, nodes):
+    return nodes[0]
+
+
 def replaces(from_cls, **kwargs):
     def f(cls):
         add_tags(cls)
-        cls._productions.append(AbstractProduction(from_cls, [None], action=lambda _: lambda _, nodes: nodes[0], **kwargs))
+        cls._productions.append(AbstractProduction(from_cls, [None], action=lambda _: _forward, **kwargs))
         return cls
     return f
 
@@ -134,6 +165,13 @@ class TempSymbol:
     name: str
 
 
+def _append(_, nodes):
+    # Appending in place keeps building a list of n items O(n)
+    items = nodes[0]
+    items.append(nodes[2])
+    return items
+
+
 def make_list(t, divider, empty=False):
     def f(cls):
         add_tags(cls)
@@ -144,13 +182,12 @@ def make_list(t, divider, empty=False):
         cls._productions.append(AbstractProduction(None, [helper_symb], action=lambda _cls: lambda _, nodes: _cls(nodes[0])))
         
         if empty:  # empty list
-            cls._productions.append(AbstractProduction(helper_symb, [], action=lambda _: lambda _, nodes: []))
+            cls._productions.append(AbstractProduction(None, [], action=lambda _cls: lambda _, nodes: _cls()))
         # single member
         cls._productions.append(AbstractProduction(helper_symb, [t], action=lambda _: lambda _, nodes: [nodes[0]]))
-        #cls._productions.append(AbstractProduction(helper_symb, [t, divider], action=lambda _: lambda _, nodes: [nodes[0]]))
-        # two members
-        cls._productions.append(AbstractProduction(helper_symb, [t, divider, helper_symb],
-                                                   action=lambda _: lambda _, nodes: [nodes[0]] + nodes[2]))
+        # more members: left recursive, so the parser stack doesn't grow with the list
+        cls._productions.append(AbstractProduction(helper_symb, [helper_symb, divider, t],
+                                                   action=lambda _: _append))
         return cls
     return f
 
@@ -162,35 +199,60 @@ _default_actions = {
     'Number': lambda _, s: int(s),
     'Boolean': lambda _, s: s == 'true',
     'String': lambda _, s: s[1:-1],
-    'RawIdentifier': lambda _, s: s
+    'RawIdentifier': lambda _, s: sys.intern(s)
 }
 
 Number = Terminal('Number', RegExRecognizer(r"\d+"))
 Boolean = Terminal('Boolean', RegExRecognizer(r"(true|false)"))
 Boolean.prior = 100
-String = Terminal('String', RegExRecognizer(r'".*"'))
+# Up to the next quote, on the same line
+String = Terminal('String', RegExRecognizer(r'"[^"\n]*"'))
 RawIdentifier = Terminal('RawIdentifier', RegExRecognizer(r'[A-Za-z_][A-Za-z0-9_]*'))
 
 _comment = Terminal('_comment', RegExRecognizer(r"%.*\n"))
 
-_layout_prods = [
-    Production(LAYOUT, ProductionRHS([LAYOUT_ITEM])),
-    Production(LAYOUT, ProductionRHS([LAYOUT, LAYOUT_ITEM])),
-    Production(LAYOUT_ITEM, ProductionRHS([WS])),
-    Production(LAYOUT_ITEM, ProductionRHS([_comment])),
-    Production(LAYOUT_ITEM, ProductionRHS([EMPTY])),
-]
+# parglare numbers the productions of a grammar in place and adds them to
+# their symbols, so every grammar needs its own copies of both (it finds the
+# layout by the name LAYOUT)
+def _layout_prods():
+    layout, item = NonTerminal(LAYOUT.name), NonTerminal(LAYOUT_ITEM.name)
+    return [
+        Production(layout, ProductionRHS([item])),
+        Production(layout, ProductionRHS([layout, item])),
+        Production(item, ProductionRHS([WS])),
+        Production(item, ProductionRHS([_comment])),
+        Production(item, ProductionRHS([EMPTY])),
+    ]
 
 _default_symbols = [Number, Boolean, String, RawIdentifier, _comment]
 
+# Held while making a parglare Parser, see Language.parser
+_parser_lock = threading.Lock()
+
+
+
+_layout_or_string = re.compile(r'("[^"\n]*")|(?:\s|%.*\n)+')
+
+def normalize_source(text):
+    """`text` with comments removed and whitespace collapsed, so texts that
+    parse the same (mostly) normalize the same."""
+    return _layout_or_string.sub(lambda m: m.group(1) or ' ', text).strip()
+
 
 
 # Make an actual language!
 # =========================================================
 
 
+# Parsers Language.parse can use
+BACKENDS = ('parglare', 'pratt')
+
+
 class Language:
-    def __init__(self, *types):
+    def __init__(self, *types, backend='parglare'):
+        if backend not in BACKENDS:
+            raise Exception(f"Unknown parser backend {backend!r}, expected one of {BACKENDS}")
+        self.backend = backend
         types = list(types)
         upgrade_map = {}
         for t in types:
@@ -212,9 +274,53 @@ class Language:
         if len(start_types) != 1:
             raise Exception(f"There was no unique starting NonTerminal (instead got {start_types})")
         self.start = start_types[0]
-            
-        self.grammar, self.actions = self.make_grammar(self.start, self.types)
-        self.parser = Parser(self.grammar, actions=self.actions)
+        self._parsers = threading.local()
+    
+    # The grammar and parser are only built when first needed, most programs
+    # only ever use one of the languages that get defined on import.
+    
+    @lazyprop
+    def _grammar_and_actions(self):
+        return self.make_grammar(self.start, self.types)
+    
+    @property
+    def grammar(self):
+        return self._grammar_and_actions[0]
+    
+    @property
+    def actions(self):
+        return self._grammar_and_actions[1]
+    
+    @lazyprop
+    def table(self):
+        # The LR table is the expensive part, so it's loaded from disk if possible
+        return cache.get_table(self.grammar)
+    
+    @property
+    def parser(self):
+        """The parglare Parser of the current thread.
+        
+        A Parser keeps the state of the parse it's doing, so threads can't share
+        one. They do share the grammar, actions and table, which parsing only
+        reads, so a thread's first parser is cheap. Making one isn't read-only
+        though: parglare resolves the actions on the grammar again and builds a
+        table for the layout, so that happens under _parser_lock."""
+        parser = getattr(self._parsers, 'parser', None)
+        if parser is None:
+            grammar, actions, table = self.grammar, self.actions, self.table
+            with _parser_lock:
+                parser = self._parsers.parser = Parser(grammar, actions=actions, table=table)
+        return parser
+    
+    @lazyprop
+    def pratt_parser(self):
+        """The PrattParser (see eopl.pratt) for this language, None if the
+        grammar doesn't fit one."""
+        from eopl import pratt
+        try:
+            return pratt.PrattParser(self.start, self.types, _default_actions, [WS, _comment])
+        except pratt.Unsupported:
+            return None
     
     @staticmethod
     def make_grammar(start, types):
@@ -267,14 +373,76 @@ class Language:
                 prods.append(prod)
                 actions[prod.symbol.name].append(ap.make_action(t))
         
-        prods += _layout_prods
+        prods += _layout_prods()
         actions.update(_default_actions)
         grammar = Grammar(productions=prods, terminals=[], start_symbol=get_name(start))
         return grammar, actions
 
-    def add_types(self, *extra_types):
-        return type(self)(*self.types, *extra_types)
-
-    def parse(self, text):
+    def add_types(self, *extra_types, backend=None):
+        # Only works on the type list, so this doesn't build a parser
+        return type(self)(*self.types, *extra_types, backend=backend or self.backend)
+    
+    # Cache of parsed programs, see enable_parse_cache
+    parse_cache = None
+    normalize_cache_keys = False
+    
+    def enable_parse_cache(self, maxsize=256, maxbytes=None, normalize=False):
+        """Keep the programs parse() returns in an LRU cache, keyed on their text.
+        
+        The cache holds at most `maxsize` programs and, if given, about
+        `maxbytes` bytes of them. With `normalize`, texts that only differ in
+        whitespace and comments share an entry. Returns the cache (an
+        eopl.util.LRUCache, with hit/miss/eviction stats).
+        
+        Cached programs are shared, so they have to be treated as immutable:
+        evaluating or compiling them is fine, calling optimize() on them isn't
+        (use parse(text, optimize=True), which is cached separately).
+        """
+        self.parse_cache = LRUCache(maxsize, maxbytes)
+        self.normalize_cache_keys = normalize
+        return self.parse_cache
+    
+    def disable_parse_cache(self):
+        self.parse_cache = None
+
+    def parse(self, text, optimize=False):
+        cache = self.parse_cache
+        if cache is not None:
+            key = (normalize_source(text) if self.normalize_cache_keys else text, optimize)
+            prog = cache.get(key)
+            if prog is not None:
+                return prog
+        prog = self._parse(text)
+        if optimize:
+            prog.optimize()
+        if cache is not None:
+            cache.put(key, prog, deep_sizeof(prog) + sys.getsizeof(key[0]))
+        return prog
+
+    def _parse(self, text):
+        if self.backend == 'pratt' and self.pratt_parser is not None:
+            from eopl.pratt import Fallback
+            try:
+                return self.pratt_parser.parse(text)
+            except Fallback:
+                pass  # parglare reports the error, or knows better
         return self.parser.parse(text)
 
+    def compile(self, text, optimize=False):
+        """Parse and compile `text`, returns a function that runs the program."""
+        return self.parse(text, optimize).compile()
+    
+    # Storing parsed programs, see eopl.serialize
+    
+    @lazyprop
+    def fingerprint(self):
+        return serialize.language_fingerprint(self)
+    
+    def dumps(self, prog):
+        """`prog`, parsed by this language, as bytes that loads() turns back into it."""
+        return serialize.dumps(self, prog)
+    
+    def loads(self, data):
+        """Load a program stored by dumps(), without parsing (or building a parser)."""
+        return serialize.loads(self, data)
+
@@ -0,0 +1,423 @@
+"""A Pratt parser for a Language, made from the same decorators as the LR grammar.
+
+parglare's LR tables resolve the expression grammar's shift/reduce conflicts
+with the priority and assoc of the productions (see @generates). A Pratt
+parser makes the same choices directly:
+
+  - Productions of a nonterminal N that start with N (like `Add: Expression
+    '+' Expression`) are its infix ("led") productions, keyed by the token
+    after the N. Everything else is a prefix ("nud") production, picked by the
+    first token.
+  - Productions N -> M that only forward (like @replaces) are inlined, so Add
+    counts as a production of Expression.
+  - A nonterminal at the end of a production P is parsed with P's priority
+    and assoc as context: an infix production with priority q continues it
+    only if q > P's priority, or they're equal and P isn't left associative.
+    That is exactly parglare's shift/reduce resolution. Nonterminals followed
+    by something else take every infix production there is.
+
+Actions are the ones the LR parser runs, so both make identical trees.
+
+Scanning is context free, where parglare only tries the terminals the parser
+expects. Tokens that parglare could have split differently (`notx` is `not x`
+where an expression starts) are marked, and the parser gives up on them.
+Anything it can't parse raises Fallback, and Language.parse hands the text to
+parglare, which either reports the error or knows better. Grammars that don't
+fit (conflicting prefixes, ambiguous infixes, ...) raise Unsupported when the
+parser is made, those languages always use parglare.
+"""
+
+import re
+import sys
+import threading
+from array import array
+
+from parglare.grammar import Terminal, RegExRecognizer, DEFAULT_PRIORITY
+
+from eopl.language import TempSymbol, _forward, Number, Boolean, String, RawIdentifier
+
+__all__ = ('PrattParser', 'Fallback', 'Unsupported')
+
+
+class Unsupported(Exception):
+    """The grammar can't be parsed with a PrattParser."""
+
+
+class Fallback(Exception):
+    """This text has to be parsed by parglare."""
+
+
+_EOF = 0
+
+
+class _Production:
+    __slots__ = ('head', 'body', 'action', 'priority', 'assoc', 'steps')
+
+    def __init__(self, head, body, action, priority, assoc):
+        self.head = head
+        self.body = body
+        self.action = action
+        self.priority = priority
+        self.assoc = assoc
+        self.steps = None
+
+    def forwarded(self, unit):
+        """This production, with the result passed through `unit` (N -> self.head)."""
+        inner, outer = self.action, unit.action
+        if outer is _forward:
+            action = inner
+        else:
+            action = lambda ctx, nodes: outer(ctx, [inner(ctx, nodes)])
+        return _Production(unit.head, self.body, action, self.priority, self.assoc)
+
+
+class _NonTerminal:
+    __slots__ = ('key', 'prefix', 'nud', 'led', 'first', 'led_kinds', 'retag', 'empty')
+
+    def __init__(self, key):
+        self.key = key
+        self.prefix = []
+        self.nud = {}       # first token kind -> production
+        self.led = {}       # token kind after the N -> production
+        self.first = frozenset()
+        self.led_kinds = frozenset()
+        self.retag = ()     # regex terminals in first, for keywords used as names
+        self.empty = None
+
+
+class PrattParser:
+    def __init__(self, start, types, terminal_actions, layout):
+        self.start = start
+        self.terminal_actions = terminal_actions
+        self.fallbacks = 0
+        self._fallbacks_lock = threading.Lock()
+        productions = self._productions(types)
+        self._make_scanner(productions, layout)
+        self._make_nonterminals(productions)
+        self._compile_steps()
+
+    # Grammar
+
+    def _productions(self, types):
+        canonical = {}
+        for t in types:
+            canonical[t] = t
+            for repl in t._upgrade_from:
+                canonical[repl] = t
+            if hasattr(t, '_orig_type'):
+                canonical[t._orig_type] = t
+
+        def resolve(symbol, t):
+            if symbol is None:
+                return t
+            if isinstance(symbol, str):
+                # Token kinds are compared by identity
+                return sys.intern(symbol)
+            if isinstance(symbol, TempSymbol):
+                return symbol
+            if isinstance(symbol, Terminal):
+                if not isinstance(symbol.recognizer, RegExRecognizer):
+                    raise Unsupported(f"terminal {symbol.name} isn't a regex")
+                return symbol
+            try:
+                return canonical[symbol]
+            except (KeyError, TypeError):
+                raise Unsupported(f"unknown symbol {symbol!r}") from None
+
+        productions = []
+        for t in types:
+            for ap in t._productions:
+                productions.append(_Production(
+                    resolve(ap.head, t), [resolve(s, t) for s in ap.body],
+                    ap.make_action(t), ap.priority, ap.assoc))
+        return productions
+
+    @staticmethod
+    def _is_terminal(symbol):
+        return isinstance(symbol, (str, Terminal))
+
+    def _make_nonterminals(self, productions):
+        by_head = {}
+        for p in productions:
+            by_head.setdefault(p.head, []).append(p)
+        self.nonterminals = {key: _NonTerminal(key) for key in by_head}
+
+        # Nonterminals that start longer productions (infix ones, mostly) are
+        # parsed on their own, others are inlined where they're forwarded to
+        own = {p.body[0] for p in productions if len(p.body) > 1 and p.body[0] in by_head}
+
+        def alternatives(key, seen):
+            if key in seen:
+                raise Unsupported(f"forwarding cycle through {key!r}")
+            for p in by_head.get(key, ()):
+                target = p.body[0] if len(p.body) == 1 else None
+                if target in by_head and target not in own:
+                    yield from (q.forwarded(p) for q in alternatives(target, seen | {key}))
+                else:
+                    yield p
+
+        for key, nt in self.nonterminals.items():
+            for p in alternatives(key, frozenset()):
+                p.head = key
+                if not p.body:
+                    if nt.empty is not None:
+                        raise Unsupported(f"{key!r} has two empty productions")
+                    nt.empty = p
+                elif p.body[0] == key:
+                    if len(p.body) < 2 or not self._is_terminal(p.body[1]):
+                        raise Unsupported(f"infix production of {key!r} needs a token after it")
+                    if p.body[1] in nt.led:
+                        raise Unsupported(f"two infix productions of {key!r} on {p.body[1]!r}")
+                    nt.led[p.body[1]] = p
+                else:
+                    nt.prefix.append(p)
+            nt.led_kinds = frozenset(nt.led)
+
+        # Pick the prefix productions by their first token
+        firsts = {}
+        def first(key, seen=frozenset()):
+            if key in firsts:
+                return firsts[key]
+            if key in seen:
+                raise Unsupported(f"left recursion through {key!r}")
+            nt = self.nonterminals.get(key)
+            if nt is None:
+                raise Unsupported(f"no productions for {key!r}")
+            result = set()
+            for p in nt.prefix:
+                result |= first_of(p.body[0], seen | {key})
+            firsts[key] = frozenset(result)
+            return firsts[key]
+        def first_of(symbol, seen=frozenset()):
+            if self._is_terminal(symbol):
+                return {symbol}
+            if symbol not in self.nonterminals:
+                raise Unsupported(f"no productions for {symbol!r}")
+            if self.nonterminals[symbol].empty is not None:
+                raise Unsupported(f"{symbol!r} can be empty and starts a production")
+            return first(symbol, seen)
+
+        for key, nt in self.nonterminals.items():
+            nud = {}
+            for p in nt.prefix:
+                for kind in first_of(p.body[0]):
+                    if kind in nud:
+                        raise Unsupported(f"two productions of {key!r} start with {kind!r}")
+                    nud[kind] = p
+            nt.nud = nud
+            nt.first = frozenset(nud)
+            nt.retag = tuple(k for k in nud if isinstance(k, Terminal))
+
+        # A nonterminal in the middle of a production takes every infix
+        # production, which is only right if LR wouldn't stop there either
+        for p in productions:
+            for i, (symbol, after) in enumerate(zip(p.body, p.body[1:])):
+                led = self.nonterminals[symbol].led if symbol in self.nonterminals else {}
+                if i == 0 and led.get(after) is not None and led[after].body is p.body:
+                    continue  # p is that infix production
+                if led:
+                    follow = {after} if self._is_terminal(after) else first_of(after)
+                    if not follow.isdisjoint(led):
+                        raise Unsupported(f"{after!r} after {symbol!r} is also an infix")
+
+        if self.start not in self.nonterminals:
+            raise Unsupported("no productions for the start symbol")
+
+    def _compile_steps(self):
+        # Token kinds are small ints from here on, see _make_scanner. Steps are
+        # (kind, regex, convert, nonterminal, context) for every symbol still
+        # to parse; infix productions start after their token.
+        ids = self.kind_ids
+        for nt in self.nonterminals.values():
+            for p in nt.prefix + list(nt.led.values()) + ([nt.empty] if nt.empty else []):
+                body = p.body[2:] if p.body and p.body[0] == nt.key else p.body
+                steps = []
+                for i, symbol in enumerate(body):
+                    if isinstance(symbol, Terminal):
+                        steps.append((ids[symbol], symbol.recognizer.regex,
+                                      self.terminal_actions.get(symbol.name), None, None))
+                    elif isinstance(symbol, str):
+                        steps.append((ids[symbol], None, None, None, None))
+                    else:
+                        last = i == len(body) - 1
+                        steps.append((None, None, None, self.nonterminals[symbol],
+                                      (p.priority, p.assoc) if last else None))
+                p.steps = tuple(steps)
+            nt.retag = tuple((ids[t], t.recognizer.regex) for t in nt.retag)
+            nt.nud = {ids[kind]: p for kind, p in nt.nud.items()}
+            nt.led = {ids[kind]: p for kind, p in nt.led.items()}
+            nt.first = frozenset(nt.nud)
+            nt.led_kinds = frozenset(nt.led)
+
+    # Scanning
+
+    def _make_scanner(self, productions, layout):
+        strings = set()
+        regexes = set()
+        for p in productions:
+            for symbol in p.body:
+                if isinstance(symbol, str):
+                    strings.add(symbol)
+                elif isinstance(symbol, Terminal):
+                    regexes.add(symbol)
+        if RawIdentifier not in regexes:
+            raise Unsupported("words are scanned as RawIdentifier")
+        if not regexes <= {Number, Boolean, String, RawIdentifier}:
+            raise Unsupported("only the default terminals have a place in the scanner")
+
+        # 0 is the end of the input
+        self.kind_ids = {symbol: i for i, symbol in enumerate(
+            [Number, Boolean, String, RawIdentifier, *sorted(strings)], 1)}
+        word = RawIdentifier.recognizer.regex
+        self.keywords = [s for s in strings if word.fullmatch(s)]
+        self.word_terminals = [t for t in regexes if t in (Boolean,)]
+        punctuation = {s: self.kind_ids[s] for s in strings if s not in self.keywords}
+        for s in punctuation:
+            if re.match(r'[\w"%\s]', s):
+                raise Unsupported(f"{s!r} can't be told apart from other tokens")
+
+        # One regex for everything: every group starts with other characters,
+        # except the punctuation, which is tried longest first
+        groups = [
+            ('layout', '(?:' + '|'.join(t.recognizer._regex for t in layout) + ')+'),
+            ('number', Number.recognizer._regex),
+            ('string', String.recognizer._regex),
+            ('word', RawIdentifier.recognizer._regex),
+            ('punctuation', '|'.join(re.escape(s) for s in sorted(punctuation, key=len, reverse=True))
+                            or '(?!)'),
+            ('error', r'[\s\S]'),
+        ]
+        self.scanner = re.compile('|'.join(f'(?P<{name}>{pattern})' for name, pattern in groups),
+                                  RawIdentifier.recognizer.re_flags)
+        index = self.scanner.groupindex
+        self._groups = tuple(index[name] for name, _ in groups)
+        self.punctuation = punctuation
+        # Shared by all threads: a word computed twice gets the same result,
+        # and the GIL keeps the dict itself consistent
+        self.words = {}
+
+    def _word(self, text):
+        """The kind of a word, and the kinds of shorter tokens parglare would
+        have preferred at its start (None usually): a keyword that starts it,
+        or `true` in `trueish`."""
+        ids = self.kind_ids
+        # (length, priority, is string, kind), like parglare's lexical disambiguation
+        candidates = [(len(text), RawIdentifier.prior, False, ids[RawIdentifier])]
+        candidates += [(len(k), DEFAULT_PRIORITY, True, ids[k])
+                       for k in self.keywords if text.startswith(k)]
+        for t in self.word_terminals:
+            m = t.recognizer.regex.match(text)
+            if m:
+                candidates.append((m.end(), t.prior, False, ids[t]))
+        length, prior, is_string, kind = max(candidates)
+        prefixes = frozenset(c[3] for c in candidates
+                             if c[1] > prior or (c[1] == prior and c[2] and not is_string))
+        if len(self.words) > 100000:
+            self.words.clear()
+        self.words[text] = result = (kind, prefixes or None)
+        return result
+
+    def tokenize(self, text):
+        """The tokens of `text`: their kinds (an array of ints, ending with 0),
+        their texts and a dict of ambiguous prefixes by position (see _word)."""
+        LAYOUT, NUMBER, STRING, WORD, PUNCTUATION, ERROR = self._groups
+        ids = self.kind_ids
+        number, string = ids[Number], ids[String]
+        words = self.words
+        punctuation = self.punctuation
+        kinds = array('H')
+        texts = []
+        ambiguous = {}
+        add_kind = kinds.append
+        add_text = texts.append
+        for m in self.scanner.finditer(text):
+            group = m.lastindex
+            if group == LAYOUT:
+                continue
+            token = m.group()
+            if group == WORD:
+                kind, prefixes = words.get(token) or self._word(token)
+                if prefixes is not None:
+                    ambiguous[len(texts)] = prefixes
+            elif group == PUNCTUATION:
+                kind = punctuation[token]
+            elif group == NUMBER:
+                kind = number
+            elif group == STRING:
+                kind = string
+            else:
+                raise Fallback
+            add_kind(kind)
+            add_text(token)
+        add_kind(_EOF)
+        add_text('')
+        return kinds, texts, ambiguous
+
+    # Parsing
+
+    def parse(self, text):
+        try:
+            return self._parse(text)
+        except (Fallback, RecursionError):
+            with self._fallbacks_lock:
+                self.fallbacks += 1
+            raise Fallback from None
+
+    def _parse(self, text):
+        kinds, texts, ambiguous = self.tokenize(text)
+        pos = 0
+
+        def parse_nonterminal(nt, context):
+            nonlocal pos
+            kind = kinds[pos]
+            if pos in ambiguous and not ambiguous[pos].isdisjoint(nt.first):
+                raise Fallback
+            p = nt.nud.get(kind)
+            if p is None and kind != _EOF:
+                # parglare only looks for the tokens it expects: a keyword
+                # that can't start this is a name
+                for t, regex in nt.retag:
+                    if regex.fullmatch(texts[pos]):
+                        p = nt.nud[t]
+                        break
+            if p is None:
+                p = nt.empty
+                if p is None:
+                    raise Fallback
+            left = run(p, [])
+
+            led = nt.led
+            while True:
+                p = led.get(kinds[pos])
+                if pos in ambiguous and not ambiguous[pos].isdisjoint(nt.led_kinds):
+                    raise Fallback
+                if p is None:
+                    return left
+                if context is not None:
+                    priority, assoc = context
+                    if p.priority < priority or (p.priority == priority and assoc == 'left'):
+                        return left
+                pos += 1
+                left = run(p, [left, texts[pos - 1]])
+
+        def run(p, nodes):
+            nonlocal pos
+            for kind, regex, convert, nt, context in p.steps:
+                if nt is not None:
+                    nodes.append(parse_nonterminal(nt, context))
+                    continue
+                if kinds[pos] != kind:
+                    # A keyword (or true) where a name is expected is a name
+                    if regex is None or kinds[pos] == _EOF or not regex.fullmatch(texts[pos]):
+                        raise Fallback
+                if pos in ambiguous and kind in ambiguous[pos]:
+                    raise Fallback
+                token = texts[pos]
+                nodes.append(token if convert is None else convert(None, token))
+                pos += 1
+            return p.action(None, nodes)
+
+        result = parse_nonterminal(self.nonterminals[self.start], None)
+        if kinds[pos] != _EOF:
+            raise Fallback
+        return result
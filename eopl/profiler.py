@@ -0,0 +1,319 @@
+"""Where does the time go when evaluating a program?
+
+    prof = Profiler()
+    prof.run(LETREC, text)     # parses and evaluates, like LETREC.parse(text).evaluate()
+    print(prof.report())
+    open('out.folded', 'w').write(prof.collapsed())
+
+or from the command line:
+
+    python -m eopl.profiler LETREC program.eopl --collapsed out.folded
+
+For every node class, procedure and store operation, the profiler counts the
+calls and measures the inclusive time (with everything it evaluates) and the
+exclusive time (without). Procedures are named after their letrec declaration
+or the let binding they're bound to. collapsed() gives the exclusive time in
+microseconds per stack of procedures (with the node class as the last frame),
+in the format of flamegraph.pl and speedscope.
+
+Profiling works by replacing the evaluate() methods of the node classes (and
+DynamicProcedure.call and the Store methods) with timing wrappers, but only
+inside `with profiler:` (which run() and evaluate() use). Outside of it the
+classes are untouched, so evaluation doesn't pay anything for the profiler. Only
+evaluate() is profiled, not the stack safe evaluator, compile() or the VM. The
+wrappers are global, so only one profiler can be active at a time, in one
+thread.
+"""
+
+import argparse
+import sys
+from time import perf_counter
+
+from eopl.base import BaseExpr
+from eopl.expressions import DynamicProcedure, DynProcExpr, LetExpr, LetRecExpr
+
+__all__ = ('Profiler',)
+
+
+class Stats:
+    __slots__ = ('calls', 'inclusive', 'exclusive')
+
+    def __init__(self):
+        self.calls = 0
+        self.inclusive = 0.0
+        self.exclusive = 0.0
+
+
+class _Frame:
+    # `path` is the stack of procedures this runs in
+    __slots__ = ('table', 'label', 'path', 'procedure', 'start', 'children')
+
+    def __init__(self, table, label, path, procedure, start):
+        self.table = table
+        self.label = label
+        self.path = path
+        self.procedure = procedure
+        self.start = start
+        self.children = 0.0
+
+
+# The profiler whose wrappers are installed
+_active = None
+
+
+def _node_classes():
+    todo = [BaseExpr]
+    while todo:
+        cls = todo.pop()
+        todo.extend(cls.__subclasses__())
+        if 'evaluate' in vars(cls):
+            yield cls
+
+
+class Profiler:
+    def __init__(self):
+        self.nodes = {}        # node class (or store operation) name -> Stats
+        self.procedures = {}   # procedure name -> Stats
+        self.parse = Stats()
+        self.stacks = {}       # tuple of frame names -> exclusive seconds
+        self.names = {}        # id of a procedure body -> name
+        self._stack = []
+        self._depth = {}       # how often a name is on the stack
+        self._patched = []
+
+    # Running programs
+
+    def run(self, lang, text, **kwargs):
+        """Parse `text` in `lang` (timed too) and evaluate it, returns its value."""
+        start = perf_counter()
+        prog = lang.parse(text)
+        elapsed = perf_counter() - start
+        self.parse.calls += 1
+        self.parse.inclusive += elapsed
+        self.parse.exclusive += elapsed
+        self.stacks[('<parse>',)] = self.stacks.get(('<parse>',), 0.0) + elapsed
+        return self.evaluate(prog, **kwargs)
+
+    def evaluate(self, prog, **kwargs):
+        """Evaluate `prog` (with Program.evaluate's arguments), returns its value."""
+        self.add_names(prog)
+        with self:
+            return prog.evaluate(**kwargs)
+
+    def add_names(self, prog):
+        """Name the procedures of `prog` after their letrec declaration or let binding."""
+        for e in prog.expr.walk():
+            if isinstance(e, LetRecExpr):
+                for decl in e.decls:
+                    self.names[id(decl.body)] = decl.pname
+            elif isinstance(e, LetExpr):
+                for ass in e.assignments:
+                    if isinstance(ass.value, DynProcExpr):
+                        self.names[id(ass.value.body)] = ass.var
+
+    # Installing the wrappers
+
+    def __enter__(self):
+        global _active
+        if _active is not None:
+            raise Exception("Another profiler is already active")
+        from eopl.state import Store
+        _active = self
+        for cls in _node_classes():
+            self._patch(cls, 'evaluate', self._wrap_node(cls.__name__, vars(cls)['evaluate']))
+        self._patch(DynamicProcedure, 'call', self._wrap_call(DynamicProcedure.call))
+        for name in ('newref', 'deref', 'setref'):
+            self._patch(Store, name, self._wrap(self.nodes, f"Store.{name}", vars(Store)[name]))
+        return self
+
+    def __exit__(self, *exc):
+        global _active
+        for cls, name, original in reversed(self._patched):
+            setattr(cls, name, original)
+        self._patched.clear()
+        self._stack.clear()
+        self._depth.clear()
+        _active = None
+
+    def _patch(self, cls, name, wrapper):
+        self._patched.append((cls, name, vars(cls)[name]))
+        setattr(cls, name, wrapper)
+
+    def _wrap(self, table, label, fn):
+        enter, leave = self._enter, self._leave
+        def wrapper(*args):
+            enter(table, label, False)
+            try:
+                return fn(*args)
+            finally:
+                leave()
+        wrapper.__wrapped__ = fn
+        return wrapper
+
+    def _wrap_node(self, name, fn):
+        enter, leave, table = self._enter, self._leave, self.nodes
+        def evaluate(node, ctx):
+            # Operators share their evaluate, so name it after the node's class,
+            # unless this is a super().evaluate(ctx) of a subclass
+            cls = type(node)
+            enter(table, cls.__name__ if cls.evaluate is evaluate else name, False)
+            try:
+                return fn(node, ctx)
+            finally:
+                leave()
+        evaluate.__wrapped__ = fn
+        return evaluate
+
+    def _wrap_call(self, fn):
+        enter, leave, table, names = self._enter, self._leave, self.procedures, self.names
+        def call(proc, arg, ctx):
+            enter(table, names.get(id(proc.body)) or f"proc ({proc.argname})", True)
+            try:
+                return fn(proc, arg, ctx)
+            finally:
+                leave()
+        call.__wrapped__ = fn
+        return call
+
+    # Measuring
+
+    def _enter(self, table, label, procedure):
+        stack = self._stack
+        path = stack[-1].path if stack else ('<program>',)
+        if procedure:
+            path = path + (label,)
+        key = (id(table), label)
+        self._depth[key] = self._depth.get(key, 0) + 1
+        stack.append(_Frame(table, label, path, procedure, perf_counter()))
+
+    def _leave(self):
+        end = perf_counter()
+        frame = self._stack.pop()
+        elapsed = end - frame.start
+        exclusive = elapsed - frame.children
+        stats = frame.table.get(frame.label)
+        if stats is None:
+            stats = frame.table[frame.label] = Stats()
+        stats.calls += 1
+        stats.exclusive += exclusive
+        # Recursion: only the outermost call counts for the inclusive time
+        key = (id(frame.table), frame.label)
+        self._depth[key] -= 1
+        if not self._depth[key]:
+            stats.inclusive += elapsed
+        if self._stack:
+            self._stack[-1].children += elapsed
+        path = frame.path if frame.procedure else frame.path + (frame.label,)
+        self.stacks[path] = self.stacks.get(path, 0.0) + exclusive
+
+    # Output
+
+    def report(self, limit=20):
+        """The `limit` most expensive node classes and procedures, by exclusive time."""
+        lines = [f"parse {self.parse.calls:>10} calls {self.parse.inclusive * 1000:>12.3f}ms"]
+        for title, table in [('node', self.nodes), ('procedure', self.procedures)]:
+            lines.append('')
+            lines.append(f"{title:<24} {'calls':>10} {'inclusive':>12} {'exclusive':>12} {'per call':>10}")
+            ranked = sorted(table.items(), key=lambda item: item[1].exclusive, reverse=True)
+            for label, s in ranked[:limit]:
+                lines.append(f"{label:<24} {s.calls:>10} {s.inclusive * 1000:>10.3f}ms"
+                             f" {s.exclusive * 1000:>10.3f}ms {s.exclusive / s.calls * 1e6:>8.2f}us")
+        return '\n'.join(lines)
+
+    def collapsed(self):
+        """The stacks in the collapsed ('folded') format of flamegraph tools: a line
+        per stack, with its frames joined by ';' and its exclusive time in us."""
+        lines = []
+        for path, seconds in sorted(self.stacks.items()):
+            micros = round(seconds * 1e6)
+            if micros:
+                lines.append(f"{';'.join(f.replace(' ', '_') for f in path)} {micros}")
+        return ''.join(line + '\n' for line in lines)
+
+
+def main(argv=None):
+    from eopl.state import LANGUAGES
+    parser = argparse.ArgumentParser(prog='python -m eopl.profiler', description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('language', choices=list(LANGUAGES))
+    parser.add_argument('program', help="file with the program, - for stdin")
+    parser.add_argument('--collapsed', metavar='PATH', help="write collapsed stacks here")
+    parser.add_argument('--limit', type=int, default=20, help="rows per table")
+    args = parser.parse_args(argv)
+    text = sys.stdin.read() if args.program == '-' else open(args.program).read()
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 20000))
+
+    prof = Profiler()
+    result = prof.run(LANGUAGES[args.language], text)
+    print(f"result: {result!r}\n")
+    print(prof.report(args.limit))
+    if args.collapsed:
+        with open(args.collapsed, 'w') as f:
+            f.write(prof.collapsed())
+
+
+# Tests
+# ===============================================
+
+import unittest
+
+
+class ProfilerTest(unittest.TestCase):
+    def test_nodes(self):
+        from eopl.expressions import LET, Add, IfExpr
+        prof = Profiler()
+        self.assertEqual(prof.run(LET, "let x = 1 in if x < 2 then x + 2 else 0"), 3)
+        calls = {label: s.calls for label, s in prof.nodes.items()}
+        self.assertEqual(calls, {'LetExpr': 1, 'IfExpr': 1, 'Lt': 1, 'Add': 1,
+                                 'Identifier': 2, 'Constant': 3})
+        self.assertEqual(prof.parse.calls, 1)
+        for s in prof.nodes.values():
+            self.assertLessEqual(s.exclusive, s.inclusive)
+        # Nothing stays behind
+        self.assertFalse(hasattr(Add.evaluate, '__wrapped__'))
+        self.assertFalse(hasattr(IfExpr.evaluate, '__wrapped__'))
+
+    def test_procedures(self):
+        from eopl.expressions import LETREC
+        prof = Profiler()
+        s = """
+        letrec fib(n) = if n < 2 then n else fib(n - 1) + fib(n - 2) in
+        let double = proc (x) x * 2 in double((proc (y) y)(fib(5)))
+        """
+        self.assertEqual(prof.run(LETREC, s), 10)
+        calls = {label: s.calls for label, s in prof.procedures.items()}
+        self.assertEqual(calls, {'fib': 15, 'double': 1, 'proc (y)': 1})
+        fib = prof.procedures['fib']
+        # Recursive calls count once for the inclusive time
+        self.assertLess(fib.inclusive, prof.nodes['LetRecExpr'].inclusive)
+
+    def test_store(self):
+        from eopl.state import IMPLICIT_REFS
+        prof = Profiler()
+        prof.run(IMPLICIT_REFS, "let x = 1 in begin set x = x + 1; x end")
+        self.assertEqual(prof.nodes['Store.deref'].calls, 2)
+        self.assertEqual(prof.nodes['Store.setref'].calls, 2)
+
+    def test_collapsed(self):
+        from eopl.expressions import LETREC
+        prof = Profiler()
+        prof.run(LETREC, "letrec f(n) = if n == 0 then 0 else f(n - 1) in f(20)")
+        lines = prof.collapsed().splitlines()
+        for line in lines:
+            self.assertRegex(line, r'^\S+ \d+$')
+        stacks = [line.split()[0] for line in lines]
+        self.assertTrue(any(s.startswith('<program>;f;f;') for s in stacks))
+        self.assertIn('<parse>', stacks)
+
+    def test_one_at_a_time(self):
+        with Profiler():
+            with self.assertRaisesRegex(Exception, "already active"):
+                with Profiler():
+                    pass
+        # And the first one cleaned up after itself
+        with Profiler():
+            pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,270 @@
+"""Run many programs at once, in a pool of worker processes.
+
+    python -m eopl LETREC programs/ --workers 8 --timeout 2 --fuel 1000000
+    python -m eopl IMPLICIT_REFS programs.jsonl > results.jsonl
+
+Programs come from a directory (every file in it, recursively, with its path
+as id) or from JSON lines (a file, or - for stdin) of {"id": ..., "source": ...}.
+Every worker builds the language's parser once, then parses and evaluates
+programs with the stack safe evaluator. Each program gets `timeout` seconds
+of wall-clock time and `fuel` evaluation steps (see trampoline).
+
+Results are written as JSON lines, in the order they finish:
+
+    {"id": "a.eopl", "status": "ok", "value": 42, "seconds": 0.0012}
+
+with a status of "ok", "error", "timeout" or "out_of_fuel", and an "error"
+message instead of the value if it's not ok. Values that aren't JSON (like
+procedures) are given by their repr.
+
+Timeouts use SIGALRM, so they only work on Unix.
+"""
+
+import argparse
+import json
+import os
+import signal
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+
+from eopl.base import OutOfFuel
+
+__all__ = ('run_programs', 'read_programs', 'main')
+
+
+class Timeout(Exception):
+    pass
+
+
+# Input
+# ===============================================
+
+def read_programs(path):
+    """(id, source) pairs from a directory or a JSON lines file ('-' for stdin)."""
+    if path != '-' and Path(path).is_dir():
+        root = Path(path)
+        for file in sorted(p for p in root.rglob('*') if p.is_file()):
+            yield str(file.relative_to(root)), file.read_text()
+        return
+    lines = sys.stdin if path == '-' else open(path)
+    with lines:
+        for number, line in enumerate(lines, 1):
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            if not isinstance(item, dict) or 'source' not in item:
+                raise Exception(f"Line {number} has no \"source\"")
+            yield item.get('id', number), item['source']
+
+
+# Workers
+# ===============================================
+
+# Set up once per worker process by _init_worker
+_language = None
+_timeout = None
+_fuel = None
+
+
+def _init_worker(language_name, timeout, fuel):
+    global _language, _timeout, _fuel
+    from eopl.state import LANGUAGES
+    _language = LANGUAGES[language_name]
+    _timeout = timeout
+    _fuel = fuel
+    # Build (or load) the parser before the first program's clock starts
+    _language.parser
+    if timeout is not None:
+        signal.signal(signal.SIGALRM, _alarm)
+
+
+def _alarm(signum, frame):
+    raise Timeout
+
+
+def _json_value(value):
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    return repr(value)
+
+
+def _stop_timer():
+    if _timeout is not None:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+
+
+def _run(item):
+    program_id, source = item
+    result = {'id': program_id}
+    start = time.perf_counter()
+    # The timer is stopped before anything else happens, so a Timeout can't
+    # come from the handlers
+    try:
+        if _timeout is not None:
+            signal.setitimer(signal.ITIMER_REAL, _timeout)
+        value = _language.parse(source).evaluate(stack_safe=True, fuel=_fuel)
+        _stop_timer()
+        result.update(status='ok', value=_json_value(value))
+    except Timeout:
+        _stop_timer()
+        result.update(status='timeout', error=f"Took longer than {_timeout}s")
+    except OutOfFuel:
+        _stop_timer()
+        result.update(status='out_of_fuel', error=f"Took more than {_fuel} steps")
+    except Exception as e:
+        _stop_timer()
+        result.update(status='error', error=f"{type(e).__name__}: {e}")
+    finally:
+        _stop_timer()
+    result['seconds'] = round(time.perf_counter() - start, 6)
+    return result
+
+
+def run_programs(language_name, programs, workers=None, timeout=None, fuel=None):
+    """Parse and evaluate (id, source) pairs in `workers` processes, yields a
+    result (as described above) for each of them, in the order they finish.
+
+    Only a few programs per worker are handed out at a time, so `programs`
+    can be a long stream.
+    
+    A program whose worker fails gets an "error" result. If the worker died,
+    the pool can't run anything else: the programs that were running get
+    their result, then BrokenProcessPool is raised.
+    """
+    workers = workers or os.cpu_count() or 1
+    programs = iter(programs)
+    with ProcessPoolExecutor(workers, initializer=_init_worker,
+                             initargs=(language_name, timeout, fuel)) as pool:
+        pending = {}  # future -> program id
+        exhausted = False
+        while True:
+            while not exhausted and len(pending) < 4 * workers:
+                item = next(programs, None)
+                if item is None:
+                    exhausted = True
+                else:
+                    pending[pool.submit(_run, item)] = item[0]
+            if not pending:
+                return
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            broken = None
+            for future in done:
+                program_id = pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    result = {'id': program_id, 'status': 'error', 'error': f"{type(e).__name__}: {e}"}
+                    if isinstance(e, BrokenProcessPool):
+                        broken = e
+                yield result
+            if broken is not None:
+                raise broken
+
+
+# Command line
+# ===============================================
+
+def main(argv=None, out=None):
+    from eopl.state import LANGUAGES
+    parser = argparse.ArgumentParser(prog='python -m eopl', description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('language', choices=list(LANGUAGES))
+    parser.add_argument('programs', nargs='?', default='-',
+                        help="a directory, or a JSON lines file (default: stdin)")
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help="number of worker processes (default: one per CPU)")
+    parser.add_argument('--timeout', type=float, default=None, help="seconds per program")
+    parser.add_argument('--fuel', type=int, default=None, help="evaluation steps per program")
+    args = parser.parse_args(argv)
+    out = out or sys.stdout
+
+    counts = {}
+    try:
+        for result in run_programs(args.language, read_programs(args.programs),
+                                   args.workers, args.timeout, args.fuel):
+            out.write(json.dumps(result) + '\n')
+            out.flush()
+            counts[result['status']] = counts.get(result['status'], 0) + 1
+    except BrokenProcessPool:
+        print("Stopped: a worker process died", file=sys.stderr)
+        return 1
+    summary = ', '.join(f"{n} {status}" for status, n in sorted(counts.items()))
+    print(summary or "no programs", file=sys.stderr)
+    return 0 if set(counts) <= {'ok'} else 1
+
+
+# Tests
+# ===============================================
+
+import io
+import tempfile
+import unittest
+from unittest import mock
+
+
+class RunnerTest(unittest.TestCase):
+    PROGRAMS = {
+        'ok': "letrec f(x) = if x == 0 then 0 else x + f(x - 1) in f(100)",
+        'error': "let x = 1 in x / 0",
+        'loop': "letrec loop(x) = loop(x) in loop(0)",
+        'proc': "proc (x) x",
+        'syntax': "let x = in 1",
+    }
+
+    def results(self, **kwargs):
+        results = list(run_programs('LETREC', self.PROGRAMS.items(), workers=2, **kwargs))
+        self.assertEqual(len(results), len(self.PROGRAMS))
+        return {r['id']: r for r in results}
+
+    def test_fuel(self):
+        results = self.results(fuel=100000)
+        self.assertEqual(results['ok']['status'], 'ok')
+        self.assertEqual(results['ok']['value'], 5050)
+        self.assertEqual(results['error']['status'], 'error')
+        self.assertIn("ZeroDivisionError", results['error']['error'])
+        self.assertEqual(results['loop']['status'], 'out_of_fuel')
+        self.assertEqual(results['syntax']['status'], 'error')
+        self.assertIsInstance(results['proc']['value'], str)
+
+    def test_timeout(self):
+        results = self.results(timeout=0.2)
+        self.assertEqual(results['loop']['status'], 'timeout')
+        self.assertEqual(results['ok']['status'], 'ok')
+
+    def test_failed_worker(self):
+        # A program that can't be sent to a worker doesn't stop the others
+        programs = [('ok', "1 + 1"), ('unpicklable', lambda: None), ('also ok', "2")]
+        results = {r['id']: r for r in run_programs('LET', programs, workers=1)}
+        self.assertEqual(results['unpicklable']['status'], 'error')
+        self.assertEqual((results['ok']['value'], results['also ok']['value']), (2, 2))
+
+        # A worker that dies does
+        class Exit:
+            def __reduce__(self):
+                return (os._exit, (1,))
+        results = []
+        with self.assertRaises(BrokenProcessPool):
+            for result in run_programs('LET', [('exit', Exit())], workers=1):
+                results.append(result)
+        self.assertEqual([(r['id'], r['status']) for r in results], [('exit', 'error')])
+
+    def test_main(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            for name, source in self.PROGRAMS.items():
+                if name != 'loop':
+                    Path(tmp, name + '.eopl').write_text(source)
+            out = io.StringIO()
+            with mock.patch('sys.stderr', io.StringIO()):
+                code = main(['LETREC', tmp, '-j', '2', '--fuel', '100000'], out)
+            self.assertEqual(code, 1)
+            results = {r['id']: r for r in map(json.loads, out.getvalue().splitlines())}
+            self.assertEqual(results['ok.eopl']['value'], 5050)
+            self.assertEqual(set(results), {n + '.eopl' for n in self.PROGRAMS} - {'loop.eopl'})
+
+            path = Path(tmp, 'programs.jsonl')
+            path.write_text('{"id": "a", "source": "1 + 1"}\n\n{"source": "true"}\n')
+            self.assertEqual(sorted(r[1] for r in read_programs(str(path))), ["1 + 1", "true"])
+            self.assertEqual([r[0] for r in read_programs(str(path))], ['a', 3])
@@ -0,0 +1,154 @@
+"""A compact binary format for parsed programs, so they can be loaded without a parser.
+
+    data = LETREC.dumps(LETREC.parse(text))
+    prog = LETREC.loads(data)            # == LETREC.parse(text)
+
+A program is stored as its tree in postorder: a flat array of ints (as small
+as they fit) with one instruction per node, list or value, and a pool of the
+values (numbers, booleans, strings) they refer to. Loading replays the instructions on a stack,
+building every node from the ones on top, so deep trees don't need deep
+recursion.
+
+Nodes are tagged with the index of their class in the Language, and their
+fields follow the class's `_fields`. Both only mean something for the exact
+language the program was dumped with, so every blob carries a fingerprint of
+it (the node classes and their fields), and loading a blob of another language
+is an error. So is loading a truncated or damaged blob.
+
+Program.__post_init__ runs again on loading, so the analyses it does are
+redone; nothing else is stored.
+"""
+
+import hashlib
+import json
+import marshal
+import struct
+from array import array
+
+__all__ = ('FORMAT_VERSION', 'language_fingerprint', 'dumps', 'loads')
+
+
+MAGIC = b'EOPLAST'
+# Bump whenever the layout changes
+FORMAT_VERSION = 1
+_FINGERPRINT_SIZE = 16
+
+# Kinds of instructions, in the low bits; the rest is the argument
+_NODE = 0    # type index, pops one value per field
+_LIST = 1    # type index, the next int is the number of items to pop
+_VALUE = 2   # index in the value pool
+_KIND_BITS = 2
+_KIND_MASK = (1 << _KIND_BITS) - 1
+
+
+def _type_name(t):
+    return getattr(t, '__name__', None) or t.name  # a class or a parglare Terminal
+
+
+def language_fingerprint(lang):
+    """A digest of the node classes of `lang` and their fields."""
+    description = {
+        'version': FORMAT_VERSION,
+        'types': [[t.__module__, t.__qualname__, issubclass(t, list),
+                   [[name, _type_name(f.type)] for name, f in (t._fields or {}).items()]]
+                  for t in lang.types],
+    }
+    data = json.dumps(description, sort_keys=True).encode('utf-8')
+    return hashlib.sha256(data).digest()[:_FINGERPRINT_SIZE]
+
+
+def dumps(lang, prog):
+    """`prog` (parsed by `lang`) as bytes."""
+    type_index = {t: i for i, t in enumerate(lang.types)}
+    values = []
+    value_index = {}
+    ops = []
+
+    # Preorder, children last to first, then reversed: that's postorder with
+    # the children in order. Operands go before their instruction for that.
+    todo = [prog]
+    while todo:
+        obj = todo.pop()
+        t = type(obj)
+        index = type_index.get(t)
+        if index is not None and issubclass(t, list):
+            ops.append(len(obj))
+            ops.append(index << _KIND_BITS | _LIST)
+            todo.extend(obj)
+        elif index is not None:
+            ops.append(index << _KIND_BITS | _NODE)
+            todo.extend(getattr(obj, name) for name in t._fields)
+        elif t in (int, bool, str) or obj is None:
+            key = (t, obj)
+            i = value_index.get(key)
+            if i is None:
+                i = value_index[key] = len(values)
+                values.append(obj)
+            ops.append(i << _KIND_BITS | _VALUE)
+        else:
+            raise Exception(f"Can't store {obj!r}: not a node of this language")
+    ops.reverse()
+
+    # The smallest ints that fit, most programs only need 'H'
+    largest = max(ops, default=0)
+    typecode = next(c for c in 'BHI' if largest < 1 << 8 * array(c).itemsize)
+    instructions = array(typecode, ops)
+    payload = marshal.dumps((typecode, instructions.itemsize, instructions.tobytes(), values))
+    return MAGIC + struct.pack('<H', FORMAT_VERSION) + lang.fingerprint + payload
+
+
+def loads(lang, data):
+    """The program stored in `data`, which has to come from dumps() with the same language."""
+    if data[:len(MAGIC)] != MAGIC:
+        raise Exception("Not a stored eopl program")
+    start = len(MAGIC) + 2
+    try:
+        [version] = struct.unpack('<H', data[len(MAGIC):start])
+    except struct.error:
+        raise Exception("Stored program is corrupt") from None
+    if version != FORMAT_VERSION:
+        raise Exception(f"Unsupported program format version {version}")
+    if data[start:start + _FINGERPRINT_SIZE] != lang.fingerprint:
+        raise Exception("Program was stored by a different language")
+    try:
+        return _load_payload(lang, data[start + _FINGERPRINT_SIZE:])
+    except (EOFError, ValueError, TypeError, IndexError) as e:
+        # Truncated or damaged: marshal, array and the replay below fail in
+        # their own ways
+        raise Exception("Stored program is corrupt") from e
+
+
+def _load_payload(lang, payload):
+    typecode, itemsize, raw, values = marshal.loads(payload)
+    instructions = array(typecode)
+    if instructions.itemsize != itemsize:
+        raise Exception("Program was stored on a platform with a different int size")
+    instructions.frombytes(raw)
+
+    # Classes can take over making their nodes (see generates), like the parser
+    makers = [getattr(t, 'from_parse', t) for t in lang.types]
+    arity = [len(t._fields or ()) for t in lang.types]
+    ops = instructions.tolist()
+    stack = []
+    push = stack.append
+    pc = 0
+    while pc < len(ops):
+        op = ops[pc]
+        kind, arg = op & _KIND_MASK, op >> _KIND_BITS
+        if kind == _VALUE:
+            push(values[arg])
+        elif kind == _NODE:
+            n = len(stack) - arity[arg]
+            node = makers[arg](*stack[n:])
+            del stack[n:]
+            push(node)
+        else:
+            pc += 1
+            n = len(stack) - ops[pc]
+            items = lang.types[arg](stack[n:])
+            del stack[n:]
+            push(items)
+        pc += 1
+    if len(stack) != 1:
+        raise Exception("Stored program is corrupt")
+    return stack[0]
@@ -0,0 +1,461 @@
+"""A server that parses and evaluates programs, for other processes to use.
+
+    python -m eopl.server --unix /tmp/eopl.sock
+    python -m eopl.server --port 7411 --workers 4 --max-pending 256 --timeout 5
+
+Clients send JSON lines and get JSON lines back, over a Unix socket or TCP
+(on localhost by default):
+
+    {"id": 1, "op": "evaluate", "language": "LETREC", "source": "...", "deadline": 2}
+    {"id": 1, "status": "ok", "value": 42, "seconds": 0.0031}
+
+The ops are "evaluate", "parse" (the program's repr as "program") and "stats"
+(see Server.stats). Responses come back in the order they finish, so every
+request should have an "id" to match them up. Statuses are the ones of
+eopl.runner ("ok", "error", "timeout", "out_of_fuel") and "busy".
+
+Languages are only built once, in every worker process, before the first
+request. The evaluation itself runs in a pool of worker processes, so the
+event loop only reads, writes and waits. Load is bounded twice: a connection
+that has --per-connection requests in progress isn't read from until one
+finishes (so the client's writes block), and when --max-pending requests are
+in progress over all connections, new ones get "busy" straight away.
+
+A request's deadline (in seconds, at most --timeout, which is also the default
+for requests without one or with null) counts from when the server read it, so waiting in the queue uses it up. A request
+whose deadline passed before a worker got to it isn't run. Deadlines use
+SIGALRM in the workers, so the server only works on Unix.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import signal
+import sys
+import time
+from bisect import bisect_left
+from concurrent.futures import ProcessPoolExecutor
+
+from eopl.base import OutOfFuel
+from eopl.runner import Timeout, _json_value
+
+__all__ = ('Server', 'Histogram', 'main')
+
+
+# Workers
+# ===============================================
+
+# Set up once per worker process by _init_worker
+_languages = None
+_fuel = None
+
+
+def _init_worker(fuel):
+    global _languages, _fuel
+    from eopl.state import LANGUAGES
+    _languages = LANGUAGES
+    _fuel = fuel
+    for lang in LANGUAGES.values():
+        lang.parser
+    signal.signal(signal.SIGALRM, _alarm)
+
+
+def _alarm(signum, frame):
+    raise Timeout
+
+
+def _warm():
+    # Submitted once per worker at startup, so the initializers have run
+    # before the server accepts requests
+    pass
+
+
+def _stop_timer():
+    signal.setitimer(signal.ITIMER_REAL, 0)
+
+
+def _handle(op, language, source, deadline_at):
+    """Run one request in a worker, deadline_at is in time.time()."""
+    remaining = deadline_at - time.time()
+    if remaining <= 0:
+        return {'status': 'timeout', 'error': "Deadline passed while queued"}
+    lang = _languages.get(language)
+    if lang is None:
+        return {'status': 'error', 'error': f"Unknown language {language!r}"}
+    # The timer is stopped before anything else happens, so a Timeout can't
+    # come from the handlers
+    try:
+        if deadline_at != float('inf'):
+            signal.setitimer(signal.ITIMER_REAL, remaining)
+        prog = lang.parse(source)
+        result = repr(prog) if op == 'parse' else prog.evaluate(stack_safe=True, fuel=_fuel)
+        _stop_timer()
+    except Timeout:
+        _stop_timer()
+        return {'status': 'timeout', 'error': "Deadline passed"}
+    except OutOfFuel:
+        _stop_timer()
+        return {'status': 'out_of_fuel', 'error': f"Took more than {_fuel} steps"}
+    except Exception as e:
+        _stop_timer()
+        return {'status': 'error', 'error': f"{type(e).__name__}: {e}"}
+    finally:
+        _stop_timer()
+    if op == 'parse':
+        return {'status': 'ok', 'program': result}
+    return {'status': 'ok', 'value': _json_value(result)}
+
+
+# Metrics
+# ===============================================
+
+class Histogram:
+    """Counts of durations, in buckets of (at most) BOUNDS milliseconds."""
+
+    BOUNDS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.total = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(self.BOUNDS, seconds * 1000)] += 1
+        self.total += seconds
+
+    def quantile(self, q):
+        """Upper bound (in ms) of the bucket with the q-th quantile, None for
+        the overflow bucket or without any observations."""
+        n = sum(self.counts)
+        if not n:
+            return None
+        seen = 0
+        for bound, count in zip(self.BOUNDS, self.counts):
+            seen += count
+            if seen >= q * n:
+                return bound
+        return None
+
+    def to_json(self):
+        n = sum(self.counts)
+        return {
+            'count': n,
+            'mean_ms': round(self.total / n * 1000, 3) if n else None,
+            'p50_ms': self.quantile(0.5),
+            'p99_ms': self.quantile(0.99),
+            'buckets': {f"le_{bound}ms": count for bound, count in zip(self.BOUNDS, self.counts)}
+                       | {'overflow': self.counts[-1]},
+        }
+
+
+# Server
+# ===============================================
+
+class Server:
+    OPS = ('evaluate', 'parse', 'stats')
+
+    def __init__(self, workers=None, max_pending=256, per_connection=16, timeout=10.0, fuel=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.max_pending = max_pending
+        self.per_connection = per_connection
+        self.timeout = timeout
+        self.fuel = fuel
+        self.pool = None
+        self.server = None
+        # Metrics
+        self.pending = 0
+        self.max_seen_pending = 0
+        self.connections = 0
+        self.statuses = {}
+        self.latency = {op: Histogram() for op in self.OPS if op != 'stats'}
+        self.started = time.time()
+
+    async def start(self, path=None, host='127.0.0.1', port=0):
+        """Start the worker processes (and wait until they're warm), then
+        listen on the Unix socket `path`, or on `host`:`port`."""
+        self.pool = ProcessPoolExecutor(self.workers, initializer=_init_worker, initargs=(self.fuel,))
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(loop.run_in_executor(self.pool, _warm) for _ in range(self.workers)))
+        # Allow large programs on one line
+        limit = 16 * 2**20
+        if path is not None:
+            self.server = await asyncio.start_unix_server(self.handle_connection, path, limit=limit)
+        else:
+            self.server = await asyncio.start_server(self.handle_connection, host, port, limit=limit)
+        return self.server
+
+    @property
+    def address(self):
+        return self.server.sockets[0].getsockname()
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+
+    async def serve_forever(self):
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def handle_connection(self, reader, writer):
+        self.connections += 1
+        slots = asyncio.Semaphore(self.per_connection)
+        tasks = set()
+
+        async def respond(line):
+            try:
+                response = await self.handle_line(line)
+                writer.write(json.dumps(response).encode() + b'\n')
+                await writer.drain()
+            except ConnectionError:
+                pass
+            finally:
+                slots.release()
+
+        try:
+            while True:
+                # Backpressure: don't read more while this connection is busy
+                await slots.acquire()
+                try:
+                    line = await reader.readline()
+                except ValueError:
+                    # Longer than the limit, the stream can't be resynchronized
+                    writer.write(json.dumps({'status': 'error', 'error': "Request too long"}).encode() + b'\n')
+                    break
+                if not line:
+                    break
+                if not line.strip():
+                    slots.release()
+                    continue
+                task = asyncio.create_task(respond(line))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.wait(tasks)
+        finally:
+            self.connections -= 1
+            writer.close()
+
+    async def handle_line(self, line):
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError("not an object")
+        except ValueError as e:
+            return self._count({'status': 'error', 'error': f"Invalid request: {e}"})
+        try:
+            response = await self.handle(request)
+        except Exception as e:
+            # Like a broken pool, the client still gets an answer
+            response = self._count({'status': 'error', 'error': f"{type(e).__name__}: {e}"})
+        if 'id' in request:
+            response = {'id': request['id'], **response}
+        return response
+
+    async def handle(self, request):
+        """The response to a request (without its id)."""
+        op = request.get('op', 'evaluate')
+        if op not in self.OPS:
+            return self._count({'status': 'error', 'error': f"Unknown op {op!r}, expected one of {self.OPS}"})
+        if op == 'stats':
+            return {'status': 'ok', 'stats': self.stats()}
+        if not isinstance(request.get('source'), str):
+            return self._count({'status': 'error', 'error': "The request needs a \"source\" string"})
+        if self.pending >= self.max_pending:
+            return self._count({'status': 'busy', 'error': f"{self.pending} requests in progress"})
+
+        deadline = request.get('deadline')
+        if deadline is not None and (isinstance(deadline, bool) or not isinstance(deadline, (int, float))
+                                     or not deadline > 0):
+            return self._count({'status': 'error', 'error': "The deadline should be a positive number of seconds"})
+        if deadline is None or (self.timeout is not None and deadline > self.timeout):
+            deadline = self.timeout
+        start = time.time()
+        deadline_at = start + deadline if deadline is not None else float('inf')
+        self.pending += 1
+        self.max_seen_pending = max(self.max_seen_pending, self.pending)
+        try:
+            loop = asyncio.get_running_loop()
+            response = await loop.run_in_executor(
+                self.pool, _handle, op, request.get('language'), request['source'], deadline_at)
+        finally:
+            self.pending -= 1
+        elapsed = time.time() - start
+        self.latency[op].observe(elapsed)
+        response['seconds'] = round(elapsed, 6)
+        return self._count(response)
+
+    def _count(self, response):
+        self.statuses[response['status']] = self.statuses.get(response['status'], 0) + 1
+        return response
+
+    def stats(self):
+        return {
+            'uptime': round(time.time() - self.started, 3),
+            'workers': self.workers,
+            'connections': self.connections,
+            # Requests in a worker or waiting for one
+            'pending': self.pending,
+            'queued': max(0, self.pending - self.workers),
+            'max_pending': self.max_seen_pending,
+            'statuses': dict(self.statuses),
+            'latency': {op: h.to_json() for op, h in self.latency.items()},
+        }
+
+
+# Command line
+# ===============================================
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m eopl.server', description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    where = parser.add_mutually_exclusive_group(required=True)
+    where.add_argument('--unix', metavar='PATH', help="listen on this Unix socket")
+    where.add_argument('--port', type=int, help="listen on this TCP port")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help="number of worker processes (default: one per CPU)")
+    parser.add_argument('--max-pending', type=int, default=256,
+                        help="requests in progress before new ones get \"busy\"")
+    parser.add_argument('--per-connection', type=int, default=16,
+                        help="requests in progress per connection before it isn't read from")
+    parser.add_argument('--timeout', type=float, default=10.0, help="default deadline in seconds")
+    parser.add_argument('--fuel', type=int, default=None, help="evaluation steps per program")
+    args = parser.parse_args(argv)
+
+    async def serve():
+        server = Server(args.workers, args.max_pending, args.per_connection, args.timeout, args.fuel)
+        await server.start(args.unix, args.host, args.port)
+        print(f"Listening on {server.address}", file=sys.stderr, flush=True)
+        try:
+            await server.serve_forever()
+        finally:
+            await server.close()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+
+# Tests
+# ===============================================
+
+import tempfile
+import unittest
+
+
+class ServerTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'eopl.sock')
+        self.server = Server(workers=2, max_pending=4, per_connection=8, timeout=5)
+        await self.server.start(self.path)
+
+    async def asyncTearDown(self):
+        await self.server.close()
+        self.tmp.cleanup()
+
+    async def connect(self):
+        reader, writer = await asyncio.open_unix_connection(self.path)
+        self.addAsyncCleanup(self._close, writer)
+        return reader, writer
+
+    @staticmethod
+    async def _close(writer):
+        writer.close()
+        await writer.wait_closed()
+
+    async def requests(self, *requests):
+        reader, writer = await self.connect()
+        for r in requests:
+            writer.write(json.dumps(r).encode() + b'\n')
+        await writer.drain()
+        responses = [json.loads(await reader.readline()) for _ in requests]
+        return {r.get('id'): r for r in responses}
+
+    async def test_evaluate(self):
+        responses = await self.requests(
+            {'id': 1, 'language': 'LETREC', 'source': "letrec f(x) = if x == 0 then 0 else x + f(x - 1) in f(100)"},
+            {'id': 2, 'op': 'parse', 'language': 'LET', 'source': "let x = 1 in x"},
+            {'id': 3, 'language': 'LET', 'source': "1 / 0"},
+            {'id': 4, 'language': 'NOPE', 'source': "1"},
+            {'id': 5, 'op': 'nope'},
+        )
+        self.assertEqual(responses[1]['status'], 'ok')
+        self.assertEqual(responses[1]['value'], 5050)
+        self.assertIn('LetExpr', responses[2]['program'])
+        self.assertIn('ZeroDivisionError', responses[3]['error'])
+        self.assertIn('Unknown language', responses[4]['error'])
+        self.assertIn('Unknown op', responses[5]['error'])
+
+    async def test_deadline(self):
+        loop = "letrec loop(x) = loop(x) in loop(0)"
+        responses = await self.requests(
+            {'id': 1, 'language': 'LETREC', 'source': loop, 'deadline': 0.2},
+            {'id': 2, 'language': 'LETREC', 'source': "1 + 1", 'deadline': 0.2},
+            {'id': 3, 'language': 'LET', 'source': "2 * 3", 'deadline': None},
+            {'id': 4, 'language': 'LET', 'source': "1", 'deadline': "soon"},
+        )
+        self.assertEqual(responses[1]['status'], 'timeout')
+        self.assertEqual(responses[2]['value'], 2)
+        self.assertEqual(responses[3]['value'], 6)
+        self.assertIn('deadline', responses[4]['error'])
+
+    async def test_deadline_cap(self):
+        self.server.timeout = 0.2
+        loop = "letrec loop(x) = loop(x) in loop(0)"
+        responses = await self.requests(
+            {'id': 1, 'language': 'LETREC', 'source': loop, 'deadline': None},
+            {'id': 2, 'language': 'LETREC', 'source': loop, 'deadline': 1e10},
+            {'id': 3, 'language': 'LET', 'source': "1", 'deadline': float('nan')},
+            {'id': 4, 'language': 'LET', 'source': "1", 'deadline': True},
+        )
+        self.assertEqual(responses[1]['status'], 'timeout')
+        self.assertEqual(responses[2]['status'], 'timeout')
+        self.assertIn('deadline', responses[3]['error'])
+        self.assertIn('deadline', responses[4]['error'])
+
+    async def test_internal_error(self):
+        async def handle(request):
+            raise RuntimeError("the pool broke")
+        self.server.handle = handle
+        responses = await self.requests({'id': 1, 'language': 'LET', 'source': "1"})
+        self.assertEqual(responses[1], {'id': 1, 'status': 'error', 'error': "RuntimeError: the pool broke"})
+
+    async def test_busy(self):
+        loop = "letrec loop(x) = loop(x) in loop(0)"
+        responses = await self.requests(
+            *({'id': i, 'language': 'LETREC', 'source': loop, 'deadline': 0.3} for i in range(6)))
+        statuses = sorted(r['status'] for r in responses.values())
+        self.assertEqual(statuses, ['busy'] * 2 + ['timeout'] * 4)
+        stats = (await self.requests({'op': 'stats'}))[None]['stats']
+        self.assertEqual(stats['max_pending'], 4)
+        self.assertEqual(stats['pending'], 0)
+        self.assertEqual(stats['statuses'], {'busy': 2, 'timeout': 4})
+        self.assertEqual(stats['latency']['evaluate']['count'], 4)
+
+    async def test_invalid(self):
+        reader, writer = await self.connect()
+        writer.write(b'not json\n\n[1]\n')
+        await writer.drain()
+        for _ in range(2):
+            self.assertEqual(json.loads(await reader.readline())['status'], 'error')
+
+    def test_histogram(self):
+        h = Histogram()
+        for ms in [0.5, 3, 3, 4, 700, 20000]:
+            h.observe(ms / 1000)
+        data = h.to_json()
+        self.assertEqual(data['count'], 6)
+        self.assertEqual(data['buckets']['le_1ms'], 1)
+        self.assertEqual(data['buckets']['le_5ms'], 3)
+        self.assertEqual(data['buckets']['overflow'], 1)
+        self.assertEqual(data['p50_ms'], 5)
+        self.assertIsNone(data['p99_ms'])
+
+
+if __name__ == '__main__':
+    main()
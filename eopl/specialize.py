@@ -0,0 +1,518 @@
+"""Self-specializing nodes, an execution mode next to compile() and the VM.
+
+Program.specialize() turns a program into a tree of node objects, much like
+compile() turns it into closures: every expression has a specialize() method
+that builds its node. A node runs with execute(env, ctx), in the same Frames as
+compiled code (variables are resolved to lexical addresses beforehand).
+
+Operators and calls start out uninitialized and rewrite themselves (by changing
+their class) after they've seen what they run on, like the nodes of Truffle:
+
+  - An operator that got two ints becomes an int node, that does the operation
+    inline behind a type guard. When the guard fails it deoptimizes for good, to
+    the generic node that calls the operator function like compile() does.
+  - A call becomes a monomorphic inline cache for the body of the first procedure
+    it calls: as long as the procedures it gets share that body, it runs it
+    without dispatching. Another body deoptimizes it to a generic call.
+
+A node can run again before it is done running: in `x + f(x - 1)` the call runs
+the same `+` for the next x. That inner run may rewrite the node before the
+outer one has its operands, so the slow paths hand the operands on to rewrite()
+of whatever class the node has by then.
+
+The nodes are made fresh by every specialize(), so rewriting them doesn't change
+the program that was parsed. Every rewrite is counted in Counters.
+"""
+
+import operator
+
+from eopl.base import Frame
+from eopl.util import pretty
+
+__all__ = ('Counters',)
+
+
+class Counters:
+    """How many nodes specialized, and how many of those deoptimized again."""
+
+    __slots__ = ('specialized', 'deoptimized')
+
+    def __init__(self):
+        self.specialized = 0
+        self.deoptimized = 0
+
+    def __repr__(self):
+        return f"Counters(specialized={self.specialized}, deoptimized={self.deoptimized})"
+
+
+# Procedures
+# ===============================================
+
+# Like CompiledProcedure and CompiledDynamicProcedure, with a node as body
+
+class Procedure:
+    __slots__ = ('names', 'body', 'captured')
+
+    def __init__(self, names, body, captured):
+        self.names = names
+        self.body = body
+        self.captured = captured
+
+    def run(self, arg, env, ctx):
+        return self.body.execute(Frame(self.names, (arg, *self.captured), None), ctx)
+
+
+class DynamicProcedure:
+    __slots__ = ('argname', 'body')
+
+    def __init__(self, argname, body):
+        self.argname = argname
+        self.body = body
+
+    def run(self, arg, env, ctx):
+        return self.body.execute(Frame((self.argname,), (arg,), env), ctx)
+
+
+# Nodes that don't specialize
+# ===============================================
+
+class Constant:
+    __slots__ = ('val',)
+
+    def __init__(self, val):
+        self.val = val
+
+    def execute(self, env, ctx):
+        return self.val
+
+
+class Local:
+    """A variable in the current Frame."""
+
+    __slots__ = ('index',)
+
+    def __init__(self, index):
+        self.index = index
+
+    def execute(self, env, ctx):
+        return env.values[self.index]
+
+
+class Outer:
+    """A variable in the parent Frame."""
+
+    __slots__ = ('index',)
+
+    def __init__(self, index):
+        self.index = index
+
+    def execute(self, env, ctx):
+        return env.parent.values[self.index]
+
+
+class Address:
+    __slots__ = ('depth', 'index')
+
+    def __init__(self, depth, index):
+        self.depth = depth
+        self.index = index
+
+    def execute(self, env, ctx):
+        return env.get(self.depth, self.index)
+
+
+class Dynamic:
+    """A dynamically scoped variable, looked up by name."""
+
+    __slots__ = ('name',)
+
+    def __init__(self, name):
+        self.name = name
+
+    def execute(self, env, ctx):
+        try:
+            return env.lookup(self.name)
+        except KeyError:
+            raise Exception(f"Couldn't find {self.name} in:\n{pretty(env)}") from None
+
+
+class Let:
+    __slots__ = ('names', 'values', 'body')
+
+    def __init__(self, names, values, body):
+        self.names = names
+        self.values = values
+        self.body = body
+
+    def execute(self, env, ctx):
+        values = tuple([ctx.wrap(value.execute(env, ctx)) for value in self.values])
+        return self.body.execute(Frame(self.names, values, env), ctx)
+
+
+class LetOne(Let):
+    __slots__ = ()
+
+    def execute(self, env, ctx):
+        value = ctx.wrap(self.values[0].execute(env, ctx))
+        return self.body.execute(Frame(self.names, (value,), env), ctx)
+
+
+class If:
+    __slots__ = ('cond', 'true', 'false')
+
+    def __init__(self, cond, true, false):
+        self.cond = cond
+        self.true = true
+        self.false = false
+
+    def execute(self, env, ctx):
+        if self.cond.execute(env, ctx):
+            return self.true.execute(env, ctx)
+        else:
+            return self.false.execute(env, ctx)
+
+
+class MakeProcedure:
+    __slots__ = ('names', 'body', 'fetchers')
+
+    def __init__(self, names, body, fetchers):
+        self.names = names
+        self.body = body
+        self.fetchers = fetchers
+
+    def execute(self, env, ctx):
+        return Procedure(self.names, self.body, [f(env) for f in self.fetchers])
+
+
+class MakeDynamicProcedure:
+    __slots__ = ('argname', 'body')
+
+    def __init__(self, argname, body):
+        self.argname = argname
+        self.body = body
+
+    def execute(self, env, ctx):
+        return DynamicProcedure(self.argname, self.body)
+
+
+class LetRec:
+    """`decls` are (names, body, fetchers) of the procedures, see LetRecDecl.specialize."""
+
+    __slots__ = ('names', 'decls', 'body')
+
+    def __init__(self, names, decls, body):
+        self.names = names
+        self.decls = decls
+        self.body = body
+
+    def execute(self, env, ctx):
+        procs = [Procedure(names, body, None) for names, body, _ in self.decls]
+        frame = Frame(self.names, [ctx.wrap(p) for p in procs], env)
+        for p, (_, _, fetchers) in zip(procs, self.decls):
+            p.captured = [f(frame) for f in fetchers]
+        return self.body.execute(frame, ctx)
+
+
+class Begin:
+    __slots__ = ('init', 'last')
+
+    def __init__(self, init, last):
+        self.init = init
+        self.last = last
+
+    def execute(self, env, ctx):
+        for e in self.init:
+            e.execute(env, ctx)
+        return self.last.execute(env, ctx)
+
+
+class NewRef:
+    __slots__ = ('init',)
+
+    def __init__(self, init):
+        self.init = init
+
+    def execute(self, env, ctx):
+        ref = ctx.store.newref()
+        ctx.store.setref(ref, self.init.execute(env, ctx))
+        return ref
+
+
+class Deref:
+    __slots__ = ('ref',)
+
+    def __init__(self, ref):
+        self.ref = ref
+
+    def execute(self, env, ctx):
+        return ctx.store.deref(self.ref.execute(env, ctx))
+
+
+class SetRef:
+    __slots__ = ('ref', 'val')
+
+    def __init__(self, ref, val):
+        self.ref = ref
+        self.val = val
+
+    def execute(self, env, ctx):
+        ref = self.ref.execute(env, ctx)
+        val = self.val.execute(env, ctx)
+        ctx.store.setref(ref, val)
+        return val
+
+
+class SetVariable:
+    """Set the reference a variable holds (implicit references), `fetch` gets it
+    out of the Frame (see Scope.fetcher)."""
+
+    __slots__ = ('fetch', 'value')
+
+    def __init__(self, fetch, value):
+        self.fetch = fetch
+        self.value = value
+
+    def execute(self, env, ctx):
+        ref = self.fetch(env)
+        val = self.value.execute(env, ctx)
+        ctx.store.setref(ref, val)
+        return val
+
+
+class Delay:
+    """Doesn't run `node` yet, but makes a thunk of it (and the Frame), with
+    the `thunk` class. See CALL_BY_NEED in eopl.state."""
+
+    __slots__ = ('thunk', 'node')
+
+    def __init__(self, thunk, node):
+        self.thunk = thunk
+        self.node = node
+
+    def execute(self, env, ctx):
+        return self.thunk(self.node, env)
+
+
+class Force:
+    """The value `ref` points to, after forcing it if it's a thunk."""
+
+    __slots__ = ('ref',)
+
+    def __init__(self, ref):
+        self.ref = ref
+
+    def execute(self, env, ctx):
+        return ctx.force(self.ref.execute(env, ctx))
+
+
+# Binary operators
+# ===============================================
+
+class BinaryNode:
+    """An operator node that hasn't run yet."""
+
+    # Every state of the node has the same slots, so it can change class
+    __slots__ = ('func', 'a', 'b', 'counters')
+
+    def __init__(self, func, a, b, counters):
+        self.func = func
+        self.a = a
+        self.b = b
+        self.counters = counters
+
+    def execute(self, env, ctx):
+        a, b = self.a.execute(env, ctx), self.b.execute(env, ctx)
+        return self.rewrite(a, b)
+
+    def rewrite(self, a, b):
+        # bool is an int too, but True + True isn't what these nodes are for
+        specialized = _INT_BINARY.get(self.func)
+        if specialized is not None and type(a) is int and type(b) is int:
+            self.__class__ = specialized
+            self.counters.specialized += 1
+        else:
+            self.__class__ = GenericBinary
+        return self.func(a, b)
+
+
+class GenericBinary(BinaryNode):
+    __slots__ = ()
+
+    def execute(self, env, ctx):
+        return self.func(self.a.execute(env, ctx), self.b.execute(env, ctx))
+
+    def rewrite(self, a, b):
+        return self.func(a, b)
+
+
+class IntBinary(BinaryNode):
+    __slots__ = ()
+
+    def rewrite(self, a, b):
+        if type(a) is int and type(b) is int:
+            return self.func(a, b)
+        return self.deoptimize(a, b)
+
+    def deoptimize(self, a, b):
+        self.__class__ = GenericBinary
+        self.counters.deoptimized += 1
+        return self.func(a, b)
+
+
+def _make_int_binary(name, symbol):
+    # The operation is inline, not a call of self.func: that's what makes the
+    # node worth having. So execute() is generated, like Context.with_env is.
+    source = (f"def execute(self, env, ctx):\n"
+              f"    a, b = self.a.execute(env, ctx), self.b.execute(env, ctx)\n"
+              f"    if type(a) is int and type(b) is int:\n"
+              f"        return a {symbol} b\n"
+              f"    return self.deoptimize(a, b)\n")
+    namespace = {}
+    exec(source, namespace)
+    return type(name, (IntBinary,), {'__slots__': (), '__module__': __name__,
+                                     'execute': namespace['execute']})
+
+
+# The int node of each operator function
+_INT_BINARY = {}
+for _func, _name, _symbol in [
+    (operator.add, 'IntAdd', '+'),
+    (operator.sub, 'IntSub', '-'),
+    (operator.mul, 'IntMul', '*'),
+    (operator.floordiv, 'IntDiv', '//'),
+    (operator.mod, 'IntMod', '%'),
+    (operator.eq, 'IntEq', '=='),
+    (operator.ne, 'IntNe', '!='),
+    (operator.lt, 'IntLt', '<'),
+    (operator.le, 'IntLe', '<='),
+    (operator.gt, 'IntGt', '>'),
+    (operator.ge, 'IntGe', '>='),
+]:
+    _INT_BINARY[_func] = _make_int_binary(_name, _symbol)
+del _func, _name, _symbol
+
+
+# Unary operators
+# ===============================================
+
+class UnaryNode:
+    """A unary operator node that hasn't run yet."""
+
+    __slots__ = ('func', 'a', 'counters')
+
+    def __init__(self, func, a, counters):
+        self.func = func
+        self.a = a
+        self.counters = counters
+
+    def execute(self, env, ctx):
+        return self.rewrite(self.a.execute(env, ctx))
+
+    def rewrite(self, a):
+        if self.func is operator.neg and type(a) is int:
+            self.__class__ = IntNeg
+            self.counters.specialized += 1
+        else:
+            self.__class__ = GenericUnary
+        return self.func(a)
+
+
+class GenericUnary(UnaryNode):
+    __slots__ = ()
+
+    def execute(self, env, ctx):
+        return self.func(self.a.execute(env, ctx))
+
+    def rewrite(self, a):
+        return self.func(a)
+
+
+class IntNeg(UnaryNode):
+    __slots__ = ()
+
+    def execute(self, env, ctx):
+        a = self.a.execute(env, ctx)
+        if type(a) is int:
+            return -a
+        return self.deoptimize(a)
+
+    def rewrite(self, a):
+        if type(a) is int:
+            return -a
+        return self.deoptimize(a)
+
+    def deoptimize(self, a):
+        self.__class__ = GenericUnary
+        self.counters.deoptimized += 1
+        return self.func(a)
+
+
+# Calls
+# ===============================================
+
+class CallNode:
+    """A call node that hasn't called anything yet.
+
+    The argument is wrapped (ctx.wrap) before the call if `wrap` is set, call
+    by reference passes a reference as it is.
+    """
+
+    __slots__ = ('proc', 'arg', 'wrap', 'target', 'counters')
+
+    def __init__(self, proc, arg, wrap, counters):
+        self.proc = proc
+        self.arg = arg
+        self.wrap = wrap
+        self.target = None
+        self.counters = counters
+
+    def execute(self, env, ctx):
+        proc, arg = self.proc.execute(env, ctx), self.arg.execute(env, ctx)
+        if self.wrap:
+            arg = ctx.wrap(arg)
+        return self.rewrite(proc, arg, env, ctx)
+
+    def rewrite(self, proc, arg, env, ctx):
+        if type(proc) is Procedure:
+            # Whatever calls this procedure's body will likely call it again
+            self.target = proc.body
+            self.__class__ = MonomorphicCall
+            self.counters.specialized += 1
+        else:
+            self.__class__ = GenericCall
+        return proc.run(arg, env, ctx)
+
+
+class GenericCall(CallNode):
+    __slots__ = ()
+
+    def execute(self, env, ctx):
+        proc, arg = self.proc.execute(env, ctx), self.arg.execute(env, ctx)
+        return proc.run(ctx.wrap(arg) if self.wrap else arg, env, ctx)
+
+    def rewrite(self, proc, arg, env, ctx):
+        return proc.run(arg, env, ctx)
+
+
+class MonomorphicCall(CallNode):
+    __slots__ = ()
+
+    def execute(self, env, ctx):
+        proc, arg = self.proc.execute(env, ctx), self.arg.execute(env, ctx)
+        if self.wrap:
+            arg = ctx.wrap(arg)
+        if type(proc) is Procedure and proc.body is self.target:
+            # Procedure.run, without looking it up
+            return self.target.execute(Frame(proc.names, (arg, *proc.captured), None), ctx)
+        return self.deoptimize(proc, arg, env, ctx)
+
+    def rewrite(self, proc, arg, env, ctx):
+        if type(proc) is Procedure and proc.body is self.target:
+            return proc.run(arg, env, ctx)
+        return self.deoptimize(proc, arg, env, ctx)
+
+    def deoptimize(self, proc, arg, env, ctx):
+        self.__class__ = GenericCall
+        self.target = None
+        self.counters.deoptimized += 1
+        return proc.run(arg, env, ctx)
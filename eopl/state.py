@@ -1,48 +1,224 @@
 
 from dataclasses import dataclass, field
-from weakref import WeakKeyDictionary
+from types import BuiltinFunctionType, FrameType, FunctionType, MethodType, ModuleType
 
 from eopl.language import *
 from eopl.base import *
 from eopl.expressions import *
 
 
-@dataclass(frozen=True)
 class Reference:
-    ptr: int
+    __slots__ = ('ptr',)
+    
+    def __init__(self, ptr: int):
+        self.ptr = ptr
+    
+    def __eq__(self, other):
+        return isinstance(other, Reference) and other.ptr == self.ptr
+    
+    def __hash__(self):
+        return hash(self.ptr)
+    
     __str__ = __repr__ = lambda s: hex(s.ptr)
 
 
-# weakref -> free GC :)
-class Store(WeakKeyDictionary):
+# Marks a cell on the free list
+_free = object()
+
+# Values that can't contain references
+_atoms = (int, float, str, bytes, type(None))
+
+
+class Store:
+    """The values that references point to, in a list indexed by Reference.ptr.
+    
+    Freed cells go on a free list and get reused by newref. Cells are freed by
+    collect(roots), a mark-and-sweep collection that keeps everything reachable
+    from `roots` (contexts, environments, procedures, ...). Every evaluator
+    passes its roots to StoreContext.safe_point every so many steps or procedure
+    calls (see trampoline, expressions._safe_point and the VM), which collects
+    once more than `threshold` references were made since the previous
+    collection.
+    """
+    
+    def __init__(self, threshold=10000):
+        self.cells = []
+        self.free = []
+        self.threshold = threshold
+        self.since_collect = 0
+        self.allocated = 0
+        self.collections = 0
+        self.collected = 0
+    
     def newref(self) -> Reference:
-        return Reference(len(self))
+        self.allocated += 1
+        self.since_collect += 1
+        if self.free:
+            ptr = self.free.pop()
+            self.cells[ptr] = None
+        else:
+            ptr = len(self.cells)
+            self.cells.append(None)
+        return Reference(ptr)
     
     def deref(self, ref: Reference):
         assert isinstance(ref, Reference)
-        return self[ref]
+        val = self.cells[ref.ptr]
+        if val is _free:
+            raise Exception(f"Dangling reference {ref}: its cell was collected")
+        return val
     
     def setref(self, ref: Reference, val):
         assert isinstance(ref, Reference)
-        self[ref] = val
+        self.cells[ref.ptr] = val
+    
+    def __len__(self):
+        return len(self.cells) - len(self.free)
+    
+    @property
+    def wants_collect(self):
+        return self.since_collect >= self.threshold
+    
+    def collect(self, roots):
+        """Free every cell that isn't reachable from `roots`, returns how many were freed."""
+        cells = self.cells
+        marked = bytearray(len(cells))
+        seen = set()
+        todo = list(roots)
+        while todo:
+            obj = todo.pop()
+            if isinstance(obj, Reference):
+                if not marked[obj.ptr]:
+                    marked[obj.ptr] = 1
+                    todo.append(cells[obj.ptr])
+            elif not isinstance(obj, _atoms) and id(obj) not in seen:
+                seen.add(id(obj))
+                todo.extend(_referents(obj))
+        
+        freed = 0
+        for ptr, m in enumerate(marked):
+            if not m and cells[ptr] is not _free:
+                cells[ptr] = _free
+                self.free.append(ptr)
+                freed += 1
+        
+        self.collections += 1
+        self.collected += freed
+        self.since_collect = 0
+        # Don't collect over and over if most of the store is live
+        if len(self) > self.threshold // 2:
+            self.threshold *= 2
+        return freed
+    
+    def stats(self):
+        return {
+            'allocated': self.allocated,
+            'live': len(self),
+            'free': len(self.free),
+            'capacity': len(self.cells),
+            'collections': self.collections,
+            'collected': self.collected,
+            'threshold': self.threshold,
+        }
+
+
+def _referents(obj):
+    """Whatever `obj` refers to that could (indirectly) hold a Reference."""
+    if isinstance(obj, (Store, BaseExpr, Language)) or hasattr(type(obj), '_productions'):
+        # The store is traced through references, and the AST and the
+        # languages hold no values
+        return ()
+    if isinstance(obj, FrameType):
+        # The Python stack of evaluate() and compiled code, see
+        # expressions._safe_point
+        return (*obj.f_locals.values(), obj.f_back)
+    if isinstance(obj, dict):
+        return obj.values()
+    if isinstance(obj, (list, tuple, set, frozenset)):
+        return obj
+    if isinstance(obj, FunctionType):
+        # Continuations and compiled code keep their state in closures
+        found = []
+        for cell in obj.__closure__ or ():
+            try:
+                found.append(cell.cell_contents)
+            except ValueError:  # not filled in yet
+                pass
+        return found
+    if isinstance(obj, MethodType):
+        return (obj.__self__,)
+    if isinstance(obj, (type, ModuleType, BuiltinFunctionType)):
+        # Code, not values
+        return ()
+    # Anything else (contexts, frames, procedures, ...), wherever it's defined,
+    # by its attributes
+    found = list(getattr(obj, '__dict__', {}).values())
+    for cls in type(obj).__mro__:
+        slots = cls.__dict__.get('__slots__', ())
+        for name in (slots,) if isinstance(slots, str) else slots:
+            found.append(getattr(obj, name, None))
+    return found
 
 
 @make_list(Expression, ';')
 class ExprList(list):
-    pass
+    __slots__ = ()
 
 
 @generates('begin', Field('expressions', ExprList), 'end')
 @replaces(Expression)
 class BeginEnd(BaseExpr):
+    __slots__ = ()
+    
     def evaluate(self, ctx):
         for e in self.expressions:
             res = e.evaluate(ctx)
         return res
+    
+    def step(self, ctx, stack):
+        expressions = self.expressions
+        last = len(expressions) - 1
+        i = 0
+        def next_expr(_, stack):
+            nonlocal i
+            e = expressions[i]
+            if i < last:
+                i += 1
+                stack.append(next_expr)
+            return e, ctx
+        return next_expr(None, stack)
+    
+    def compile(self, scope):
+        *init, last = [e.compile(scope) for e in self.expressions]
+        def begin(env, ctx):
+            for e in init:
+                e(env, ctx)
+            return last(env, ctx)
+        return begin
+    
+    def specialize(self, scope, counters):
+        *init, last = [e.specialize(scope, counters) for e in self.expressions]
+        return specialize.Begin(tuple(init), last)
+    
+    def emit(self, code, scope, tail=False):
+        *init, last = self.expressions
+        for e in init:
+            e.emit(code, scope)
+            code.emit(vm.POP)
+        last.emit(code, scope, tail)
+    
+    def optimize(self, inline=True):
+        *init, last = [e.optimize(inline) for e in self.expressions]
+        # Only the value of the last expression is used
+        init = [e for e in init if e.has_effects()]
+        if not init:
+            return last
+        self.expressions[:] = [*init, last]
+        return self
+    
+    def has_effects(self):
+        return any(e.has_effects() for e in self.expressions)
         
-    def free_vars(self):
-        for e in self.expressions:
-            yield from e.free_vars()
 
 
 
@@ -52,44 +228,130 @@ class BeginEnd(BaseExpr):
 @generates('newref', '(', Field('init_expr', Expression), ')')
 @replaces(Expression)
 class NewRefExpr(BaseExpr):
+    __slots__ = ()
+    
     def evaluate(self, ctx):
         ref = ctx.store.newref()
         init = self.init_expr.evaluate(ctx)
         ctx.store.setref(ref, init)
         return ref
     
+    def step(self, ctx, stack):
+        ref = ctx.store.newref()
+        def init(val, stack):
+            ctx.store.setref(ref, val)
+            return None, ref
+        stack.append(init)
+        return self.init_expr, ctx
+    
+    def compile(self, scope):
+        init_expr = self.init_expr.compile(scope)
+        def newref(env, ctx):
+            ref = ctx.store.newref()
+            ctx.store.setref(ref, init_expr(env, ctx))
+            return ref
+        return newref
+    
+    def specialize(self, scope, counters):
+        return specialize.NewRef(self.init_expr.specialize(scope, counters))
+    
+    def emit(self, code, scope, tail=False):
+        self.init_expr.emit(code, scope)
+        code.emit(vm.NEWREF)
+    
+    def check_purity(self, procs):
+        super().check_purity(procs)
+        return False
+    
 
 @generates('deref', '(', Field('ref', Expression), ')')
 @replaces(Expression)
 class DeRefExpr(BaseExpr):
+    __slots__ = ()
+    
     def evaluate(self, ctx):
         ref = self.ref.evaluate(ctx)
         assert isinstance(ref, Reference)
         return ctx.store.deref(ref)
+    
+    def step(self, ctx, stack):
+        stack.append(lambda ref, stack: (None, ctx.store.deref(ref)))
+        return self.ref, ctx
+    
+    def compile(self, scope):
+        ref = self.ref.compile(scope)
+        return lambda env, ctx: ctx.store.deref(ref(env, ctx))
+    
+    def specialize(self, scope, counters):
+        return specialize.Deref(self.ref.specialize(scope, counters))
+    
+    def emit(self, code, scope, tail=False):
+        self.ref.emit(code, scope)
+        code.emit(vm.DEREF)
+    
+    def check_purity(self, procs):
+        super().check_purity(procs)
+        return False
 
 
 @generates('setref', '(', Field('ref', Expression), ',', Field('val', Expression), ')')
 @replaces(Expression)
 class SetRefExpr(BaseExpr):
+    __slots__ = ()
+    
     def evaluate(self, ctx):
         ref = self.ref.evaluate(ctx)
         assert isinstance(ref, Reference)
         val = self.val.evaluate(ctx)
         ctx.store.setref(ref, val)
         return val
+    
+    def step(self, ctx, stack):
+        def got_ref(ref, stack):
+            def got_val(val, stack):
+                ctx.store.setref(ref, val)
+                return None, val
+            stack.append(got_val)
+            return self.val, ctx
+        stack.append(got_ref)
+        return self.ref, ctx
+    
+    def compile(self, scope):
+        ref, val = self.ref.compile(scope), self.val.compile(scope)
+        def setref(env, ctx):
+            r = ref(env, ctx)
+            v = val(env, ctx)
+            ctx.store.setref(r, v)
+            return v
+        return setref
+    
+    def specialize(self, scope, counters):
+        return specialize.SetRef(self.ref.specialize(scope, counters), self.val.specialize(scope, counters))
+    
+    def emit(self, code, scope, tail=False):
+        self.ref.emit(code, scope)
+        self.val.emit(code, scope)
+        code.emit(vm.SETREF)
+    
+    def check_purity(self, procs):
+        super().check_purity(procs)
+        return False
 
 
-@dataclass
+@dataclass(slots=True)
 class StoreContext(Context):
     store: Store = field(default_factory=Store)
+    
+    def safe_point(self, *roots):
+        if self.store.wants_collect:
+            self.store.collect(roots)
 
 
 @generates(Field('expr', Expression))
 @upgrades(LetProgram)
-class ExplRefProgram(Start):
-    def evaluate(self):
-        ctx = StoreContext()
-        return self.expr.evaluate(ctx)
+class ExplRefProgram(Program):
+    __slots__ = ()
+    context = StoreContext
 
 
 EXPLICIT_REFS = LETREC.add_types(BeginEnd, ExprList, NewRefExpr, DeRefExpr, SetRefExpr, ExplRefProgram)
@@ -101,27 +363,94 @@ EXPLICIT_REFS = LETREC.add_types(BeginEnd, ExprList, NewRefExpr, DeRefExpr, SetR
 
 @upgrades(Identifier)
 class DerefIdentifier(Identifier):
+    __slots__ = ()
+    
     def evaluate(self, ctx):
         ref = super().evaluate(ctx)
         return ctx.store.deref(ref)
+    
+    def compile(self, scope):
+        lookup = super().compile(scope)
+        return lambda env, ctx: ctx.store.deref(lookup(env, ctx))
+    
+    def specialize(self, scope, counters):
+        return specialize.Deref(super().specialize(scope, counters))
+    
+    def emit(self, code, scope, tail=False):
+        super().emit(code, scope)
+        code.emit(vm.DEREF)
+    
+    def check_purity(self, procs):
+        return False
 
 
 @generates('set', Field('var', RawIdentifier), '=', Field('value', Expression))
 @replaces(Expression)
 class ImplicitSetRef(BaseExpr):
+    __slots__ = ()
+    _instance_attrs = ('fetch',)
+    # Gets the reference out of the Frame, set by resolve()
+    fetch = None
+    
+    def reference(self, ctx):
+        if self.fetch is None:
+            # Not resolved (see Program.evaluate)
+            return ctx.env.lookup(self.var)
+        return self.fetch(ctx.env)
+    
     def evaluate(self, ctx):
-        ref = ctx.env[self.var]
+        ref = self.reference(ctx)
         val = self.value.evaluate(ctx)
         ctx.store.setref(ref, val)
         return val
     
-    def free_vars(self):
-        yield self.var
-        yield from self.value.free_vars()
+    def resolve(self, scope):
+        self.fetch = scope.fetcher(self.var)
+        self.value.resolve(scope)
+    
+    def step(self, ctx, stack):
+        ref = self.reference(ctx)
+        def got_val(val, stack):
+            ctx.store.setref(ref, val)
+            return None, val
+        stack.append(got_val)
+        return self.value, ctx
+    
+    def compile(self, scope):
+        fetch, value = scope.fetcher(self.var), self.value.compile(scope)
+        def set_(env, ctx):
+            ref = fetch(env)
+            val = value(env, ctx)
+            ctx.store.setref(ref, val)
+            return val
+        return set_
+    
+    def specialize(self, scope, counters):
+        return specialize.SetVariable(scope.fetcher(self.var), self.value.specialize(scope, counters))
+    
+    def emit(self, code, scope, tail=False):
+        Identifier(name=self.var).emit(code, scope)
+        self.value.emit(code, scope)
+        code.emit(vm.SETREF)
+    
+    def check_purity(self, procs):
+        self.value.check_purity(procs)
+        return False
+    
+    def analyze(self):
+        self.fvs = self.value.analyze() | {self.var}
+        return self.fvs
+    
+    def count_uses(self, name):
+        if self.var == name:
+            return float('inf')
+        return self.value.count_uses(name)
 
 
 @upgrades(CallExpr)
 class CallByReferenceExpr(CallExpr):
+    __slots__ = ()
+    
     # The default CallExpr will evaluate the argument, then store it and pass
     # the resulting reference to Procedure.call (through ctx.wrap).
     # This is different, we don't need to add a new store if we're passing
@@ -129,41 +458,279 @@ class CallByReferenceExpr(CallExpr):
     def evaluate(self, ctx):
         proc = self.proc.evaluate(ctx)
         if isinstance(self.arg, DerefIdentifier):
-            arg = ctx.env[self.arg.name]
+            # The reference itself, not what it points to
+            arg = Identifier.evaluate(self.arg, ctx)
         else:
             arg = ctx.wrap(self.arg.evaluate(ctx))
         return proc.call(arg, ctx)
+    
+    def step(self, ctx, stack):
+        def got_proc(proc, stack):
+            if isinstance(self.arg, DerefIdentifier):
+                return proc.enter(Identifier.evaluate(self.arg, ctx), ctx)
+            stack.append(lambda arg, stack: proc.enter(ctx.wrap(arg), ctx))
+            return self.arg, ctx
+        stack.append(got_proc)
+        return self.proc, ctx
+    
+    def compile(self, scope):
+        proc = self.proc.compile(scope)
+        if isinstance(self.arg, DerefIdentifier):
+            # The reference itself, not what it points to
+            ref = Identifier.compile(self.arg, scope)
+            return lambda env, ctx: proc(env, ctx).run(ref(env, ctx), env, ctx)
+        arg = self.arg.compile(scope)
+        def call(env, ctx):
+            # In a local, where a safe point sees it (see expressions._safe_point)
+            p = proc(env, ctx)
+            return p.run(ctx.wrap(arg(env, ctx)), env, ctx)
+        return call
+    
+    def specialize(self, scope, counters):
+        if not isinstance(self.arg, DerefIdentifier):
+            return super().specialize(scope, counters)
+        proc = self.proc.specialize(scope, counters)
+        return specialize.CallNode(proc, Identifier.specialize(self.arg, scope, counters), False, counters)
+    
+    def emit(self, code, scope, tail=False):
+        if not isinstance(self.arg, DerefIdentifier):
+            return super().emit(code, scope, tail)
+        self.proc.emit(code, scope)
+        Identifier.emit(self.arg, code, scope)
+        code.emit(vm.TAIL_CALL if tail else vm.CALL)
+    
+    def count_uses(self, name):
+        if isinstance(self.arg, DerefIdentifier) and self.arg.name == name:
+            # The procedure gets the reference, and may assign to it
+            return float('inf')
+        return super().count_uses(name)
 
 
 class ImplicitStoreContext(StoreContext):
+    __slots__ = ()
+    
     def wrap(self, val):
         ref = self.store.newref()
         self.store.setref(ref, val)
         return ref
     
-    def with_layer(self, l):
-        assert all(isinstance(v, Reference) for v in l.values()), f"Environment contains non-references!"
-        return super().with_layer(l)
+    def bind(self, names, values, env=None):
+        if self.debug and not all(isinstance(v, Reference) for v in values):
+            raise Exception(f"Binding non-references: {dict(zip(names, values))}")
+        return self.with_env(Frame(names, values, self.env if env is None else env))
 
 
 @generates(Field('expr', Expression))
 @upgrades(LetProgram)
-class ImplRefProgram(Start):
-    def evaluate(self):
-        ctx = ImplicitStoreContext()
-        return self.expr.evaluate(ctx)
+class ImplRefProgram(Program):
+    __slots__ = ()
+    context = ImplicitStoreContext
 
 
 IMPLICIT_REFS = LETREC.add_types(BeginEnd, ExprList, DerefIdentifier, ImplicitSetRef, CallByReferenceExpr, ImplRefProgram)
 
 
+
+# CALL_BY_NEED: Lazy Evaluation
+# ==================================================
+
+# Let bindings and procedure arguments are stored as thunks: the expression and
+# the environment to evaluate it in. The first time a variable is read, its
+# thunk is forced and the reference gets the value instead, so it runs at most
+# once. Each backend has its own kind of thunk, like with procedures.
+
+class Thunk:
+    __slots__ = ('code', 'env')
+    
+    def __init__(self, code, env):
+        self.code = code
+        self.env = env
+    
+    def force(self, ctx):
+        # An expression and its Context
+        return self.code.evaluate(self.env)
+
+
+class CompiledThunk(Thunk):
+    __slots__ = ()
+    
+    def force(self, ctx):
+        # A closure and its Frame
+        return self.code(self.env, ctx)
+
+
+class SpecializedThunk(Thunk):
+    __slots__ = ()
+    
+    def force(self, ctx):
+        # A node (see eopl.specialize) and its Frame
+        return self.code.execute(self.env, ctx)
+
+
+def _is_value(expr):
+    # Nothing to save by delaying these, and they can't fail
+    return isinstance(expr, (Constant, DynProcExpr))
+
+
+class NeedContext(ImplicitStoreContext):
+    __slots__ = ()
+    
+    def force(self, ref):
+        """The value `ref` points to, forcing (and replacing) the thunk there if needed."""
+        val = self.store.deref(ref)
+        if isinstance(val, Thunk):
+            val = val.force(self)
+            self.store.setref(ref, val)
+        return val
+
+
+@upgrades(DerefIdentifier)
+class NeedIdentifier(DerefIdentifier):
+    __slots__ = ()
+    
+    def evaluate(self, ctx):
+        return ctx.force(Identifier.evaluate(self, ctx))
+    
+    def step(self, ctx, stack):
+        ref = Identifier.evaluate(self, ctx)
+        val = ctx.store.deref(ref)
+        if not isinstance(val, Thunk):
+            return None, val
+        def got_val(val, stack):
+            ctx.store.setref(ref, val)
+            return None, val
+        stack.append(got_val)
+        return val.code, val.env
+    
+    def compile(self, scope):
+        lookup = Identifier.compile(self, scope)
+        return lambda env, ctx: ctx.force(lookup(env, ctx))
+    
+    def specialize(self, scope, counters):
+        return specialize.Force(Identifier.specialize(self, scope, counters))
+    
+    def emit(self, code, scope, tail=False):
+        raise Exception("The bytecode compiler doesn't support call by need")
+    
+    def can_vectorize(self):
+        return False
+
+
+@upgrades(LetExpr)
+class LazyLetExpr(LetExpr):
+    __slots__ = ()
+    
+    def delay(self, ctx):
+        return ctx.bind(self.var_names, [ctx.wrap(ass.value.evaluate(ctx) if _is_value(ass.value)
+                                                  else Thunk(ass.value, ctx))
+                                         for ass in self.assignments])
+    
+    def evaluate(self, ctx):
+        return self.expr.evaluate(self.delay(ctx))
+    
+    def step(self, ctx, stack):
+        return self.expr, self.delay(ctx)
+    
+    def compile(self, scope):
+        names = tuple(ass.var for ass in self.assignments)
+        values = [(ass.value.compile(scope), _is_value(ass.value)) for ass in self.assignments]
+        body = self.expr.compile(scope.extend(names))
+        def let(env, ctx):
+            return body(Frame(names, tuple([ctx.wrap(code(env, ctx) if is_value else CompiledThunk(code, env))
+                                            for code, is_value in values]), env), ctx)
+        return let
+    
+    def specialize(self, scope, counters):
+        names = tuple(ass.var for ass in self.assignments)
+        values = tuple(ass.value.specialize(scope, counters) if _is_value(ass.value)
+                       else specialize.Delay(SpecializedThunk, ass.value.specialize(scope, counters))
+                       for ass in self.assignments)
+        return specialize.Let(names, values, self.expr.specialize(scope.extend(names), counters))
+    
+    def emit(self, code, scope, tail=False):
+        raise Exception("The bytecode compiler doesn't support call by need")
+    
+    def can_vectorize(self):
+        # Vectorizing evaluates every binding, used or not
+        return False
+
+
+@upgrades(CallByReferenceExpr)
+class CallByNeedExpr(CallByReferenceExpr):
+    __slots__ = ()
+    
+    # Variables are still passed by reference (and share their thunk), other
+    # arguments are passed as a thunk
+    def lazy(self):
+        return not (isinstance(self.arg, DerefIdentifier) or _is_value(self.arg))
+    
+    def evaluate(self, ctx):
+        if not self.lazy():
+            return super().evaluate(ctx)
+        proc = self.proc.evaluate(ctx)
+        return proc.call(ctx.wrap(Thunk(self.arg, ctx)), ctx)
+    
+    def step(self, ctx, stack):
+        if not self.lazy():
+            return super().step(ctx, stack)
+        stack.append(lambda proc, stack: proc.enter(ctx.wrap(Thunk(self.arg, ctx)), ctx))
+        return self.proc, ctx
+    
+    def compile(self, scope):
+        if not self.lazy():
+            return super().compile(scope)
+        proc, arg = self.proc.compile(scope), self.arg.compile(scope)
+        return lambda env, ctx: proc(env, ctx).run(ctx.wrap(CompiledThunk(arg, env)), env, ctx)
+    
+    def specialize(self, scope, counters):
+        if not self.lazy():
+            return super().specialize(scope, counters)
+        arg = specialize.Delay(SpecializedThunk, self.arg.specialize(scope, counters))
+        return specialize.CallNode(self.proc.specialize(scope, counters), arg, True, counters)
+    
+    def emit(self, code, scope, tail=False):
+        if not self.lazy():
+            return super().emit(code, scope, tail)
+        raise Exception("The bytecode compiler doesn't support call by need")
+
+
+@generates(Field('expr', Expression))
+@upgrades(LetProgram)
+class NeedProgram(Program):
+    __slots__ = ()
+    context = NeedContext
+
+
+CALL_BY_NEED = LETREC.add_types(BeginEnd, ExprList, NeedIdentifier, ImplicitSetRef, CallByNeedExpr,
+                                LazyLetExpr, NeedProgram)
+
+
+# Every language we ship, by name
+LANGUAGES = {
+    'LET': LET,
+    'PROC': PROC,
+    'DYNPROC': DYNPROC,
+    'LETREC': LETREC,
+    'EXPLICIT_REFS': EXPLICIT_REFS,
+    'IMPLICIT_REFS': IMPLICIT_REFS,
+    'CALL_BY_NEED': CALL_BY_NEED,
+}
+
+
 # Tests
 # ===============================================
 
+import sys
+import threading
 import unittest
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from unittest import mock
+
+from eopl import expressions, serialize
 
 
-class ExplicitRefsTest(unittest.TestCase):
+class ExplicitRefsTest(LanguageTest):
     def test_simple(self):
         s = """
         let g = 
@@ -175,11 +742,11 @@ class ExplicitRefsTest(unittest.TestCase):
         in let a = g(11); b = g(11)
         in a - b
         """
-        res = EXPLICIT_REFS.parse(s).evaluate()
+        res = self.run_program(EXPLICIT_REFS, s)
         self.assertEqual(res, -1)
 
 
-class ImplicitRefsTest(unittest.TestCase):
+class ImplicitRefsTest(LanguageTest):
     def test_simple(self):
         s = """
         let g = 
@@ -191,7 +758,7 @@ class ImplicitRefsTest(unittest.TestCase):
         in let a = g(11); b = g(11)
         in a - b
         """
-        res = IMPLICIT_REFS.parse(s).evaluate()
+        res = self.run_program(IMPLICIT_REFS, s)
         self.assertEqual(res, -1)
     
     def test_cbr(self):
@@ -205,9 +772,458 @@ class ImplicitRefsTest(unittest.TestCase):
                     foo + bar
                 end
         """
-        res = IMPLICIT_REFS.parse(s).evaluate()
+        res = self.run_program(IMPLICIT_REFS, s)
         self.assertEqual(res, 50)
 
 
+class CallByNeedTest(LanguageTest):
+    def test_unused(self):
+        # Never evaluated, so no division by zero
+        s = "let count = 0 in let x = begin set count = count + 1; 1 / 0 end in count"
+        self.assertEqual(self.run_program(CALL_BY_NEED, s), 0)
+        s = "let f = proc (x) 5 in f(1 / 0)"
+        self.assertEqual(self.run_program(CALL_BY_NEED, s), 5)
+    
+    def test_once(self):
+        # Forced when first needed, not before (and not again)
+        s = """
+        let count = 0 in
+        let x = begin set count = count + 1; 5 end in
+        begin set count = count * 10; x + x + count end
+        """
+        self.assertEqual(self.run_program(CALL_BY_NEED, s), 11)
+        s = """
+        let count = 0 in
+        let twice = proc (a) a + a in
+        twice(begin set count = count + 1; count end)
+        """
+        self.assertEqual(self.run_program(CALL_BY_NEED, s), 2)
+    
+    def test_shared(self):
+        # A variable passes its reference, and with that its thunk
+        s = """
+        let count = 0 in
+        let x = begin set count = count + 1; 20 end in
+        let f = proc (y) y + 1 in
+        f(x) + x + count
+        """
+        self.assertEqual(self.run_program(CALL_BY_NEED, s), 42)
+    
+    def test_recursion(self):
+        s = """
+        letrec loop(n) = if n == 0 then 0 else loop(n - 1);
+               fact(n) = if n == 0 then 1 else n * fact(n - 1)
+        in let unused = loop(100000); used = fact(5) in used
+        """
+        self.assertEqual(self.run_program(CALL_BY_NEED, s), 120)
+
+
+class ExplicitRefsCompiledTest(CompiledMixin, ExplicitRefsTest): pass
+class ImplicitRefsCompiledTest(CompiledMixin, ImplicitRefsTest): pass
+class ExplicitRefsStackSafeTest(StackSafeMixin, ExplicitRefsTest): pass
+class ImplicitRefsStackSafeTest(StackSafeMixin, ImplicitRefsTest): pass
+class ExplicitRefsVMTest(VMMixin, ExplicitRefsTest): pass
+class ImplicitRefsVMTest(VMMixin, ImplicitRefsTest): pass
+class ExplicitRefsOptimizedTest(OptimizedMixin, ExplicitRefsTest): pass
+class ImplicitRefsOptimizedTest(OptimizedMixin, ImplicitRefsTest): pass
+class ExplicitRefsSerializedTest(SerializedMixin, ExplicitRefsTest): pass
+class ImplicitRefsSerializedTest(SerializedMixin, ImplicitRefsTest): pass
+class ExplicitRefsPrattTest(PrattMixin, ExplicitRefsTest): pass
+class ImplicitRefsPrattTest(PrattMixin, ImplicitRefsTest): pass
+class ExplicitRefsSpecializedTest(SpecializedMixin, ExplicitRefsTest): pass
+class ImplicitRefsSpecializedTest(SpecializedMixin, ImplicitRefsTest): pass
+class CallByNeedCompiledTest(CompiledMixin, CallByNeedTest): pass
+class CallByNeedStackSafeTest(StackSafeMixin, CallByNeedTest): pass
+class CallByNeedOptimizedTest(OptimizedMixin, CallByNeedTest): pass
+class CallByNeedSerializedTest(SerializedMixin, CallByNeedTest): pass
+class CallByNeedPrattTest(PrattMixin, CallByNeedTest): pass
+class CallByNeedSpecializedTest(SpecializedMixin, CallByNeedTest): pass
+
+
+class ForceTest(unittest.TestCase):
+    """Every thunk is forced exactly once, whatever runs the program."""
+    
+    def forced(self, run):
+        # How often each thunk was forced
+        counts = {}
+        def patch(cls):
+            def force(thunk, ctx, _force=cls.force):
+                counts[id(thunk)] = counts.get(id(thunk), 0) + 1
+                return _force(thunk, ctx)
+            return mock.patch.object(cls, 'force', force)
+        with patch(Thunk), patch(CompiledThunk), patch(SpecializedThunk):
+            result = run()
+        return result, sorted(counts.values())
+    
+    def check(self, s, result, thunks):
+        prog = CALL_BY_NEED.parse(s)
+        for run in [prog.evaluate, prog.compile(), prog.specialize()]:
+            self.assertEqual(self.forced(run), (result, [1] * thunks))
+        # The stack safe evaluator forces thunks itself, without Thunk.force
+        self.assertEqual(prog.evaluate(stack_safe=True), result)
+    
+    def test_let(self):
+        self.check("let x = 1 + 2; y = 3 * 4; z = 1 / 0 in x * x + y * x", 45, 2)
+    
+    def test_call(self):
+        s = "let f = proc (a) a * a * a in let g = proc (b) f(b) + f(b) in g(1 + 1)"
+        # f gets g's b by reference, so only g's argument is a thunk
+        self.check(s, 16, 1)
+    
+    def test_nested(self):
+        s = "let x = 2 in let y = x * x in let z = y + y in z * z"
+        self.check(s, 64, 2)
+    
+    def test_vm(self):
+        with self.assertRaisesRegex(Exception, "doesn't support call by need"):
+            CALL_BY_NEED.parse("let x = 1 + 1 in x").assemble()
+
+
+class MemoizeRefsTest(unittest.TestCase):
+    def test_store_is_impure(self):
+        s = """
+        let calls = newref(0) in
+        letrec count(i) = begin setref(calls, deref(calls) + 1); i end;
+               pure(i) = i * 2
+        in count(1) + count(1) + pure(3) + pure(3) + deref(calls)
+        """
+        memo = LRUCache()
+        self.assertEqual(EXPLICIT_REFS.parse(s).evaluate(memo=memo), 16)
+        self.assertEqual((memo.hits, memo.misses), (1, 1))
+        
+    def test_implicit(self):
+        s = "letrec double(i) = i * 2 in double(2) + double(2)"
+        memo = LRUCache()
+        self.assertEqual(IMPLICIT_REFS.parse(s).evaluate(memo=memo), 8)
+        self.assertEqual(len(memo), 0)
+
+
+class OptimizeRefsTest(unittest.TestCase):
+    def test_effects_kept(self):
+        s = "let r = newref(1) in begin 2 + 3; setref(r, 5); 7; deref(r) end"
+        prog = EXPLICIT_REFS.parse(s, optimize=True)
+        self.assertEqual(len(prog.expr.expr.expressions), 2)
+        self.assertEqual(prog.evaluate(), 5)
+    
+    def test_assigned_not_inlined(self):
+        s = "let x = 1 in begin set x = x + 1; 0 end"
+        prog = IMPLICIT_REFS.parse(s, optimize=True)
+        self.assertIsInstance(prog.expr, LetExpr)
+        s = "let x = 1 in letrec f(y) = set y = 2 in begin f(x); x end"
+        self.assertEqual(IMPLICIT_REFS.parse(s, optimize=True).evaluate(), 2)
+    
+    def test_by_reference(self):
+        s = """
+        let x = 0 in
+        let inc = proc (y) set y = y + 1 in
+        letrec loop(i) = if i == 0 then 0 else begin inc(x); loop(i - 1) end
+        in begin loop(3); 5 end
+        """
+        prog = IMPLICIT_REFS.parse(s, optimize=True)
+        self.assertEqual([ass.var for ass in prog.expr.assignments], ['x'])
+
+
+class FreeVarsRefsTest(unittest.TestCase):
+    def test_set_and_begin(self):
+        prog = IMPLICIT_REFS.parse("let f = proc (x) begin set a = x; b end in f(1)")
+        self.assertEqual(prog.expr.fvs, {'a', 'b'})
+
+
+class StoreTest(unittest.TestCase):
+    def run_collecting(self, lang, s, threshold):
+        prog = lang.parse(s)
+        ctx = prog.context(store=Store(threshold=threshold))
+        return trampoline(prog.expr, ctx), ctx.store
+    
+    def test_free_list(self):
+        store = Store()
+        a, b = store.newref(), store.newref()
+        store.setref(a, 1)
+        store.setref(b, b)
+        self.assertEqual(store.collect([a]), 1)
+        self.assertEqual(store.newref(), b)
+        self.assertEqual(store.deref(a), 1)
+        self.assertEqual(store.stats()['allocated'], 3)
+    
+    def test_any_module(self):
+        # Roots are traced by their attributes, wherever they're defined
+        class Slotted:
+            __slots__ = ('ref',)
+        Slotted.__module__ = 'user'
+        store = Store()
+        a, b = store.newref(), store.newref()
+        slotted = Slotted()
+        slotted.ref = a
+        self.assertEqual(store.collect([slotted, SimpleNamespace(ref=[b])]), 0)
+        self.assertEqual(store.collect([slotted]), 1)
+        with self.assertRaisesRegex(Exception, "Dangling reference"):
+            store.deref(b)
+    
+    def test_bounded(self):
+        s = """
+        let count = 0 in
+        letrec loop(i) = if i == 0 then count else begin set count = count + i; loop(i - 1) end
+        in loop(5000)
+        """
+        res, store = self.run_collecting(IMPLICIT_REFS, s, 100)
+        self.assertEqual(res, 5000 * 5001 // 2)
+        stats = store.stats()
+        self.assertGreater(stats['collections'], 10)
+        self.assertLess(stats['capacity'], 300)
+    
+    def test_live(self):
+        s = """
+        let c = newref(0); keep = newref(newref(7)) in
+        letrec loop(i) = if i == 0 then deref(c) + deref(deref(keep)) else
+            begin setref(c, deref(c) + deref(newref(i))); loop(i - 1) end
+        in loop(1000)
+        """
+        res, store = self.run_collecting(EXPLICIT_REFS, s, 50)
+        self.assertEqual(res, 1000 * 1001 // 2 + 7)
+        self.assertLess(store.stats()['capacity'], 150)
+
+
+class StoreEvaluateTest(StoreTest):
+    def run_collecting(self, lang, s, threshold):
+        prog = lang.parse(s)
+        ctx = prog.context(store=Store(threshold=threshold))
+        return self.recursive(lambda: prog.expr.evaluate(ctx)), ctx.store
+    
+    def recursive(self, run):
+        # Deep recursion on the Python stack, with a safe point every 16 calls
+        limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(max(limit, 100000))
+        try:
+            with mock.patch.multiple(expressions, SAFE_POINT_INTERVAL=16, _calls_left=16):
+                return run()
+        finally:
+            sys.setrecursionlimit(limit)
+    
+    def test_bounded(self):
+        # The recursion keeps the variables of its calls, but not what the
+        # calls in between leave behind
+        s = """
+        let count = 0 in
+        letrec waste(j) = if j == 0 then 1 else let x = j in waste(j - 1);
+               loop(i) = if i == 0 then count else begin set count = count + waste(20); loop(i - 1) end
+        in loop(500)
+        """
+        res, store = self.run_collecting(IMPLICIT_REFS, s, 100)
+        self.assertEqual(res, 500)
+        stats = store.stats()
+        self.assertGreater(stats['collections'], 5)
+        self.assertLess(stats['capacity'], stats['allocated'] / 5)
+    
+    def test_partial_results(self):
+        # The values of a let so far and the first operand live on while the
+        # rest is evaluated, and the calls there collect
+        s = """
+        letrec churn(i) = if i == 0 then 0 else let x = newref(i) in churn(i - 1) in
+        let a = newref(1); b = churn(200); c = newref(2) in
+        let p = proc (x) deref(a) + deref(c) in
+        (p)(churn(200)) + (deref(a) + churn(200)) + deref(c)
+        """
+        res, store = self.run_collecting(EXPLICIT_REFS, s, 20)
+        self.assertEqual(res, 6)
+        self.assertGreater(store.stats()['collections'], 2)
+
+
+class StoreCompiledTest(StoreEvaluateTest):
+    def run_collecting(self, lang, s, threshold):
+        prog = lang.parse(s)
+        ctx = prog.context(store=Store(threshold=threshold))
+        code = prog.expr.compile(Scope())
+        return self.recursive(lambda: code(Frame((), (), None), ctx)), ctx.store
+
+
+class StoreVMTest(StoreTest):
+    def run_collecting(self, lang, s, threshold):
+        code = lang.parse(s).assemble()
+        ctx = code.context(store=Store(threshold=threshold))
+        # The machine only stops for garbage collection on calls
+        with mock.patch.object(vm, 'SAFE_POINT_INTERVAL', 16):
+            return code.run(ctx), ctx.store
+
+
+class SerializeTest(unittest.TestCase):
+    PROGRAMS = {
+        'DYNPROC': 'let f = proc (x) x + y; y = 2 in if not (1 < 2) then -1 else f(3) * 4',
+        'LETREC': """
+            letrec even(i) = if i == 0 then true else odd(i - 1);
+                   odd(i) = if i == 0 then false else even(i - 1)
+            in let s = "text"; n = 3000 in
+            if even(4) and (1 <= 2 or 3 >= 4) and 1 != 2 and 1 == 1 and 4 > 3
+            then (n / 7 - n mod 7) else s
+        """,
+        'EXPLICIT_REFS': """
+            let r = newref(0) in begin setref(r, deref(r) + 1); deref(r) end
+        """,
+        'IMPLICIT_REFS': """
+            let x = 0; f = proc (y) set y = 7 in
+            letrec g(z) = z in begin set x = 1; f(x); g(x) end
+        """,
+        'CALL_BY_NEED': """
+            let x = 1 + 1; f = proc (y) y * y in f(x + 1) + x
+        """,
+    }
+    
+    def roundtrip(self, lang, prog):
+        loaded = lang.loads(lang.dumps(prog))
+        self.assertEqual(loaded, prog)
+        self.assertEqual(loaded.evaluate(), prog.evaluate())
+        return loaded
+    
+    def test_every_node_type(self):
+        def types(obj):
+            yield type(obj)
+            if isinstance(obj, list):
+                children = obj
+            else:
+                children = [getattr(obj, name) for name in getattr(obj, '_fields', None) or ()]
+            for child in children:
+                yield from types(child)
+        seen = set()
+        for name, s in self.PROGRAMS.items():
+            lang = LANGUAGES[name]
+            seen.update(types(self.roundtrip(lang, lang.parse(s))))
+        # Every class that makes nodes, in any of the languages
+        expected = {t for lang in LANGUAGES.values() for t in lang.types
+                    if t._fields is not None or issubclass(t, list)}
+        self.assertEqual({t.__name__ for t in expected - seen}, set())
+    
+    def test_deep(self):
+        s = "let x = 1 in " + "(" * 300 + "x" + " + 1)" * 300
+        prog = self.roundtrip(LET, LET.parse(s))
+        self.assertEqual(prog.evaluate(), 301)
+    
+    def test_optimized(self):
+        s = "letrec f(x) = if false then 1 / 0 else x * (2 + 3) in f(2)"
+        self.roundtrip(LETREC, LETREC.parse(s, optimize=True))
+    
+    def test_mismatch(self):
+        data = LETREC.dumps(LETREC.parse("letrec f(x) = x in f(1)"))
+        with self.assertRaisesRegex(Exception, "different language"):
+            IMPLICIT_REFS.loads(data)
+        with self.assertRaisesRegex(Exception, "different language"):
+            LETREC.add_types(NewRefExpr).loads(data)
+        self.assertEqual(LETREC.add_types().loads(data).evaluate(), 1)
+        with self.assertRaisesRegex(Exception, "Not a stored eopl program"):
+            LETREC.loads(b'garbage' + data)
+        with self.assertRaisesRegex(Exception, "Can't store"):
+            LET.dumps(LETREC.parse("letrec f(x) = x in f(1)"))
+    
+    def test_corrupt(self):
+        data = LETREC.dumps(LETREC.parse(self.PROGRAMS['LETREC']))
+        # Magic, version and fingerprint
+        header = len(serialize.MAGIC) + 2 + serialize._FINGERPRINT_SIZE
+        for end in [8, header, header + 1, len(data) // 2, len(data) - 1]:
+            with self.assertRaisesRegex(Exception, "Stored program is corrupt"):
+                LETREC.loads(data[:end])
+        with self.assertRaisesRegex(Exception, "Stored program is corrupt"):
+            LETREC.loads(data[:header] + b'garbage')
+    
+    def test_no_parser(self):
+        data = EXPLICIT_REFS.dumps(EXPLICIT_REFS.parse("let r = newref(1) in deref(r)"))
+        lang = EXPLICIT_REFS.add_types()
+        self.assertEqual(lang.loads(data).evaluate(), 1)
+        self.assertFalse(hasattr(lang, '_lazy_table'))
+
+
+class StackSafeRefsTest(unittest.TestCase):
+    def test_begin_tail(self):
+        s = """
+        let count = 0 in
+        letrec loop(i) = if i == 0 then count else begin set count = count + i; loop(i - 1) end
+        in loop(20000)
+        """
+        self.assertEqual(IMPLICIT_REFS.parse(s).evaluate(stack_safe=True), 20000 * 20001 // 2)
+
+
+class ContextTest(unittest.TestCase):
+    def test_with_env(self):
+        for cls in [Context, StoreContext, ImplicitStoreContext, NeedContext]:
+            ctx = cls(memo=LRUCache())
+            sub = ctx.bind(('x', 'y'), (1, 2))
+            self.assertIs(type(sub), cls)
+            self.assertIs(sub.memo, ctx.memo)
+            self.assertIs(getattr(sub, 'store', None), getattr(ctx, 'store', None))
+            self.assertEqual(sub.env.lookup('y'), 2)
+            self.assertIs(sub.env.parent, ctx.env)
+            self.assertIs(ctx.env, Context().env)
+
+    def test_shadowing(self):
+        for lang in [LETREC, IMPLICIT_REFS]:
+            self.assertEqual(lang.parse("let x = 1 in let x = 2; y = x in let x = x + y in x").evaluate(), 3)
+            self.assertEqual(lang.parse("let x = 1 in letrec x(y) = y in x(4)").evaluate(), 4)
+            # Like a dict, the last binding wins
+            self.assertEqual(lang.parse("let x = 1; x = 2 in x").evaluate(), 2)
+
+    def test_debug(self):
+        ctx = ImplicitStoreContext()
+        # Only checked when debugging
+        ctx.bind(('x',), (1,))
+        ctx.debug = True
+        ctx.bind(('x',), (ctx.wrap(1),))
+        with self.assertRaisesRegex(Exception, "non-references"):
+            ctx.bind(('x',), (1,))
+        s = "let x = 1 in letrec f(y) = if y == 0 then x else f(y - 1) in f(5)"
+        self.assertEqual(IMPLICIT_REFS.parse(s).evaluate(debug=True), 1)
+
+
+class ThreadedParseTest(unittest.TestCase):
+    THREADS = 8
+
+    @staticmethod
+    def programs():
+        for i in range(20):
+            yield f"let r = newref({i}) in begin " + "; ".join(
+                f"setref(r, deref(r) * {j} + {i})" for j in range(i % 7 + 1)) + " end"
+            yield "letrec " + "; ".join(
+                f"f{j}(x) = if x == {j} then {i} else f{(j + 1) % 3}(x - 1)" for j in range(3)) + f" in f0({i})"
+            yield f"let x{i} = proc (y) y - {i} in x{i}({i} * 2)" if i % 5 == 0 else f"{i} - x * ({i} + 1)"
+
+    def check(self, lang):
+        texts = list(self.programs())
+        expected = [EXPLICIT_REFS.parse(text) for text in texts]
+        barrier = threading.Barrier(self.THREADS)
+        parsers = set()
+
+        def parse_all(offset):
+            # Start together, so the first parses race to build the parser
+            barrier.wait()
+            if lang.backend == 'parglare':
+                parsers.add(id(lang.parser))
+            n = len(texts)
+            return [(i % n, lang.parse(texts[i % n])) for i in range(offset, offset + 2 * n)]
+
+        # Switch threads often, so they're in the middle of parses together
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            with ThreadPoolExecutor(self.THREADS) as pool:
+                results = list(pool.map(parse_all, range(0, self.THREADS * 7, 7)))
+        finally:
+            sys.setswitchinterval(interval)
+        for result in results:
+            for i, prog in result:
+                self.assertEqual(prog, expected[i], texts[i])
+        return parsers
+
+    def test_parglare(self):
+        # A new language, so the grammar and table are built by the threads
+        parsers = self.check(EXPLICIT_REFS.add_types())
+        self.assertEqual(len(parsers), self.THREADS)
+
+    def test_pratt(self):
+        self.check(EXPLICIT_REFS.add_types(backend='pratt'))
+
+    def test_parse_cache(self):
+        lang = EXPLICIT_REFS.add_types()
+        cache = lang.enable_parse_cache(maxsize=16)
+        self.check(lang)
+        self.assertEqual(len(cache), 16)
+        self.assertEqual(cache.hits + cache.misses, self.THREADS * 2 * len(list(self.programs())))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,6 +1,8 @@
 
+import sys
+import threading
 from pprint import PrettyPrinter
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 
 
 class multimap(defaultdict):
@@ -36,15 +38,119 @@ class multimap(defaultdict):
         return d
 
 
-def lazyprop(fn):
-    attr_name = '_lazy_' + fn.__name__
-    @property
-    def _lazyprop(self):
-        if not hasattr(self, attr_name):
-            setattr(self, attr_name, fn(self))
-        return getattr(self, attr_name)
-    return _lazyprop
+class lazyprop(property):
+    """A property that is computed once, then kept in the attribute `attr_name`
+    (which classes with __slots__ need a slot for).
     
+    Threads that ask for it at the same time wait for one of them to compute
+    it; once it's there, getting it doesn't lock."""
+    
+    def __init__(self, fn):
+        attr_name = self.attr_name = '_lazy_' + fn.__name__
+        lock = threading.RLock()
+        def get(obj):
+            if not hasattr(obj, attr_name):
+                with lock:
+                    if not hasattr(obj, attr_name):
+                        setattr(obj, attr_name, fn(obj))
+            return getattr(obj, attr_name)
+        super().__init__(get, doc=fn.__doc__)
+    
+
+class LRUCache:
+    """A mapping that only keeps the `maxsize` most recently used items, and
+    counts how often it was (un)successfully looked in.
+    
+    Items can be given a size in bytes when they're put in, then the cache
+    also keeps their total under `maxbytes`. It can be used from several
+    threads at once.
+    """
+    
+    def __init__(self, maxsize=4096, maxbytes=None):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.data = OrderedDict()
+        self.sizes = {}
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+    
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self.data.move_to_end(key)
+            self.hits += 1
+            return value
+    
+    def put(self, key, value, size=0):
+        with self.lock:
+            self.bytes -= self.sizes.pop(key, 0)
+            self.data[key] = value
+            self.data.move_to_end(key)
+            if size:
+                self.sizes[key] = size
+                self.bytes += size
+            while self.data and ((self.maxsize is not None and len(self.data) > self.maxsize)
+                                 or (self.maxbytes is not None and self.bytes > self.maxbytes)):
+                old, _ = self.data.popitem(last=False)
+                self.bytes -= self.sizes.pop(old, 0)
+                self.evictions += 1
+    
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.sizes.clear()
+            self.bytes = 0
+    
+    def __len__(self):
+        return len(self.data)
+    
+    def __contains__(self, key):
+        return key in self.data
+    
+    def stats(self):
+        return {
+            'size': len(self.data),
+            'maxsize': self.maxsize,
+            'bytes': self.bytes,
+            'maxbytes': self.maxbytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+def deep_sizeof(obj):
+    """Approximate memory used by `obj` and everything it refers to (that isn't
+    shared with other objects: classes, functions and modules aren't counted)."""
+    seen = set()
+    total = 0
+    todo = [obj]
+    while todo:
+        obj = todo.pop()
+        if id(obj) in seen or isinstance(obj, (type, type(sys), type(deep_sizeof))):
+            continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            todo.extend(obj.keys())
+            todo.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            todo.extend(obj)
+        if hasattr(obj, '__dict__'):
+            todo.append(obj.__dict__)
+        for cls in type(obj).__mro__:
+            for name in getattr(cls, '__slots__', ()):
+                if hasattr(obj, name):
+                    todo.append(getattr(obj, name))
+    return total
+
 
 _pretty_printer = PrettyPrinter(indent=2, width=100)
 
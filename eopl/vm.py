@@ -0,0 +1,326 @@
+"""Bytecode for the LETREC family of languages, and the stack machine that runs it.
+
+Program.assemble() turns a program into a Code object: a flat array('i') of
+instructions, a pool of constants and the type of Context to run in. Every
+node has an emit() method that appends its own instructions, much like
+compile() builds closures.
+
+The machine keeps values on one operand stack and return addresses on a call
+stack, both Python lists, so deep recursion in a program doesn't use the
+Python stack. Variables are resolved to lexical addresses (see Scope) and live
+in Frames; a procedure is its entry point and the Frame it was made in.
+
+Code can be stored with to_bytes() and loaded again with Code.from_bytes().
+"""
+
+import importlib
+import marshal
+import operator
+import struct
+from array import array
+
+from eopl.base import Frame, Context
+
+__all__ = ('Code', 'VMProcedure', 'run', 'OPERATORS')
+
+
+# Opcodes, with their operands
+# ===============================================
+
+OPCODES = [
+    ('CONST', 1),           # constant index
+    ('LOAD0', 1),           # index in the current frame
+    ('LOAD1', 1),           # index in the parent frame
+    ('LOAD', 2),            # depth, index
+    ('STORE0', 1),          # index in the current frame, pops the value
+    ('BINARY', 1),          # index in OPERATORS
+    ('UNARY', 1),           # index in OPERATORS
+    ('JUMP', 1),            # target
+    ('JUMP_IF_FALSE', 1),   # target, pops the condition
+    ('POP', 0),
+    ('WRAP', 0),            # ctx.wrap the top of the stack
+    ('LET', 2),             # constant index of the names, number of values to pop
+    ('LETREC', 2),          # constant index of the names, number of slots
+    ('END_LET', 0),
+    ('MAKE_PROC', 2),       # entry, constant index of the argument names
+    ('CALL', 0),            # pops the argument and the procedure
+    ('TAIL_CALL', 0),
+    ('RETURN', 0),
+    ('NEWREF', 0),
+    ('DEREF', 0),
+    ('SETREF', 0),
+    ('HALT', 0),
+]
+
+OPNAMES = [name for name, _ in OPCODES]
+OPERANDS = [n for _, n in OPCODES]
+globals().update({name: i for i, name in enumerate(OPNAMES)})
+
+# Functions for BINARY and UNARY; the index is part of the bytecode format,
+# only ever add to the end
+OPERATORS = (
+    operator.add, operator.sub, operator.mul, operator.floordiv, operator.mod,
+    operator.eq, operator.ne, operator.lt, operator.le, operator.gt, operator.ge,
+    operator.and_, operator.or_, operator.neg, operator.not_,
+)
+
+# Safe points (garbage collection of the store) happen every so many calls
+SAFE_POINT_INTERVAL = 256
+
+
+class VMProcedure:
+    __slots__ = ('entry', 'names', 'env')
+
+    def __init__(self, entry, names, env):
+        self.entry = entry
+        self.names = names
+        self.env = env
+
+    def __repr__(self):
+        return f"VMProcedure({self.names[0]!r} @ {self.entry})"
+
+
+# Code objects
+# ===============================================
+
+MAGIC = b'EOPLVM'
+FORMAT_VERSION = 1
+
+
+class Code:
+    def __init__(self, context=Context, instructions=None, constants=None):
+        self.context = context
+        self.instructions = array('i') if instructions is None else instructions
+        self.constants = [] if constants is None else constants
+        self._constant_index = {(type(c), c): i for i, c in enumerate(self.constants)}
+        # Values only need wrapping if the context does something with them
+        self.wraps = context.wrap is not Context.wrap
+
+    def emit(self, op, *operands):
+        """Append an instruction, returns the position of its first operand."""
+        assert len(operands) == OPERANDS[op], f"{OPNAMES[op]} takes {OPERANDS[op]} operand(s)"
+        if op == WRAP and not self.wraps:
+            return self.position
+        self.instructions.append(op)
+        self.instructions.extend(operands)
+        return len(self.instructions) - len(operands)
+
+    def constant(self, value):
+        """Index of `value` in the constant pool, adding it if needed."""
+        key = (type(value), value)
+        index = self._constant_index.get(key)
+        if index is None:
+            index = self._constant_index[key] = len(self.constants)
+            self.constants.append(value)
+        return index
+
+    def operator(self, func):
+        try:
+            return OPERATORS.index(func)
+        except ValueError:
+            raise Exception(f"No bytecode for operator {func}") from None
+
+    @property
+    def position(self):
+        return len(self.instructions)
+
+    def patch(self, at, target=None):
+        """Fill in a jump target emitted earlier, by default the current position."""
+        self.instructions[at] = self.position if target is None else target
+
+    def run(self, ctx=None):
+        return run(self, self.context() if ctx is None else ctx)
+
+    def disassemble(self):
+        lines = []
+        code = self.instructions
+        pc = 0
+        while pc < len(code):
+            op = code[pc]
+            operands = list(code[pc + 1:pc + 1 + OPERANDS[op]])
+            comment = ''
+            if op in (CONST, LET, LETREC, MAKE_PROC):
+                comment = f"  ({self.constants[operands[0 if op != MAKE_PROC else 1]]!r})"
+            elif op in (BINARY, UNARY):
+                comment = f"  ({OPERATORS[operands[0]].__name__})"
+            lines.append(f"{pc:>5} {OPNAMES[op]:<14}{' '.join(map(str, operands))}{comment}")
+            pc += 1 + OPERANDS[op]
+        return '\n'.join(lines)
+
+    # Serialization
+
+    def to_bytes(self):
+        context = f"{self.context.__module__}:{self.context.__qualname__}"
+        payload = marshal.dumps((context, self.instructions.itemsize,
+                                 self.instructions.tobytes(), self.constants))
+        return MAGIC + struct.pack('<H', FORMAT_VERSION) + payload
+
+    @classmethod
+    def from_bytes(cls, data):
+        if data[:len(MAGIC)] != MAGIC:
+            raise Exception("Not eopl bytecode")
+        start = len(MAGIC) + 2
+        [version] = struct.unpack('<H', data[len(MAGIC):start])
+        if version != FORMAT_VERSION:
+            raise Exception(f"Unsupported bytecode version {version}")
+        context, itemsize, raw, constants = marshal.loads(data[start:])
+        module, _, qualname = context.partition(':')
+        if not module.startswith('eopl'):
+            raise Exception(f"Context {context} is not part of eopl")
+        context_type = importlib.import_module(module)
+        for part in qualname.split('.'):
+            context_type = getattr(context_type, part)
+        instructions = array('i')
+        if instructions.itemsize != itemsize:
+            raise Exception("Bytecode was made on a platform with a different int size")
+        instructions.frombytes(raw)
+        return cls(context_type, instructions, constants)
+
+
+# The machine
+# ===============================================
+
+def run(code, ctx,
+        # Opcodes as locals, they're compared a lot
+        CONST=CONST, LOAD0=LOAD0, LOAD1=LOAD1, LOAD=LOAD, STORE0=STORE0, BINARY=BINARY,
+        UNARY=UNARY, JUMP=JUMP, JUMP_IF_FALSE=JUMP_IF_FALSE, POP=POP, WRAP=WRAP, LET=LET,
+        LETREC=LETREC, END_LET=END_LET, MAKE_PROC=MAKE_PROC, CALL=CALL, TAIL_CALL=TAIL_CALL,
+        RETURN=RETURN, NEWREF=NEWREF, DEREF=DEREF, SETREF=SETREF, HALT=HALT):
+    # A list is faster to index than the array
+    instructions = code.instructions.tolist()
+    constants = code.constants
+    wrap = ctx.wrap
+    store = getattr(ctx, 'store', None)
+    stack = []
+    push = stack.append
+    pop = stack.pop
+    calls = []
+    env = Frame((), (), None)
+    countdown = SAFE_POINT_INTERVAL
+    pc = 0
+
+    while True:
+        op = instructions[pc]
+        if op == LOAD0:
+            push(env.values[instructions[pc + 1]])
+            pc += 2
+        elif op == CONST:
+            push(constants[instructions[pc + 1]])
+            pc += 2
+        elif op == BINARY:
+            b = pop()
+            stack[-1] = OPERATORS[instructions[pc + 1]](stack[-1], b)
+            pc += 2
+        elif op == JUMP_IF_FALSE:
+            pc = pc + 2 if pop() else instructions[pc + 1]
+        elif op == LOAD1:
+            push(env.parent.values[instructions[pc + 1]])
+            pc += 2
+        elif op == WRAP:
+            stack[-1] = wrap(stack[-1])
+            pc += 1
+        elif op == CALL or op == TAIL_CALL:
+            arg = pop()
+            proc = pop()
+            if type(proc) is not VMProcedure:
+                raise Exception(f"Can't call {proc!r}")
+            if op == CALL:
+                calls.append((pc + 1, env))
+            env = Frame(proc.names, (arg,), proc.env)
+            pc = proc.entry
+            countdown -= 1
+            if not countdown:
+                countdown = SAFE_POINT_INTERVAL
+                ctx.safe_point(env, stack, calls)
+        elif op == RETURN:
+            pc, env = calls.pop()
+        elif op == LOAD:
+            frame = env
+            for _ in range(instructions[pc + 1]):
+                frame = frame.parent
+            push(frame.values[instructions[pc + 2]])
+            pc += 3
+        elif op == JUMP:
+            pc = instructions[pc + 1]
+        elif op == LET:
+            n = instructions[pc + 2]
+            values = tuple(stack[-n:])
+            del stack[-n:]
+            env = Frame(constants[instructions[pc + 1]], values, env)
+            pc += 3
+        elif op == END_LET:
+            env = env.parent
+            pc += 1
+        elif op == UNARY:
+            stack[-1] = OPERATORS[instructions[pc + 1]](stack[-1])
+            pc += 2
+        elif op == POP:
+            pop()
+            pc += 1
+        elif op == DEREF:
+            stack[-1] = store.deref(stack[-1])
+            pc += 1
+        elif op == SETREF:
+            val = pop()
+            store.setref(pop(), val)
+            push(val)
+            pc += 1
+        elif op == NEWREF:
+            ref = store.newref()
+            store.setref(ref, stack[-1])
+            stack[-1] = ref
+            pc += 1
+        elif op == MAKE_PROC:
+            push(VMProcedure(instructions[pc + 1], constants[instructions[pc + 2]], env))
+            pc += 3
+        elif op == LETREC:
+            env = Frame(constants[instructions[pc + 1]], [None] * instructions[pc + 2], env)
+            pc += 3
+        elif op == STORE0:
+            env.values[instructions[pc + 1]] = pop()
+            pc += 2
+        elif op == HALT:
+            return pop()
+        else:
+            raise Exception(f"Bad opcode {op} at {pc}")
+
+
+# Tests
+# ===============================================
+
+import unittest
+
+
+class TestCode(unittest.TestCase):
+    def test_roundtrip(self):
+        from eopl.state import LETREC, IMPLICIT_REFS, ImplicitStoreContext
+        s = "letrec fact(n) = if n == 0 then 1 else n * fact(n - 1) in fact(10)"
+        data = LETREC.parse(s).assemble().to_bytes()
+        self.assertEqual(Code.from_bytes(data).run(), 3628800)
+
+        s = "let x = 0 in letrec loop(i) = if i == 0 then x else begin set x = x + i; loop(i - 1) end in loop(10)"
+        code = Code.from_bytes(IMPLICIT_REFS.parse(s).assemble().to_bytes())
+        self.assertIs(code.context, ImplicitStoreContext)
+        self.assertEqual(code.run(), 55)
+
+    def test_invalid(self):
+        from eopl.expressions import LET
+        data = LET.parse("1 + 2").assemble().to_bytes()
+        with self.assertRaisesRegex(Exception, "Not eopl bytecode"):
+            Code.from_bytes(b'garbage' + data)
+        with self.assertRaisesRegex(Exception, "Unsupported bytecode version"):
+            Code.from_bytes(MAGIC + struct.pack('<H', 99) + data[len(MAGIC) + 2:])
+
+    def test_constants(self):
+        code = Code()
+        self.assertEqual([code.constant(v) for v in (1, True, 1, 'a', True)], [0, 1, 0, 2, 1])
+
+    def test_disassemble(self):
+        from eopl.expressions import LET
+        text = LET.parse("let x = 1 in x + 2").assemble().disassemble()
+        self.assertIn("LET", text)
+        self.assertIn("(add)", text)
+
+
+if __name__ == '__main__':
+    unittest.main()